@@ -1,37 +1,96 @@
+import asyncio
+import hashlib
+import hmac
+import logging
 import os
 import tempfile
-import zipfile
-from typing import Optional, List
+import time
+from contextlib import asynccontextmanager
+from typing import List, Optional, Set
+from urllib.parse import urlencode
 
 from fastapi import FastAPI, Request, UploadFile, Form, File
 from fastapi.responses import (
     HTMLResponse,
     RedirectResponse,
     PlainTextResponse,
-    FileResponse,
+    JSONResponse,
     Response,
+    StreamingResponse,
 )
 from fastapi.templating import Jinja2Templates
 from starlette.middleware.sessions import SessionMiddleware
 from starlette.status import HTTP_303_SEE_OTHER
-from aiogram import Bot
-from aiogram.types import FSInputFile, InputMediaPhoto
-
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+import aiofiles
+
+from backup import (
+    BackupError,
+    apply_restore,
+    discard_restore,
+    new_backup_id,
+    stage_restore,
+    stream_backup,
+)
+from broadcaster import BroadcastEngine, BroadcastJob
+import dispatch
+import ipc
+import media
+import metrics
+import profiler
+import tracks_io
+import users
 from db import (
-    list_tracks,
+    list_tracks_page,
     create_track,
     update_track,
     delete_track,
+    import_tracks,
     list_broadcasts,
     create_broadcast,
-    mark_broadcast_sent,
-    get_all_users,
+    count_users,
+    seed_broadcast_deliveries,
+    get_delivery_counts,
+    get_delivery_errors,
     get_track,
     create_broadcast_file,
+    find_broadcast_file,
     delete_broadcast,
+    swap_database,
+    save_backup_manifest,
+    get_backup_manifest,
+    get_last_backup_id,
 )
 
 TEMPLATES = Jinja2Templates(directory="templates")
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+TRACKS_PAGE_SIZE = 50
+IMPORT_ERRORS_SHOWN = 200
+
+# куда Telegram шлет апдейты в режиме webhook (см. main.py, WEBHOOK_URL)
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+# сколько при остановке ждать обработки уже принятых апдейтов
+WEBHOOK_DRAIN_TIMEOUT = 10.0
+# сколько webhook-запрос ждет места в переполненной очереди апдейтов
+WEBHOOK_BACKPRESSURE_TIMEOUT = 10.0
+# Bot API все равно не отправит файл больше 50 МБ
+MAX_UPLOAD_BYTES = int(os.getenv("BROADCAST_MAX_UPLOAD_MB", "50")) * 1024 * 1024
+# если задан - /metrics отдается только с заголовком Authorization: Bearer <token>
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+logger = logging.getLogger(__name__)
+
+
+class UploadTooLarge(Exception):
+    """Загруженный файл больше MAX_UPLOAD_BYTES."""
+
+
+def _remove_quietly(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
 
 
 def get_admin_password() -> str:
@@ -47,12 +106,126 @@ async def ensure_admin(request: Request) -> Optional[Response]:
     return None
 
 
-def create_app(bot: Bot) -> FastAPI:
-    app = FastAPI()
+async def _process_update(bot: Bot, dp: Dispatcher, update: Update) -> None:
+    try:
+        await dp.feed_update(bot, update)
+    except Exception:
+        logger.exception("Failed to process webhook update %s", update.update_id)
+
+
+def _add_webhook_route(
+    app: FastAPI,
+    bot: Bot,
+    dp: Dispatcher,
+    webhook_secret: Optional[str],
+    update_tasks: Set["asyncio.Task[None]"],
+) -> None:
+    if not webhook_secret:
+        raise RuntimeError("Для webhook нужен секрет (WEBHOOK_SECRET)")
+    expected_secret = webhook_secret.encode()
+    scheduler = dispatch.get_scheduler(dp)
+
+    @app.post(WEBHOOK_PATH)
+    async def telegram_webhook(request: Request):
+        secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(secret.encode(), expected_secret):
+            return Response(status_code=403)
+
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": bot})
+        except ValueError:
+            return Response(status_code=400)
+
+        # очередь апдейтов переполнена - не отвечаем, пока не разгрузится:
+        # Telegram держит ограниченное число запросов к webhook, так что
+        # притормаживает и он; не дождались - 503, апдейт придет повторно
+        if scheduler is not None and scheduler.overloaded:
+            metrics.UPDATES_THROTTLED.inc("webhook")
+            if not await scheduler.wait_capacity(WEBHOOK_BACKPRESSURE_TIMEOUT):
+                metrics.UPDATES_REJECTED.inc()
+                return Response(status_code=503)
+
+        # отвечаем сразу, обработчик работает в фоне: Telegram не ждет
+        # медленные хендлеры и не пересылает апдейт повторно
+        task = asyncio.create_task(_process_update(bot, dp, update))
+        update_tasks.add(task)
+        task.add_done_callback(update_tasks.discard)
+        return Response(status_code=200)
+
+
+async def _drain_updates(bot: Bot, dp: Dispatcher, update_tasks: Set["asyncio.Task[None]"]) -> None:
+    # даем досчитать принятые апдейты: Telegram их повторно не пришлет
+    if update_tasks:
+        await asyncio.wait(list(update_tasks), timeout=WEBHOOK_DRAIN_TIMEOUT)
+    await dp.emit_shutdown(bot=bot, dispatcher=dp)
+
+
+def create_webhook_app(bot: Bot, dp: Dispatcher, webhook_secret: Optional[str]) -> FastAPI:
+    """Только прием апдейтов - для воркеров бота в режиме PROCESS_MODE=split."""
+    update_tasks: Set["asyncio.Task[None]"] = set()
+
+    @asynccontextmanager
+    async def lifespan(_app: FastAPI):
+        await dp.emit_startup(bot=bot, dispatcher=dp)
+        yield
+        await _drain_updates(bot, dp, update_tasks)
+
+    app = FastAPI(lifespan=lifespan)
+    _add_webhook_route(app, bot, dp, webhook_secret, update_tasks)
+
+    @app.get("/healthz")
+    async def healthz():
+        return PlainTextResponse("ok")
+
+    return app
+
+
+def create_app(
+    bot: Bot,
+    dp: Optional[Dispatcher] = None,
+    webhook_secret: Optional[str] = None,
+    hub: Optional[ipc.Hub] = None,
+) -> FastAPI:
+    """
+    Админка. Если передан dp - еще и прием апдейтов Telegram
+    через webhook на WEBHOOK_PATH (вместо long polling).
+    Если передан hub - бот работает в отдельных процессах (PROCESS_MODE=split):
+    рассылки и сброс кэшей уходят им по IPC.
+    """
+    broadcaster = BroadcastEngine(bot) if hub is None else ipc.RemoteBroadcastEngine(hub)
+    # апдейты, которые еще обрабатываются в фоне
+    update_tasks: Set["asyncio.Task[None]"] = set()
+
+    @asynccontextmanager
+    async def lifespan(_app: FastAPI):
+        # рассылки, прерванные прошлым рестартом, продолжаются с чекпоинта
+        # (в режиме split это делает сам воркер рассылок при старте)
+        if hub is None:
+            await broadcaster.resume()
+        if dp is not None:
+            await dp.emit_startup(bot=bot, dispatcher=dp)
+        yield
+        if dp is not None:
+            await _drain_updates(bot, dp, update_tasks)
+        if hub is None:
+            await broadcaster.stop()
+
+    app = FastAPI(lifespan=lifespan)
 
     secret_key = os.getenv("SESSION_SECRET", "dev-secret-change-me")
     app.add_middleware(SessionMiddleware, secret_key=secret_key)
     app.state.bot = bot
+    app.state.broadcaster = broadcaster
+
+    async def tracks_changed() -> None:
+        """Каталог поменялся: воркерам бота - перечитать версию (в одном процессе не нужно)."""
+        if hub is not None:
+            await hub.broadcast("tracks_changed")
+
+    # ---------- TELEGRAM WEBHOOK ----------
+
+    if dp is not None:
+        _add_webhook_route(app, bot, dp, webhook_secret, update_tasks)
 
     # ---------- AUTH ----------
 
@@ -86,14 +259,44 @@ def create_app(bot: Bot) -> FastAPI:
         if (resp := await ensure_admin(request)) is not None:
             return resp
 
-        tracks = await list_tracks()
-        restore_status = request.query_params.get("restore")
+        params = request.query_params
+        q = params.get("q", "").strip()
+        active_param = params.get("active", "")
+        active = {"1": True, "0": False}.get(active_param)
+        points_param = params.get("points", "")
+        points = int(points_param) if points_param.isdigit() else None
+        before = params.get("before", "")
+        before_id = int(before) if before.isdigit() else None
+
+        tracks, next_before = await list_tracks_page(
+            before_id=before_id,
+            limit=TRACKS_PAGE_SIZE,
+            query=q or None,
+            active=active,
+            points=points,
+        )
+
+        # фильтры переносим в ссылку на следующую страницу
+        filters = {"q": q, "active": active_param, "points": points_param}
+        filters = {k: v for k, v in filters.items() if v}
+        next_url = None
+        if next_before is not None:
+            next_url = "/admin_web?" + urlencode({**filters, "before": next_before})
+        first_url = "/admin_web?" + urlencode(filters) if before_id is not None else None
+
+        restore_status = params.get("restore")
         return TEMPLATES.TemplateResponse(
             "index.html",
             {
                 "request": request,
                 "tracks": tracks,
+                "q": q,
+                "active": active_param,
+                "points": points_param,
+                "next_url": next_url,
+                "first_url": first_url,
                 "restore_status": restore_status,
+                "last_backup_id": await get_last_backup_id(),
             },
         )
 
@@ -115,8 +318,10 @@ def create_app(bot: Bot) -> FastAPI:
             points_val = int(points)
         except ValueError:
             points_val = 1
+        points_val = min(max(points_val, 1), tracks_io.MAX_POINTS)
 
         await create_track(title, points_val, hint.strip() if hint else None)
+        await tracks_changed()
         return RedirectResponse("/admin_web", status_code=HTTP_303_SEE_OTHER)
 
     @app.post("/admin_web/tracks/{track_id}/edit")
@@ -139,6 +344,7 @@ def create_app(bot: Bot) -> FastAPI:
             points_val = int(points)
         except ValueError:
             points_val = 1
+        points_val = min(max(points_val, 1), tracks_io.MAX_POINTS)
 
         await update_track(
             track_id=track_id,
@@ -147,6 +353,7 @@ def create_app(bot: Bot) -> FastAPI:
             hint=hint.strip() if hint else None,
             is_active=bool(is_active),
         )
+        await tracks_changed()
         return RedirectResponse("/admin_web", status_code=HTTP_303_SEE_OTHER)
 
     @app.post("/admin_web/tracks/{track_id}/delete")
@@ -155,8 +362,63 @@ def create_app(bot: Bot) -> FastAPI:
             return resp
 
         await delete_track(track_id)
+        await tracks_changed()
         return RedirectResponse("/admin_web", status_code=HTTP_303_SEE_OTHER)
 
+    # ---------- IMPORT / EXPORT ----------
+
+    @app.get("/admin_web/tracks/import", response_class=HTMLResponse)
+    async def tracks_import_page(request: Request):
+        if (resp := await ensure_admin(request)) is not None:
+            return resp
+
+        return TEMPLATES.TemplateResponse(
+            "tracks_import.html",
+            {"request": request, "error": None, "result": None},
+        )
+
+    @app.post("/admin_web/tracks/import", response_class=HTMLResponse)
+    async def tracks_import_submit(request: Request, file: UploadFile = File(...)):
+        if (resp := await ensure_admin(request)) is not None:
+            return resp
+
+        def render(error: Optional[str] = None, result: Optional[dict] = None):
+            return TEMPLATES.TemplateResponse(
+                "tracks_import.html",
+                {"request": request, "error": error, "result": result},
+            )
+
+        fmt = tracks_io.format_of(file.filename or "")
+        if fmt is None:
+            return render(error="Нужен файл .csv или .json")
+
+        # разбор и проверка строк - в отдельном потоке, файл читается кусками
+        try:
+            rows, errors = await asyncio.to_thread(tracks_io.read_tracks, file.file, fmt)
+        except tracks_io.TrackFormatError as e:
+            return render(error=str(e))
+
+        imported = await import_tracks(rows)
+        await tracks_changed()
+        return render(result={
+            "imported": imported,
+            "errors": errors[:IMPORT_ERRORS_SHOWN],
+            "errors_total": len(errors),
+        })
+
+    @app.get("/admin_web/tracks/export")
+    async def tracks_export(request: Request, format: str = "csv"):
+        if (resp := await ensure_admin(request)) is not None:
+            return resp
+
+        fmt = "json" if format == "json" else "csv"
+        media_type = "application/json" if fmt == "json" else "text/csv; charset=utf-8"
+        return StreamingResponse(
+            tracks_io.export_tracks(fmt),
+            media_type=media_type,
+            headers={"Content-Disposition": f'attachment; filename="kazoo-tracks.{fmt}"'},
+        )
+
     # ---------- BROADCASTS ----------
 
     @app.get("/admin_web/broadcasts", response_class=HTMLResponse)
@@ -167,6 +429,9 @@ def create_app(bot: Bot) -> FastAPI:
         broadcasts = await list_broadcasts()
         sent = request.query_params.get("sent")
         failed = request.query_params.get("failed")
+        job_id = request.query_params.get("job")
+        engine: BroadcastEngine = request.app.state.broadcaster
+        running_ids = {b[0] for b in broadcasts if engine.is_running(b[0])}
         return TEMPLATES.TemplateResponse(
             "broadcasts_list.html",
             {
@@ -174,6 +439,8 @@ def create_app(bot: Bot) -> FastAPI:
                 "broadcasts": broadcasts,
                 "sent": sent,
                 "failed": failed,
+                "job_id": job_id,
+                "running_ids": running_ids,
             },
         )
 
@@ -182,6 +449,7 @@ def create_app(bot: Bot) -> FastAPI:
         if (resp := await ensure_admin(request)) is not None:
             return resp
 
+        await request.app.state.broadcaster.cancel(broadcast_id)
         await delete_broadcast(broadcast_id)
         return RedirectResponse("/admin_web/broadcasts", status_code=HTTP_303_SEE_OTHER)
 
@@ -202,23 +470,52 @@ def create_app(bot: Bot) -> FastAPI:
     ) -> List[str]:
         saved_paths: List[str] = []
         base_dir = os.path.join("uploads", "broadcasts", str(broadcast_id), kind)
-        os.makedirs(base_dir, exist_ok=True)
 
         for up in files:
             if not up or not up.filename:
                 continue
-            data = await up.read()
-            if not data:
-                continue
 
             filename = up.filename.replace("/", "_").replace("\\", "_")
-            path = os.path.join(base_dir, filename)
-            with open(path, "wb") as f:
-                f.write(data)
+            os.makedirs(base_dir, exist_ok=True)
+            # имя итогового файла известно только после подсчета sha256
+            fd, tmp_path = tempfile.mkstemp(suffix=".part", dir=base_dir)
+            os.close(fd)
+
+            # пишем кусками и сразу считаем sha256: память не зависит от размера файла
+            digest = hashlib.sha256()
+            size = 0
+            try:
+                async with aiofiles.open(tmp_path, "wb") as f:
+                    while chunk := await up.read(UPLOAD_CHUNK_SIZE):
+                        size += len(chunk)
+                        if size > MAX_UPLOAD_BYTES:
+                            raise UploadTooLarge(up.filename)
+                        digest.update(chunk)
+                        await f.write(chunk)
+            except BaseException:
+                await asyncio.to_thread(_remove_quietly, tmp_path)
+                raise
+
+            if not size:
+                await asyncio.to_thread(_remove_quietly, tmp_path)
+                continue
 
-            rel_path = path
-            await create_broadcast_file(broadcast_id, kind, rel_path)
-            saved_paths.append(rel_path)
+            sha256 = digest.hexdigest()
+            existing = await find_broadcast_file(kind, sha256)
+            if existing and os.path.exists(existing):
+                # такой файл уже загружали: храним одну копию (и один file_id)
+                await asyncio.to_thread(_remove_quietly, tmp_path)
+                path = existing
+            else:
+                # путь зависит от содержимого: одноименный файл с другим
+                # содержимым ляжет рядом и не перезапишет тот, на который
+                # уже ссылаются (и на который указывает поиск по sha256)
+                path = os.path.join(base_dir, sha256, filename)
+                await asyncio.to_thread(os.makedirs, os.path.dirname(path), exist_ok=True)
+                await asyncio.to_thread(os.replace, tmp_path, path)
+
+            await create_broadcast_file(broadcast_id, kind, path, sha256)
+            saved_paths.append(path)
 
         return saved_paths
 
@@ -253,8 +550,11 @@ def create_app(bot: Bot) -> FastAPI:
             full_text = (title or body).strip()
 
         bot: Bot = request.app.state.bot
-        users = await get_all_users()
-        if not users:
+        # новые пользователи могли еще не доехать до базы
+        await users.flush()
+        if hub is not None:
+            await hub.broadcast("users_flush")
+        if not await count_users():
             return TEMPLATES.TemplateResponse(
                 "broadcasts_new.html",
                 {"request": request, "error": "Нет пользователей для рассылки"},
@@ -262,100 +562,60 @@ def create_app(bot: Bot) -> FastAPI:
 
         bid = await create_broadcast(full_text)
 
-        image_paths = await _save_files_for_broadcast(bid, images, "photo") if images else []
-        video_paths = await _save_files_for_broadcast(bid, videos, "video") if videos else []
-        file_paths = await _save_files_for_broadcast(bid, files, "file") if files else []
-
-        sent = 0
-        failed = 0
-
-        for uid in users:
-            user_failed = False
-            caption_used = False  # уже прикрепляли текст как caption?
-
-            # 1) Картинки — как и было: текст в подписи к первой
-            try:
-                if image_paths:
-                    if len(image_paths) == 1:
-                        await bot.send_photo(
-                            uid,
-                            FSInputFile(image_paths[0]),
-                            caption=full_text or None,
-                        )
-                        if full_text:
-                            caption_used = True
-                    else:
-                        media = []
-                        for i, p in enumerate(image_paths):
-                            cap = full_text if i == 0 and full_text else None
-                            if cap:
-                                caption_used = True
-                            media.append(
-                                InputMediaPhoto(
-                                    media=FSInputFile(p),
-                                    caption=cap,
-                                )
-                            )
-                        await bot.send_media_group(uid, media)
-
-            except Exception as e:
-                print(f"[broadcast] photo/text error for {uid}: {e}")
-                user_failed = True
-
-            # 2) Видео — если нет картинок, текст идёт как подпись к первому видео
-            for i, p in enumerate(video_paths):
-                cap = None
-                if full_text and not caption_used and i == 0:
-                    cap = full_text
-                    caption_used = True
-                try:
-                    await bot.send_video(uid, FSInputFile(p), caption=cap)
-                except Exception as e:
-                    # fallback: пробуем как документ (вдруг слишком большой/нестандартный контейнер)
-                    print(f"[broadcast] video error for {uid}, fallback to document: {e}")
-                    try:
-                        await bot.send_document(uid, FSInputFile(p), caption=cap)
-                    except Exception as e2:
-                        print(f"[broadcast] video-document error for {uid}: {e2}")
-                        user_failed = True
-
-            # 3) Файлы (аудио/доки) — если нет ни картинок, ни видео, текст идёт в подписи к первому файлу
-            audio_exts = {".mp3", ".ogg", ".wav", ".m4a"}
-            for i, p in enumerate(file_paths):
-                cap = None
-                if full_text and not caption_used and i == 0:
-                    cap = full_text
-                    caption_used = True
-
-                ext = os.path.splitext(p)[1].lower()
-                try:
-                    if ext in audio_exts:
-                        await bot.send_audio(uid, FSInputFile(p), caption=cap)
-                    else:
-                        await bot.send_document(uid, FSInputFile(p), caption=cap)
-                except Exception as e:
-                    print(f"[broadcast] file error for {uid}: {e}")
-                    user_failed = True
-
-            # 4) Если ни одной медиа не было вообще — отправляем просто текст
-            if not caption_used and not (image_paths or video_paths or file_paths) and full_text:
-                try:
-                    await bot.send_message(uid, full_text)
-                except Exception as e:
-                    print(f"[broadcast] text-only error for {uid}: {e}")
-                    user_failed = True
-
-            if user_failed:
-                failed += 1
-            else:
-                sent += 1
+        try:
+            image_paths = await _save_files_for_broadcast(bid, images, "photo") if images else []
+            video_paths = await _save_files_for_broadcast(bid, videos, "video") if videos else []
+            file_paths = await _save_files_for_broadcast(bid, files, "file") if files else []
+        except UploadTooLarge as e:
+            await delete_broadcast(bid)
+            return TEMPLATES.TemplateResponse(
+                "broadcasts_new.html",
+                {
+                    "request": request,
+                    "error": f"Файл {e} больше {MAX_UPLOAD_BYTES // (1024 * 1024)} МБ",
+                },
+            )
 
-        await mark_broadcast_sent(bid)
+        engine: BroadcastEngine = request.app.state.broadcaster
+        job = BroadcastJob(
+            id=bid,
+            text=full_text,
+            image_paths=image_paths,
+            video_paths=video_paths,
+            file_paths=file_paths,
+        )
+        # журнал доставки заполняем до старта: по нему рассылка переживает рестарт
+        await seed_broadcast_deliveries(bid)
+        engine.start(job)
         return RedirectResponse(
-            f"/admin_web/broadcasts?sent={sent}&failed={failed}",
+            f"/admin_web/broadcasts?job={bid}",
             status_code=HTTP_303_SEE_OTHER,
         )
 
+    @app.get("/admin_web/broadcasts/{broadcast_id}/progress")
+    async def broadcasts_progress(request: Request, broadcast_id: int):
+        if (resp := await ensure_admin(request)) is not None:
+            return resp
+
+        engine: BroadcastEngine = request.app.state.broadcaster
+        job = engine.get(broadcast_id)
+        if job is not None and engine.is_running(broadcast_id):
+            data = job.as_dict()
+        else:
+            # не запущена в этом процессе - считаем по журналу доставки
+            counts = await get_delivery_counts(broadcast_id)
+            data = {
+                "id": broadcast_id,
+                "status": job.status if job else "idle",
+                "total": sum(counts.values()),
+                "sent": counts.get("sent", 0),
+                "failed": counts.get("failed", 0),
+                "remaining": counts.get("pending", 0),
+                "rate": 0.0,
+            }
+        data["errors"] = await get_delivery_errors(broadcast_id)
+        return JSONResponse(data)
+
     # ---------- BACKUP / RESTORE ----------
 
     @app.get("/admin_web/backup")
@@ -363,62 +623,153 @@ def create_app(bot: Bot) -> FastAPI:
         if (resp := await ensure_admin(request)) is not None:
             return resp
 
-        base = "uploads"
-        os.makedirs(base, exist_ok=True)
+        # ?since=<id> или ?incremental=1 (от последнего бэкапа) - инкрементальный
+        since = request.query_params.get("since")
+        if not since and request.query_params.get("incremental"):
+            since = await get_last_backup_id()
+        base = await get_backup_manifest(since) if since else None
 
-        fd, tmp_path = tempfile.mkstemp(suffix=".zip")
-        os.close(fd)
-
-        with zipfile.ZipFile(tmp_path, "w", compression=zipfile.ZIP_DEFLATED) as zf:
-            if os.path.isdir(base):
-                for root_dir, _dirs, files in os.walk(base):
-                    for name in files:
-                        full = os.path.join(root_dir, name)
-                        rel = os.path.relpath(full, start=".")
-                        zf.write(full, arcname=rel)
-
-        return FileResponse(
-            tmp_path,
-            filename="kazoo-backup.zip",
+        backup_id = new_backup_id()
+        kind = "incr" if base else "full"
+        return StreamingResponse(
+            stream_backup(backup_id, base, on_complete=save_backup_manifest),
             media_type="application/zip",
+            headers={
+                "Content-Disposition":
+                    f'attachment; filename="kazoo-backup-{backup_id}-{kind}.zip"',
+            },
         )
 
     @app.post("/admin_web/restore")
-    async def restore(request: Request, archive: UploadFile):
+    async def restore(request: Request, archives: List[UploadFile] = File(default=[])):
         if (resp := await ensure_admin(request)) is not None:
             return resp
 
-        if not archive or not archive.filename:
+        archives = [a for a in archives if a and a.filename]
+        if not archives:
             return RedirectResponse(
                 "/admin_web?restore=missing",
                 status_code=HTTP_303_SEE_OTHER,
             )
 
-        base = "uploads"
-        os.makedirs(base, exist_ok=True)
-
-        fd, tmp_path = tempfile.mkstemp(suffix=".zip")
-        os.close(fd)
-        with open(tmp_path, "wb") as f:
-            f.write(await archive.read())
+        if hub is not None and hub.missing_workers():
+            # воркер без связи с админкой не закроет базу перед подменой файла
+            logger.warning("Restore refused: bot workers %s are not connected", hub.missing_workers())
+            return RedirectResponse(
+                "/admin_web?restore=workers",
+                status_code=HTTP_303_SEE_OTHER,
+            )
 
-        with zipfile.ZipFile(tmp_path, "r") as zf:
-            for member in zf.infolist():
-                member_path = os.path.normpath(member.filename)
-                if not member_path.startswith("uploads"):
-                    continue
-                zf.extract(member, ".")
+        os.makedirs("uploads", exist_ok=True)
+        engine: BroadcastEngine = request.app.state.broadcaster
 
+        tmp_paths: List[str] = []
         try:
-            os.remove(tmp_path)
-        except Exception:
-            pass
+            # архив пишем на диск кусками, не держа его целиком в памяти
+            for archive in archives:
+                fd, tmp_path = tempfile.mkstemp(suffix=".zip")
+                os.close(fd)
+                tmp_paths.append(tmp_path)
+                async with aiofiles.open(tmp_path, "wb") as f:
+                    while chunk := await archive.read(UPLOAD_CHUNK_SIZE):
+                        await f.write(chunk)
+
+            # проверка и распаковка (base + цепочка инкрементов или один
+            # старый архив) рядом с живыми файлами - в отдельном потоке,
+            # бот продолжает отвечать
+            staged = await asyncio.to_thread(stage_restore, tmp_paths)
+        except BackupError as e:
+            logger.warning("Restore rejected: %s", e)
+            return RedirectResponse(
+                "/admin_web?restore=invalid",
+                status_code=HTTP_303_SEE_OTHER,
+            )
+        finally:
+            for tmp_path in tmp_paths:
+                try:
+                    os.remove(tmp_path)
+                except Exception:
+                    pass
+
+        if staged.db_path is None:
+            # в архиве только файлы
+            await asyncio.to_thread(apply_restore, staged)
+        else:
+            # рассылки пишут журнал доставки в текущую базу - останавливаем
+            # их на время подмены и продолжаем уже по восстановленной
+            await engine.stop()
+            engine.jobs.clear()
+            if hub is not None:
+                # воркеры бота закрывают свои соединения до подмены файла;
+                # не закрыл хоть один - подменять файл под ним нельзя
+                try:
+                    await hub.suspend_workers()
+                except (ipc.IPCError, asyncio.TimeoutError) as e:
+                    logger.warning("Restore aborted: %s", e)
+                    # uploads/ еще не трогали: достаточно убрать подготовленное
+                    await asyncio.to_thread(discard_restore, staged)
+                    await engine.resume()
+                    return RedirectResponse(
+                        "/admin_web?restore=workers",
+                        status_code=HTTP_303_SEE_OTHER,
+                    )
+            # file_id старой базы забываем до подмены: хуки swap_database
+            # (например, file_id приветствия) заполняют кэш уже из новой
+            media.clear()
+            try:
+                try:
+                    await swap_database(staged.db_path)
+                except BaseException:
+                    await asyncio.to_thread(discard_restore, staged)
+                    raise
+                # база уже из бэкапа - теперь и файлы uploads/ (до того, как
+                # воркеры снова начнут отправлять медиа новой базы)
+                await asyncio.to_thread(apply_restore, staged)
+            finally:
+                if hub is not None:
+                    await hub.resume_workers()
+            await engine.resume()
+            logger.info("Database restored from backup and swapped in")
 
         return RedirectResponse(
             "/admin_web?restore=ok",
             status_code=HTTP_303_SEE_OTHER,
         )
 
+    # ---------- DB PROFILER ----------
+
+    @app.get("/admin_web/profiler", response_class=HTMLResponse)
+    async def profiler_page(request: Request):
+        if (resp := await ensure_admin(request)) is not None:
+            return resp
+        return TEMPLATES.TemplateResponse(
+            "profiler.html",
+            {
+                "request": request,
+                "enabled": profiler.enabled,
+                "slow_ms": profiler.SLOW_QUERY_MS,
+                "started_at": time.strftime("%d.%m %H:%M:%S", time.localtime(profiler.started_at)),
+                "queries": profiler.top_queries(),
+                "waits": profiler.waits(),
+                "slow": [
+                    (time.strftime("%H:%M:%S", time.localtime(q.at)), q)
+                    for q in profiler.slow_queries()
+                ],
+            },
+        )
+
+    @app.post("/admin_web/profiler")
+    async def profiler_action(request: Request, action: str = Form(...)):
+        if (resp := await ensure_admin(request)) is not None:
+            return resp
+        if action == "enable":
+            profiler.set_enabled(True)
+        elif action == "disable":
+            profiler.set_enabled(False)
+        elif action == "reset":
+            profiler.reset()
+        return RedirectResponse("/admin_web/profiler", status_code=HTTP_303_SEE_OTHER)
+
     # ---------- HEALTH ----------
 
     @app.api_route("/health", methods=["GET", "HEAD"])
@@ -429,4 +780,17 @@ def create_app(bot: Bot) -> FastAPI:
     async def healthz():
         return PlainTextResponse("ok")
 
+    # ---------- METRICS ----------
+
+    @app.get("/metrics")
+    async def metrics_endpoint(request: Request):
+        if METRICS_TOKEN:
+            auth = request.headers.get("Authorization", "")
+            if not hmac.compare_digest(auth.encode(), f"Bearer {METRICS_TOKEN}".encode()):
+                return Response(status_code=401)
+        return PlainTextResponse(
+            metrics.render(),
+            media_type="text/plain; version=0.0.4; charset=utf-8",
+        )
+
     return app
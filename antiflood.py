@@ -0,0 +1,102 @@
+"""
+Защита от частых нажатий кнопок.
+
+На вечеринке "⏭️ Следующая песня" жмут по несколько раз в секунду: каждое
+нажатие - запрос к базе, сообщение в Telegram и еще один трек из колоды,
+который никто не успел увидеть.
+
+AntiFloodMiddleware (outer middleware на dp.update, раньше планировщика
+dispatch.py): нажатие проверяется в момент прихода, а не когда до него
+дойдет очередь игрока - иначе окно считалось бы от выхода из очереди и
+повторы, простоявшие в ней, проходили бы как новые нажатия:
+- повтор той же кнопки тем же пользователем быстрее ANTIFLOOD_WINDOW секунд
+  после принятого нажатия схлопывается в него: хендлер не вызывается;
+- на все кнопки пользователя - token bucket: ANTIFLOOD_BURST нажатий подряд,
+  дальше ANTIFLOOD_RATE в секунду;
+- лишние нажатия получают пустой cb.answer() (у кнопки пропадают часики).
+
+Состояние - в памяти процесса, не больше MAX_USERS пользователей (LRU).
+В режиме split с несколькими воркерами у каждого оно свое, так что
+защита там приблизительная.
+"""
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+
+import metrics
+
+ANTIFLOOD_WINDOW = float(os.getenv("ANTIFLOOD_WINDOW", "1.0"))
+ANTIFLOOD_RATE = float(os.getenv("ANTIFLOOD_RATE", "2"))
+ANTIFLOOD_BURST = float(os.getenv("ANTIFLOOD_BURST", "5"))
+MAX_USERS = 10_000
+
+
+class _Bucket:
+    __slots__ = ("tokens", "updated", "last_data", "last_at")
+
+    def __init__(self, tokens: float, now: float) -> None:
+        self.tokens = tokens
+        self.updated = now
+        self.last_data: Optional[str] = None
+        self.last_at = 0.0
+
+
+class AntiFloodMiddleware(BaseMiddleware):
+    def __init__(
+        self,
+        window: float = ANTIFLOOD_WINDOW,
+        rate: float = ANTIFLOOD_RATE,
+        burst: float = ANTIFLOOD_BURST,
+        max_users: int = MAX_USERS,
+    ) -> None:
+        self.window = window
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+        self._buckets: "OrderedDict[int, _Bucket]" = OrderedDict()
+
+    def _bucket(self, user_id: int, now: float) -> _Bucket:
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = _Bucket(self.burst, now)
+            if len(self._buckets) > self.max_users:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(user_id)
+        return bucket
+
+    def check(self, user_id: int, data: Optional[str], now: Optional[float] = None) -> Optional[str]:
+        """None - нажатие принято, иначе причина отказа: duplicate / rate."""
+        if now is None:
+            now = time.monotonic()
+        bucket = self._bucket(user_id, now)
+        if data == bucket.last_data and now - bucket.last_at < self.window:
+            return "duplicate"
+        bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+        bucket.updated = now
+        if bucket.tokens < 1:
+            return "rate"
+        bucket.tokens -= 1
+        bucket.last_data = data
+        bucket.last_at = now
+        return None
+
+    async def __call__(
+        self,
+        handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any],
+    ) -> Any:
+        callback = event.callback_query
+        if callback is None:
+            return await handler(event, data)
+        reason = self.check(callback.from_user.id, callback.data)
+        if reason is None:
+            return await handler(event, data)
+        metrics.ANTIFLOOD_DROPPED.inc(reason)
+        await callback.answer()
+        return None
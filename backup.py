@@ -0,0 +1,485 @@
+"""
+Бэкап и восстановление uploads/.
+
+База снимается через online backup API SQLite (согласованный снимок,
+даже если бот в этот момент пишет), архив собирается в отдельном потоке
+и отдается клиенту кусками, без временного zip на диске и без блокировки
+event loop. Уже сжатые медиа (jpg/mp4/mp3...) кладутся без пережатия.
+
+Каждый архив содержит backup.json - манифест всех файлов uploads/
+с их sha256. Инкрементальный бэкап (since=<id прошлого бэкапа>) везет
+только файлы, содержимого которых не было в прошлом бэкапе, плюс снимок
+базы; восстановление собирает полное состояние из базового архива
+и цепочки инкрементов. Живые файлы при подготовке не трогаются:
+проверенный снимок подменяет базу через db.swap_database(), и только
+потом файлы uploads/ перекладываются на место (apply_restore).
+"""
+import asyncio
+import hashlib
+import io
+import json
+import os
+import queue
+import secrets
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import zipfile
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from db import DB_PATH
+import migrations
+
+UPLOADS_DIR = "uploads"
+MANIFEST_NAME = "backup.json"
+CHUNK_SIZE = 256 * 1024
+# сколько кусков может ждать отправки клиенту (ограничивает память)
+QUEUE_CHUNKS = 8
+
+# форматы, которые zlib уже не сожмет - только зря потратим CPU
+STORED_EXTS = {
+    ".jpg", ".jpeg", ".png", ".gif", ".webp",
+    ".mp4", ".mov", ".mkv", ".webm", ".avi",
+    ".mp3", ".ogg", ".m4a", ".aac", ".opus",
+    ".zip", ".gz", ".rar", ".7z",
+}
+
+# файлы живой базы в архив не копируем: вместо них кладется снимок
+_DB_FILES = {
+    os.path.normpath(DB_PATH + suffix) for suffix in ("", "-wal", "-shm", "-journal")
+}
+_DB_ARCNAME = os.path.relpath(DB_PATH, start=".")
+
+Manifest = Dict[str, Any]
+
+
+class BackupError(Exception):
+    """Архив (или цепочка архивов) не подходит для восстановления."""
+
+
+class _Aborted(Exception):
+    """Клиент отключился - поток сборки архива завершается."""
+
+
+class _QueueWriter(io.RawIOBase):
+    """Несикабельный файл: все записанное уходит кусками в очередь."""
+
+    def __init__(self, chunks: "queue.Queue", stop: threading.Event) -> None:
+        self.chunks = chunks
+        self.stop = stop
+        self.buf = bytearray()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.buf += data
+        if len(self.buf) >= CHUNK_SIZE:
+            self._emit()
+        return len(data)
+
+    def flush(self) -> None:
+        if self.buf:
+            self._emit()
+
+    def _emit(self) -> None:
+        _put_chunk(self.chunks, bytes(self.buf), self.stop)
+        self.buf.clear()
+
+
+def _put_chunk(
+    chunks: "queue.Queue",
+    item: Union[bytes, BaseException, None],
+    stop: threading.Event,
+) -> None:
+    while not stop.is_set():
+        try:
+            chunks.put(item, timeout=0.5)
+            return
+        except queue.Full:
+            continue
+    raise _Aborted()
+
+
+def new_backup_id() -> str:
+    return time.strftime("%Y%m%d-%H%M%S") + "-" + secrets.token_hex(3)
+
+
+def snapshot_database(dst_path: str) -> None:
+    """Согласованная копия живой базы через sqlite3 backup API."""
+    src = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True)
+    dst = sqlite3.connect(dst_path)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+
+
+def compression_for(path: str) -> int:
+    ext = os.path.splitext(path)[1].lower()
+    return zipfile.ZIP_STORED if ext in STORED_EXTS else zipfile.ZIP_DEFLATED
+
+
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _is_safe_member(name: str) -> bool:
+    path = os.path.normpath(name)
+    return not os.path.isabs(path) and path.startswith(UPLOADS_DIR + os.sep)
+
+
+def scan_uploads(base: Optional[Manifest]) -> Dict[str, Dict[str, Any]]:
+    """
+    Файлы uploads/ (кроме базы) с sha256.
+    Если размер и mtime совпадают с прошлым манифестом, хэш не пересчитываем.
+    """
+    known = base["files"] if base else {}
+    files: Dict[str, Dict[str, Any]] = {}
+    for root_dir, _dirs, names in os.walk(UPLOADS_DIR):
+        for name in names:
+            full = os.path.join(root_dir, name)
+            if os.path.normpath(full) in _DB_FILES:
+                continue
+            rel = os.path.relpath(full, start=".")
+            st = os.stat(full)
+            prev = known.get(rel)
+            if prev and prev["size"] == st.st_size and prev["mtime_ns"] == st.st_mtime_ns:
+                sha = prev["sha256"]
+            else:
+                sha = file_sha256(full)
+            files[rel] = {"sha256": sha, "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+    return files
+
+
+def _write_archive(
+    chunks: "queue.Queue",
+    stop: threading.Event,
+    backup_id: str,
+    base: Optional[Manifest],
+    result: Dict[str, Any],
+) -> None:
+    fd, snapshot_path = tempfile.mkstemp(suffix=".sqlite3")
+    os.close(fd)
+    try:
+        has_db = os.path.exists(DB_PATH)
+        if has_db:
+            snapshot_database(snapshot_path)
+
+        files = scan_uploads(base)
+        # содержимое, которое уже есть в цепочке, повторно не везем
+        have = {info["sha256"] for info in base["files"].values()} if base else set()
+        shipped: List[str] = []
+        for rel, info in sorted(files.items()):
+            if info["sha256"] not in have:
+                shipped.append(rel)
+                have.add(info["sha256"])
+
+        manifest: Manifest = {
+            "id": backup_id,
+            "parent": base["id"] if base else None,
+            "kind": "incremental" if base else "full",
+            "created_at": int(time.time()),
+            "db": _DB_ARCNAME if has_db else None,
+            "files": files,
+            "shipped": shipped,
+        }
+
+        out = _QueueWriter(chunks, stop)
+        with zipfile.ZipFile(out, "w", allowZip64=True) as zf:
+            zf.writestr(MANIFEST_NAME, json.dumps(manifest), zipfile.ZIP_DEFLATED)
+            if has_db:
+                zf.write(
+                    snapshot_path,
+                    arcname=_DB_ARCNAME,
+                    compress_type=zipfile.ZIP_DEFLATED,
+                )
+            for rel in shipped:
+                zf.write(rel, arcname=rel, compress_type=compression_for(rel))
+        out.flush()
+        result["manifest"] = manifest
+        _put_chunk(chunks, None, stop)
+    except _Aborted:
+        pass
+    except BaseException as e:
+        try:
+            _put_chunk(chunks, e, stop)
+        except _Aborted:
+            pass
+    finally:
+        try:
+            os.remove(snapshot_path)
+        except OSError:
+            pass
+
+
+async def stream_backup(
+    backup_id: str,
+    base: Optional[Manifest] = None,
+    on_complete: Optional[Callable[[Manifest], Awaitable[None]]] = None,
+) -> AsyncIterator[bytes]:
+    """
+    Zip-архив uploads/ (со снимком базы), отдаваемый кусками.
+    base - манифест прошлого бэкапа для инкрементального режима,
+    on_complete(manifest) вызывается, когда архив целиком отдан клиенту.
+    """
+    os.makedirs(UPLOADS_DIR, exist_ok=True)
+    chunks: "queue.Queue[Optional[bytes]]" = queue.Queue(maxsize=QUEUE_CHUNKS)
+    stop = threading.Event()
+    result: Dict[str, Any] = {}
+    worker = threading.Thread(
+        target=_write_archive,
+        args=(chunks, stop, backup_id, base, result),
+        name="backup-writer",
+        daemon=True,
+    )
+    worker.start()
+    try:
+        while True:
+            item = await asyncio.to_thread(chunks.get)
+            if item is None:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        # клиент мог оборвать загрузку - отпускаем поток сборки
+        # и будим поток, который мог остаться ждать в chunks.get()
+        stop.set()
+        try:
+            chunks.put_nowait(None)
+        except queue.Full:
+            pass
+
+    if on_complete is not None and "manifest" in result:
+        await on_complete(result["manifest"])
+
+
+# ---------- Restore ----------
+
+def read_manifest(zf: zipfile.ZipFile) -> Optional[Manifest]:
+    try:
+        return json.loads(zf.read(MANIFEST_NAME))
+    except KeyError:
+        return None
+
+
+def order_chain(
+    items: List[Tuple[zipfile.ZipFile, Manifest]],
+) -> List[Tuple[zipfile.ZipFile, Manifest]]:
+    """Выстроить архивы в цепочку: полный бэкап, затем инкременты по parent."""
+    by_parent = {m["parent"]: (zf, m) for zf, m in items}
+    if len(by_parent) != len(items):
+        raise BackupError("В цепочке есть архивы с одинаковым родителем")
+    if None not in by_parent:
+        raise BackupError("Нет полного (базового) бэкапа")
+
+    chain = [by_parent[None]]
+    while len(chain) < len(items):
+        nxt = by_parent.get(chain[-1][1]["id"])
+        if nxt is None:
+            raise BackupError(f"Цепочка обрывается после {chain[-1][1]['id']}")
+        chain.append(nxt)
+    return chain
+
+
+def _check_archive(zf: zipfile.ZipFile) -> None:
+    """Проверить CRC всех файлов архива, ничего не распаковывая на диск."""
+    bad = zf.testzip()
+    if bad is not None:
+        raise BackupError(f"Поврежден файл {bad} в архиве")
+
+
+def _check_database(path: str) -> None:
+    """Снимок базы из архива открывается, цел и похож на базу бота."""
+    try:
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            row = conn.execute("PRAGMA integrity_check").fetchone()
+            if row is None or row[0] != "ok":
+                raise BackupError(f"База в архиве повреждена: {row[0] if row else '?'}")
+            tables = {
+                r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+            }
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+        finally:
+            conn.close()
+    except sqlite3.DatabaseError as e:
+        raise BackupError(f"База в архиве не читается: {e}") from e
+    if not {"users", "tracks"} <= tables:
+        raise BackupError("В архиве не база бота")
+    # старые схемы догонят миграции при открытии, новую этот код не знает
+    if version > migrations.SCHEMA_VERSION:
+        raise BackupError(
+            f"База в архиве от более новой версии бота (схема {version}, "
+            f"поддерживается до {migrations.SCHEMA_VERSION})"
+        )
+
+
+def _extract(zf: zipfile.ZipFile, member: str, target: str) -> None:
+    """Распаковать во временный файл рядом и подменить целевой через os.replace."""
+    os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+    tmp = target + ".part"
+    try:
+        with zf.open(member) as src, open(tmp, "wb") as dst:
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        os.replace(tmp, target)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+class StagedRestore:
+    """
+    Проверенный и распакованный бэкап, еще не примененный: снимок базы
+    для db.swap_database() и файлы uploads/ во временной папке рядом.
+    """
+
+    def __init__(self, dest: str, staging_dir: str) -> None:
+        self.dest = dest
+        self.staging_dir = staging_dir
+        # снимок базы (None, если базы в архиве нет)
+        self.db_path: Optional[str] = None
+        # пути относительно dest, подготовленные в staging_dir
+        self.files: List[str] = []
+        # все файлы uploads/ из манифеста; None - старый архив, лишнее не удаляем
+        self.wanted: Optional[set] = None
+
+
+def stage_restore(paths: List[str], dest: str = ".") -> StagedRestore:
+    """
+    Подготовить восстановление uploads/ из одного архива или цепочки
+    base + инкременты (порядок файлов не важен, он берется из манифестов).
+
+    Проверяется все (CRC архивов, полнота цепочки, целостность базы),
+    файлы распаковываются во временную папку рядом с uploads/, а снимок
+    базы - рядом с живой базой. Живые файлы не трогаются: их подменяет
+    apply_restore() после успешного db.swap_database(), при отмене
+    подготовленное убирает discard_restore().
+    Функция блокирующая - вызывать через asyncio.to_thread().
+    """
+    try:
+        archives = [zipfile.ZipFile(p) for p in paths]
+    except zipfile.BadZipFile as e:
+        raise BackupError(f"Не zip-архив: {e}") from e
+    try:
+        for zf in archives:
+            _check_archive(zf)
+
+        # (архив, имя в архиве, путь назначения относительно dest)
+        writes: List[Tuple[zipfile.ZipFile, str, str]] = []
+        wanted: Optional[set] = None
+        db_member: Optional[Tuple[zipfile.ZipFile, str]] = None
+
+        items = [(zf, read_manifest(zf)) for zf in archives]
+        if any(m is None for _zf, m in items):
+            # старые архивы без манифеста: просто распаковываем uploads/
+            if len(items) != 1:
+                raise BackupError("Архивы без backup.json восстанавливаются только по одному")
+            zf = archives[0]
+            for member in zf.infolist():
+                if member.is_dir() or not _is_safe_member(member.filename):
+                    continue
+                if os.path.normpath(member.filename) == os.path.normpath(DB_PATH):
+                    db_member = (zf, member.filename)
+                elif os.path.normpath(member.filename) not in _DB_FILES:
+                    writes.append((zf, member.filename, member.filename))
+        else:
+            chain = order_chain(items)
+            final = chain[-1][1]
+
+            # sha256 -> (архив, имя файла в нем)
+            blobs: Dict[str, Tuple[zipfile.ZipFile, str]] = {}
+            for zf, m in chain:
+                for rel in m["shipped"]:
+                    blobs[m["files"][rel]["sha256"]] = (zf, rel)
+
+            for rel, info in final["files"].items():
+                if not _is_safe_member(rel):
+                    raise BackupError(f"Недопустимый путь в манифесте: {rel}")
+                target = os.path.join(dest, rel)
+                if os.path.exists(target) and file_sha256(target) == info["sha256"]:
+                    continue
+                blob = blobs.get(info["sha256"])
+                if blob is None:
+                    raise BackupError(f"В цепочке нет содержимого для {rel}")
+                writes.append((blob[0], blob[1], rel))
+
+            wanted = {os.path.normpath(rel) for rel in final["files"]}
+            if final["db"]:
+                db_member = (chain[-1][0], final["db"])
+
+        # та же файловая система, что и у uploads/: применение - это os.replace
+        staged = StagedRestore(dest, tempfile.mkdtemp(prefix=".restore-", dir=dest))
+        staged.wanted = wanted
+        try:
+            if db_member is not None:
+                staged.db_path = os.path.join(dest, DB_PATH) + ".restore"
+                _extract(db_member[0], db_member[1], staged.db_path)
+                _check_database(staged.db_path)
+            for zf, member, rel in writes:
+                _extract(zf, member, os.path.join(staged.staging_dir, rel))
+                staged.files.append(rel)
+        except BaseException:
+            discard_restore(staged)
+            raise
+        return staged
+    finally:
+        for zf in archives:
+            zf.close()
+
+
+def apply_restore(staged: StagedRestore) -> None:
+    """
+    Переложить подготовленные файлы в uploads/ и удалить те, которых
+    в бэкапе нет. Вызывать после того, как база уже подменена.
+    Функция блокирующая - вызывать через asyncio.to_thread().
+    """
+    dest = staged.dest
+    try:
+        for rel in staged.files:
+            target = os.path.join(dest, rel)
+            os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+            os.replace(os.path.join(staged.staging_dir, rel), target)
+
+        if staged.wanted is not None:
+            # файлы, удаленные после бэкапа, тоже удаляем
+            for root_dir, _dirs, names in os.walk(os.path.join(dest, UPLOADS_DIR)):
+                for name in names:
+                    full = os.path.join(root_dir, name)
+                    rel = os.path.normpath(os.path.relpath(full, start=dest))
+                    if rel in staged.wanted or rel in _DB_FILES:
+                        continue
+                    os.remove(full)
+    finally:
+        shutil.rmtree(staged.staging_dir, ignore_errors=True)
+
+
+def discard_restore(staged: StagedRestore) -> None:
+    """Отменить подготовленное восстановление: живые файлы не менялись."""
+    if staged.db_path is not None:
+        try:
+            os.remove(staged.db_path)
+        except FileNotFoundError:
+            pass
+    shutil.rmtree(staged.staging_dir, ignore_errors=True)
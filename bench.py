@@ -0,0 +1,449 @@
+"""
+Нагрузочный прогон бота на заглушке Bot API (fake_telegram.py).
+
+Сценарии:
+- game      - N пользователей одновременно жмут /start, go, next, restart;
+              апдейты идут через настоящий router из main.py и db.py;
+- broadcast - рассылка синтетической аудитории (10k...1M пользователей)
+              через BroadcastEngine;
+- all       - оба по очереди.
+
+Заглушка работает в отдельном процессе (ее память и CPU не смешиваются
+с ботом), умеет задерживать ответы (--latency) и отвечать 429 (--rate-limit).
+Каждый прогон идет на чистой базе во временной папке.
+
+Отчет: пропускная способность, p50/p95/p99, ожидание соединений SQLite
+(пул читателей и блокировка писателя), пиковый RSS. Результаты дописываются
+строкой JSON в bench_output.txt вместе с коммитом, с --compare сравниваются
+с прошлым прогоном с теми же параметрами (код выхода 1 при регрессии).
+
+    python bench.py game --users 500 --steps 30 --latency 0.05
+    python bench.py broadcast --audience 100000 --rate 5000
+    python bench.py all --compare
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_OUTPUT = os.path.join(REPO_DIR, "bench_output.txt")
+SEED_BATCH = 50_000
+
+
+# ---------- Stats ----------
+
+def percentile(values: Sequence[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def _hist_snapshot(hist: Any, labels: Tuple[str, ...]) -> Tuple[List[int], float, int]:
+    series = hist.series.get(labels)
+    if series is None:
+        return [0] * (len(hist.buckets) + 1), 0.0, 0
+    return list(series[0]), series[1], series[2]
+
+
+def _hist_delta(hist: Any, labels: Tuple[str, ...], before: Tuple[List[int], float, int]):
+    counts, total, count = _hist_snapshot(hist, labels)
+    return [a - b for a, b in zip(counts, before[0])], total - before[1], count - before[2]
+
+
+def hist_quantile(buckets: Sequence[float], counts: Sequence[int], q: float) -> float:
+    """Оценка квантиля по корзинам гистограммы (как histogram_quantile в Prometheus)."""
+    total = sum(counts)
+    if not total:
+        return 0.0
+    rank = q * total
+    seen = 0
+    lower = 0.0
+    for bound, n in zip(list(buckets) + [buckets[-1]], counts):
+        if seen + n >= rank and n:
+            return lower + (bound - lower) * (rank - seen) / n
+        seen += n
+        lower = bound
+    return buckets[-1]
+
+
+def peak_rss_mb() -> float:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдает килобайты, macOS - байты
+    return rss / 1024 / 1024 if sys.platform == "darwin" else rss / 1024
+
+
+def _ms(seconds: float) -> float:
+    return round(seconds * 1000, 2)
+
+
+class DbWaits:
+    """Ожидание соединений SQLite за время сценария (из metrics.DB_WAIT)."""
+
+    def __init__(self) -> None:
+        import metrics
+
+        self._hist = metrics.DB_WAIT
+        self._before = {kind: _hist_snapshot(self._hist, (kind,)) for kind in ("read", "write")}
+
+    def result(self) -> Dict[str, Any]:
+        out = {}
+        for kind, before in self._before.items():
+            counts, total, count = _hist_delta(self._hist, (kind,), before)
+            out[kind] = {
+                "count": count,
+                "total_ms": _ms(total),
+                "p99_ms": _ms(hist_quantile(self._hist.buckets, counts, 0.99)),
+            }
+        return out
+
+
+# ---------- Fake Bot API ----------
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_fake(args: argparse.Namespace) -> Tuple[subprocess.Popen, str]:
+    port = _free_port()
+    proc = subprocess.Popen(
+        [
+            sys.executable, os.path.join(REPO_DIR, "fake_telegram.py"),
+            "--port", str(port),
+            "--latency", str(args.latency),
+            "--rate-limit", str(args.rate_limit),
+            "--retry-after", str(args.retry_after),
+        ],
+        stdout=subprocess.PIPE,
+        # без kazoo.jpg в рабочей папке aiogram обрывает загрузку фото - это не ошибка прогона
+        stderr=None if args.verbose else subprocess.DEVNULL,
+        text=True,
+    )
+    line = proc.stdout.readline()
+    if not line.startswith("Fake Bot API"):
+        proc.kill()
+        raise RuntimeError("fake_telegram.py не запустился")
+    return proc, f"http://127.0.0.1:{port}"
+
+
+# ---------- Scenarios ----------
+
+async def run_game(args: argparse.Namespace, bot, dp) -> Dict[str, Any]:
+    from aiogram.types import Update
+
+    import metrics
+    from fake_telegram import callback_update, message_update
+
+    latencies: Dict[str, List[float]] = {}
+    errors = 0
+
+    async def press(update: Dict[str, Any], action: str) -> None:
+        nonlocal errors
+        started = time.perf_counter()
+        try:
+            await dp.feed_update(bot, Update.model_validate(update, context={"bot": bot}))
+        except Exception:
+            errors += 1
+        latencies.setdefault(action, []).append(time.perf_counter() - started)
+
+    async def player(user_id: int) -> None:
+        await press(message_update(user_id, "/start"), "start")
+        await press(callback_update(user_id, "go"), "go")
+        for step in range(args.steps):
+            action = "restart" if step % 10 == 9 else "next"
+            await press(callback_update(user_id, action), action)
+            if args.think:
+                await asyncio.sleep(args.think)
+
+    waits = DbWaits()
+    queue_before = _hist_snapshot(metrics.UPDATE_QUEUE_WAIT, ())
+    dropped_before = sum(metrics.ANTIFLOOD_DROPPED.values.values())
+    started = time.perf_counter()
+    await asyncio.gather(*(player(user_id) for user_id in range(1, args.users + 1)))
+    elapsed = time.perf_counter() - started
+    queue_counts, _total, _count = _hist_delta(metrics.UPDATE_QUEUE_WAIT, (), queue_before)
+
+    everything = [t for values in latencies.values() for t in values]
+    return {
+        "updates": len(everything),
+        "errors": errors,
+        "dropped": int(sum(metrics.ANTIFLOOD_DROPPED.values.values()) - dropped_before),
+        "seconds": round(elapsed, 3),
+        "throughput": round(len(everything) / elapsed, 1),
+        "p50_ms": _ms(percentile(everything, 0.50)),
+        "p95_ms": _ms(percentile(everything, 0.95)),
+        "p99_ms": _ms(percentile(everything, 0.99)),
+        "by_action_p95_ms": {
+            action: _ms(percentile(values, 0.95)) for action, values in sorted(latencies.items())
+        },
+        "queue_wait_p95_ms": _ms(
+            hist_quantile(metrics.UPDATE_QUEUE_WAIT.buckets, queue_counts, 0.95)
+        ),
+        "db_wait": waits.result(),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+async def seed_audience(size: int) -> float:
+    import db
+
+    started = time.perf_counter()
+    now = int(time.time())
+    first = 10_000_000
+    for offset in range(0, size, SEED_BATCH):
+        await db.save_users([
+            (first + i, None, now)
+            for i in range(offset, min(size, offset + SEED_BATCH))
+        ])
+    return time.perf_counter() - started
+
+
+async def run_broadcast(args: argparse.Namespace, bot) -> Dict[str, Any]:
+    import db
+    import metrics
+    from broadcaster import BroadcastEngine, BroadcastJob
+
+    seed_seconds = await seed_audience(args.audience)
+    bid = await db.create_broadcast("Нагрузочный прогон рассылки")
+    total = await db.seed_broadcast_deliveries(bid)
+
+    engine = BroadcastEngine(bot, workers=args.workers, rate=args.rate)
+    job = BroadcastJob(id=bid, text="Нагрузочный прогон рассылки",
+                       image_paths=[], video_paths=[], file_paths=[])
+    send_before = _hist_snapshot(metrics.TELEGRAM_LATENCY, ("sendMessage",))
+    throttled_before = metrics.BROADCAST_THROTTLED.values.get((), 0)
+    waits = DbWaits()
+
+    started = time.perf_counter()
+    engine.start(job)
+    while job.status == "running":
+        await asyncio.sleep(0.2)
+    elapsed = time.perf_counter() - started
+
+    counts, _total, _count = _hist_delta(metrics.TELEGRAM_LATENCY, ("sendMessage",), send_before)
+    buckets = metrics.TELEGRAM_LATENCY.buckets
+    return {
+        "audience": total,
+        "seed_seconds": round(seed_seconds, 3),
+        "sent": job.sent,
+        "failed": job.failed,
+        "throttled": int(metrics.BROADCAST_THROTTLED.values.get((), 0) - throttled_before),
+        "seconds": round(elapsed, 3),
+        "throughput": round((job.sent + job.failed) / elapsed, 1),
+        # по корзинам гистограммы метрик: точность - в пределах корзины
+        "p50_ms": _ms(hist_quantile(buckets, counts, 0.50)),
+        "p95_ms": _ms(hist_quantile(buckets, counts, 0.95)),
+        "p99_ms": _ms(hist_quantile(buckets, counts, 0.99)),
+        "db_wait": waits.result(),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+# ---------- Results ----------
+
+def _git_commit() -> Optional[str]:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=REPO_DIR, capture_output=True, text=True, check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.stdout.strip() or None
+
+
+def scenario_params(args: argparse.Namespace, scenario: str) -> Dict[str, Any]:
+    common = {
+        "latency": args.latency,
+        "rate_limit": args.rate_limit,
+        "retry_after": args.retry_after,
+        "tracks": args.tracks,
+    }
+    if scenario == "game":
+        params = {**common, "users": args.users, "steps": args.steps, "think": args.think}
+        if args.antiflood:
+            params["antiflood"] = True
+        return params
+    return {**common, "audience": args.audience, "rate": args.rate, "workers": args.workers}
+
+
+def load_previous(path: str, scenario: str, params: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    if not os.path.exists(path):
+        return None
+    previous = None
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("scenario") == scenario and record.get("params") == params:
+                previous = record
+    return previous
+
+
+def compare(previous: Dict[str, Any], current: Dict[str, Any], tolerance: float) -> bool:
+    """Напечатать разницу с прошлым прогоном. True - если есть регрессия."""
+    old, new = previous["results"], current["results"]
+    regression = False
+    print(f"  vs {previous.get('commit') or '?'} ({previous.get('at')}):")
+    for key, higher_is_better in (("throughput", True), ("p95_ms", False), ("p99_ms", False)):
+        before, after = old.get(key), new.get(key)
+        if not before or after is None:
+            continue
+        change = (after - before) / before
+        worse = -change if higher_is_better else change
+        mark = ""
+        if worse > tolerance:
+            mark = "  <-- REGRESSION"
+            regression = True
+        print(f"    {key:<11} {before:>10} -> {after:<10} {change:+.1%}{mark}")
+    return regression
+
+
+def report(scenario: str, results: Dict[str, Any]) -> None:
+    print(f"[{scenario}]")
+    for key, value in results.items():
+        print(f"  {key:<17} {value}")
+
+
+# ---------- Main ----------
+
+async def run(args: argparse.Namespace, base_url: str) -> List[Tuple[str, Dict[str, Any]]]:
+    # модули бота импортируются уже внутри рабочей папки: база, логи, .env
+    os.environ["TELEGRAM_BOT_TOKEN"] = os.environ.get("BENCH_BOT_TOKEN", "123456:bench")
+    os.environ["TELEGRAM_API_BASE"] = base_url
+    os.environ["WEBHOOK_URL"] = ""
+    if not args.antiflood:
+        # игроки бенча жмут без пауз: антифлуд отбросил бы почти все нажатия
+        os.environ["ANTIFLOOD_WINDOW"] = "0"
+        os.environ["ANTIFLOOD_BURST"] = "1e9"
+
+    import logging
+
+    from aiogram import Bot
+    from aiogram.client.default import DefaultBotProperties
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    from aiogram.enums import ParseMode
+
+    import catalog
+    import db
+    import main as bot_main
+    import metrics
+    import users
+
+    # на каждый апдейт aiogram пишет строку INFO - в прогоне это только шум
+    logging.getLogger("aiogram.event").setLevel(logging.WARNING)
+    logging.getLogger().setLevel(logging.WARNING if not args.verbose else logging.INFO)
+
+    os.makedirs("uploads", exist_ok=True)
+    welcome = os.path.join(REPO_DIR, bot_main.WELCOME_PHOTO)
+    if os.path.exists(welcome):
+        shutil.copy(welcome, bot_main.WELCOME_PHOTO)
+    await db.init_db()
+    await db.import_tracks([
+        (None, f"Трек {i}", 1 + i % 3, None, True) for i in range(args.tracks)
+    ])
+    await catalog.load()
+    await users.load()
+    users.start()
+
+    bot = Bot(
+        token=os.environ["TELEGRAM_BOT_TOKEN"],
+        session=AiohttpSession(api=TelegramAPIServer.from_base(base_url)),
+        default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN),
+    )
+    bot.session.middleware(metrics.TelegramMetricsMiddleware())
+    dp = bot_main._make_dispatcher(bot)
+
+    results = []
+    try:
+        if args.scenario in ("game", "all"):
+            results.append(("game", await run_game(args, bot, dp)))
+        if args.scenario in ("broadcast", "all"):
+            await users.flush()
+            results.append(("broadcast", await run_broadcast(args, bot)))
+    finally:
+        await users.stop()
+        await bot.session.close()
+        await db.close_db()
+    return results
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон бота")
+    parser.add_argument("scenario", choices=["game", "broadcast", "all"])
+    parser.add_argument("--latency", type=float, default=0.02, help="задержка Bot API, сек")
+    parser.add_argument("--rate-limit", type=float, default=0.0,
+                        help="доля send*-запросов с ответом 429, 0..1")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--tracks", type=int, default=500, help="треков в каталоге")
+    parser.add_argument("--users", type=int, default=200, help="одновременных игроков")
+    parser.add_argument("--steps", type=int, default=20, help="нажатий next на игрока")
+    parser.add_argument("--think", type=float, default=0.0, help="пауза между нажатиями, сек")
+    parser.add_argument("--antiflood", action="store_true",
+                        help="не отключать антифлуд (лишние нажатия отбрасываются)")
+    parser.add_argument("--audience", type=int, default=10_000, help="получателей рассылки")
+    parser.add_argument("--rate", type=float, default=2000.0, help="лимит рассылки, сообщений/сек")
+    parser.add_argument("--workers", type=int, default=64, help="воркеров рассылки")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="куда дописывать результаты")
+    parser.add_argument("--compare", action="store_true", help="сравнить с прошлым прогоном")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="допустимое ухудшение при --compare (0.2 = 20%%)")
+    parser.add_argument("--keep", action="store_true", help="не удалять рабочую папку")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output)
+    workdir = tempfile.mkdtemp(prefix="kazoo-bench-")
+    fake, base_url = start_fake(args)
+    cwd = os.getcwd()
+    try:
+        os.chdir(workdir)
+        results = asyncio.run(run(args, base_url))
+    finally:
+        os.chdir(cwd)
+        fake.terminate()
+        fake.wait()
+        if args.keep:
+            print("workdir:", workdir)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    commit = _git_commit()
+    regression = False
+    with open(output, "a", encoding="utf-8") as f:
+        for scenario, scenario_results in results:
+            record = {
+                "scenario": scenario,
+                "commit": commit,
+                "at": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "params": scenario_params(args, scenario),
+                "results": scenario_results,
+            }
+            report(scenario, scenario_results)
+            if args.compare:
+                previous = load_previous(output, scenario, record["params"])
+                if previous is None:
+                    print("  (прошлых прогонов с такими параметрами нет)")
+                elif compare(previous, record, args.tolerance):
+                    regression = True
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    return 1 if regression else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
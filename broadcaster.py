@@ -0,0 +1,480 @@
+"""
+Фоновая рассылка.
+
+Рассылка запускается отдельной asyncio-задачей и раздается пулом воркеров.
+Общий темп ограничен token bucket'ом под лимит Telegram (~30 сообщений/с),
+в один чат сообщения идут не чаще CHAT_INTERVAL. На 429 (retry_after)
+отправка ставится на паузу, а темп снижается и потом плавно восстанавливается.
+Файлы загружаются в Telegram один раз, дальше уходят по file_id (media.py).
+
+Кому рассылка уже ушла, записывается в broadcast_deliveries пачками;
+после рестарта процесса рассылка продолжается с последнего чекпоинта.
+"""
+import asyncio
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+
+import media
+import metrics
+from db import (
+    finish_stranded_broadcasts,
+    get_broadcast,
+    get_broadcast_files,
+    get_delivery_counts,
+    get_pending_deliveries,
+    list_unfinished_broadcasts,
+    mark_broadcast_sent,
+    record_deliveries,
+    set_broadcast_file_id,
+)
+
+logger = logging.getLogger(__name__)
+
+# сообщений в секунду на весь бот (Telegram режет примерно на 30)
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "28"))
+# сколько получателей обрабатываем параллельно
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "32"))
+# минимальный интервал между сообщениями в один чат, сек
+CHAT_INTERVAL = float(os.getenv("BROADCAST_CHAT_INTERVAL", "1.0"))
+# сколько раз повторяем отправку после 429 / сетевой ошибки
+MAX_RETRIES = 3
+# журнал доставки пишем пачками: по размеру или по таймеру, что раньше
+FLUSH_BATCH = 500
+FLUSH_INTERVAL = 1.0
+FEED_PAGE_SIZE = 1000
+# окно для подсчета текущей скорости рассылки, сек
+RATE_WINDOW = 10.0
+
+AUDIO_EXTS = {".mp3", ".ogg", ".wav", ".m4a"}
+
+
+def file_method(kind: str, path: str) -> str:
+    """Каким методом Bot API отправляется файл рассылки данного вида."""
+    if kind in ("photo", "video"):
+        return kind
+    if os.path.splitext(path)[1].lower() in AUDIO_EXTS:
+        return "audio"
+    return "document"
+
+
+class TokenBucket:
+    """Глобальный лимит сообщений в секунду, подстраивается под 429."""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None) -> None:
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, tokens: float = 1.0) -> None:
+        tokens = min(tokens, self.capacity)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(
+                    self.capacity,
+                    self.tokens + (now - self.updated) * self.rate,
+                )
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+    def throttle(self, retry_after: float) -> None:
+        """Telegram ответил 429: ждем retry_after и вдвое снижаем темп."""
+        now = time.monotonic()
+        self.paused_until = max(self.paused_until, now + retry_after)
+        self.rate = max(1.0, self.rate / 2)
+        self.tokens = 0.0
+        self.updated = now
+
+    def recover(self) -> None:
+        """Успешная отправка: понемногу возвращаем темп к максимальному."""
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 100)
+
+
+class _ChatPacer:
+    """Не чаще одного сообщения в CHAT_INTERVAL для одного чата."""
+
+    def __init__(self) -> None:
+        self.next_at = 0.0
+
+    async def wait(self) -> None:
+        delay = self.next_at - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def sent(self, messages: int = 1) -> None:
+        self.next_at = time.monotonic() + CHAT_INTERVAL * messages
+
+
+@dataclass
+class BroadcastJob:
+    id: int
+    text: str
+    image_paths: List[str]
+    video_paths: List[str]
+    file_paths: List[str]
+    total: int = 0
+    sent: int = 0
+    failed: int = 0
+    status: str = "running"  # running / done / cancelled / failed
+    started_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+    # результаты, еще не записанные в broadcast_deliveries: (user_id, status, error)
+    pending_results: List[Tuple[int, str, Optional[str]]] = field(default_factory=list)
+    # моменты последних доставок - для текущей скорости
+    recent: Deque[float] = field(default_factory=deque)
+
+    def record(self, user_id: int, error: Optional[str]) -> None:
+        if error is None:
+            self.sent += 1
+            self.pending_results.append((user_id, "sent", None))
+            metrics.BROADCAST_MESSAGES.inc("sent")
+        else:
+            self.failed += 1
+            self.pending_results.append((user_id, "failed", error))
+            metrics.BROADCAST_MESSAGES.inc("failed")
+            metrics.BROADCAST_FAILURES.inc(error)
+        now = time.monotonic()
+        self.recent.append(now)
+        while self.recent and self.recent[0] < now - RATE_WINDOW:
+            self.recent.popleft()
+        metrics.BROADCAST_RATE.set(value=len(self.recent) / RATE_WINDOW)
+
+    def rate(self) -> float:
+        """Получателей в секунду за последние RATE_WINDOW секунд."""
+        now = time.monotonic()
+        while self.recent and self.recent[0] < now - RATE_WINDOW:
+            self.recent.popleft()
+        return len(self.recent) / RATE_WINDOW
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "status": self.status,
+            "total": self.total,
+            "sent": self.sent,
+            "failed": self.failed,
+            "remaining": self.total - self.sent - self.failed,
+            "rate": round(self.rate(), 2),
+            "started_at": int(self.started_at),
+            "finished_at": int(self.finished_at) if self.finished_at else None,
+        }
+
+
+class BroadcastEngine:
+    def __init__(
+        self,
+        bot: Bot,
+        workers: int = BROADCAST_WORKERS,
+        rate: float = BROADCAST_RATE,
+    ) -> None:
+        self.bot = bot
+        self.workers = max(1, workers)
+        self.bucket = TokenBucket(rate)
+        self.jobs: Dict[int, BroadcastJob] = {}
+        self._tasks: Dict[int, asyncio.Task] = {}
+
+    def start(self, job: BroadcastJob) -> int:
+        """
+        Запустить рассылку в фоне и сразу вернуть ее id.
+        Получатели берутся из broadcast_deliveries (статус pending).
+        """
+        self.jobs[job.id] = job
+        task = asyncio.create_task(self._run(job))
+        self._tasks[job.id] = task
+        task.add_done_callback(lambda _t: self._tasks.pop(job.id, None))
+        return job.id
+
+    async def start_saved(self, broadcast_id: int) -> bool:
+        """
+        Запустить рассылку, уже сохраненную в базе (текст, файлы, журнал доставки).
+        False - если такой рассылки нет.
+        """
+        if self.is_running(broadcast_id):
+            return True
+        row = await get_broadcast(broadcast_id)
+        if row is None:
+            return False
+        paths: Dict[str, List[str]] = {"photo": [], "video": [], "file": []}
+        for _id, kind, path, _created_at, _file_id in await get_broadcast_files(broadcast_id):
+            paths.setdefault(kind, []).append(path)
+        self.start(BroadcastJob(
+            id=broadcast_id,
+            text=row[1],
+            image_paths=paths["photo"],
+            video_paths=paths["video"],
+            file_paths=paths["file"],
+        ))
+        return True
+
+    async def resume(self) -> None:
+        """Продолжить рассылки, прерванные рестартом процесса."""
+        for broadcast_id in await finish_stranded_broadcasts():
+            logger.info("Broadcast #%s had no pending deliveries left, marked as sent", broadcast_id)
+        for broadcast_id in await list_unfinished_broadcasts():
+            if self.is_running(broadcast_id):
+                continue
+            logger.info("Resuming broadcast #%s", broadcast_id)
+            await self.start_saved(broadcast_id)
+
+    def get(self, job_id: int) -> Optional[BroadcastJob]:
+        return self.jobs.get(job_id)
+
+    def is_running(self, job_id: int) -> bool:
+        return job_id in self._tasks
+
+    async def cancel(self, job_id: int) -> None:
+        task = self._tasks.get(job_id)
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    async def stop(self) -> None:
+        """Остановка процесса: прервать рассылки, сохранив журнал доставки."""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self, job: BroadcastJob) -> None:
+        for _id, kind, path, _created_at, file_id in await get_broadcast_files(job.id):
+            if file_id:
+                media.remember(file_method(kind, path), path, file_id)
+
+        # после рестарта продолжаем счетчики с того места, где остановились
+        counts = await get_delivery_counts(job.id)
+        job.total = sum(counts.values())
+        job.sent = counts.get("sent", 0)
+        job.failed = counts.get("failed", 0)
+
+        queue: "asyncio.Queue[Optional[int]]" = asyncio.Queue(maxsize=self.workers * 4)
+        feeder = asyncio.create_task(self._feed(job, queue))
+        flusher = asyncio.create_task(self._flush_loop(job))
+        workers = [
+            asyncio.create_task(self._worker(job, queue))
+            for _ in range(self.workers)
+        ]
+        try:
+            await asyncio.gather(feeder, *workers)
+        except asyncio.CancelledError:
+            for t in (feeder, *workers):
+                t.cancel()
+            job.status = "cancelled"
+            raise
+        except Exception:
+            # без этого остальные задачи продолжили бы работать, а статус
+            # навсегда остался бы running
+            for t in (feeder, *workers):
+                t.cancel()
+            await asyncio.gather(feeder, *workers, return_exceptions=True)
+            job.status = "failed"
+            logger.exception("Broadcast #%s failed", job.id)
+            return
+        finally:
+            job.finished_at = time.time()
+            metrics.BROADCAST_RATE.set(value=0)
+            flusher.cancel()
+            await asyncio.gather(flusher, return_exceptions=True)
+            # последний чекпоинт: то, что успели отправить, больше не повторится
+            await self._flush(job)
+
+        job.status = "done"
+        await mark_broadcast_sent(job.id)
+        logger.info(
+            "Broadcast #%s finished: sent=%s failed=%s in %.1fs",
+            job.id, job.sent, job.failed, job.finished_at - job.started_at,
+        )
+
+    async def _feed(self, job: BroadcastJob, queue: "asyncio.Queue[Optional[int]]") -> None:
+        """Подавать получателей страницами из журнала доставки."""
+        after = 0
+        while True:
+            page = await get_pending_deliveries(job.id, after, FEED_PAGE_SIZE)
+            if not page:
+                break
+            for uid in page:
+                await queue.put(uid)
+            after = page[-1]
+        for _ in range(self.workers):
+            await queue.put(None)
+
+    async def _flush(self, job: BroadcastJob) -> None:
+        if not job.pending_results:
+            return
+        batch, job.pending_results = job.pending_results, []
+        await record_deliveries(job.id, batch)
+
+    async def _flush_loop(self, job: BroadcastJob) -> None:
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            try:
+                await self._flush(job)
+            except Exception:
+                logger.exception("Broadcast #%s: failed to write delivery ledger", job.id)
+
+    async def _worker(self, job: BroadcastJob, queue: "asyncio.Queue[Optional[int]]") -> None:
+        while True:
+            uid = await queue.get()
+            if uid is None:
+                return
+            try:
+                error = await self._deliver(job, uid)
+            except Exception as e:
+                logger.exception("Broadcast #%s: unexpected error for %s", job.id, uid)
+                error = type(e).__name__
+            job.record(uid, error)
+            if len(job.pending_results) >= FLUSH_BATCH:
+                await self._flush(job)
+
+    async def _send(
+        self,
+        pacer: _ChatPacer,
+        make: Callable[[], Awaitable[Any]],
+        messages: int = 1,
+    ) -> Any:
+        """Отправить с учетом лимитов; 429 и сетевые ошибки повторяем."""
+        for attempt in range(MAX_RETRIES + 1):
+            await self.bucket.acquire(messages)
+            await pacer.wait()
+            try:
+                result = await make()
+            except TelegramRetryAfter as e:
+                metrics.BROADCAST_THROTTLED.inc()
+                self.bucket.throttle(e.retry_after)
+                if attempt == MAX_RETRIES:
+                    raise
+            except (TelegramNetworkError, TelegramServerError):
+                if attempt == MAX_RETRIES:
+                    raise
+                await asyncio.sleep(2 ** attempt)
+            else:
+                pacer.sent(messages)
+                self.bucket.recover()
+                return result
+
+    async def _deliver(self, job: BroadcastJob, uid: int) -> Optional[str]:
+        """
+        Отправить рассылку одному пользователю.
+        Возвращает None, если все дошло, иначе класс первой ошибки.
+        """
+        bot = self.bot
+        pacer = _ChatPacer()
+        full_text = job.text
+        error: Optional[str] = None
+        caption_used = False  # уже прикрепляли текст как caption?
+
+        # 1) Картинки: текст в подписи к первой
+        try:
+            if job.image_paths:
+                if len(job.image_paths) == 1:
+                    await self._send(pacer, lambda: media.send_file(
+                        "photo",
+                        job.image_paths[0],
+                        lambda f: bot.send_photo(uid, f, caption=full_text or None),
+                        save=set_broadcast_file_id,
+                    ))
+                    if full_text:
+                        caption_used = True
+                else:
+                    captions = [
+                        full_text if i == 0 and full_text else None
+                        for i in range(len(job.image_paths))
+                    ]
+                    if full_text:
+                        caption_used = True
+                    await self._send(
+                        pacer,
+                        lambda: media.send_photo_group(
+                            job.image_paths,
+                            captions,
+                            lambda group: bot.send_media_group(uid, group),
+                            save=set_broadcast_file_id,
+                        ),
+                        messages=len(job.image_paths),
+                    )
+        except Exception as e:
+            logger.warning("Broadcast #%s: photo/text error for %s: %s", job.id, uid, e)
+            error = error or type(e).__name__
+
+        # 2) Видео: если нет картинок, текст идет как подпись к первому видео
+        for i, p in enumerate(job.video_paths):
+            cap = None
+            if full_text and not caption_used and i == 0:
+                cap = full_text
+                caption_used = True
+            try:
+                await self._send(pacer, lambda: media.send_file(
+                    "video",
+                    p,
+                    lambda f: bot.send_video(uid, f, caption=cap),
+                    save=set_broadcast_file_id,
+                ))
+            except Exception as e:
+                # fallback: пробуем как документ (вдруг слишком большой/нестандартный контейнер)
+                logger.warning(
+                    "Broadcast #%s: video error for %s, fallback to document: %s",
+                    job.id, uid, e,
+                )
+                try:
+                    await self._send(pacer, lambda: media.send_file(
+                        "document",
+                        p,
+                        lambda f: bot.send_document(uid, f, caption=cap),
+                    ))
+                except Exception as e2:
+                    logger.warning(
+                        "Broadcast #%s: video-document error for %s: %s", job.id, uid, e2
+                    )
+                    error = error or type(e2).__name__
+
+        # 3) Файлы (аудио/доки): если нет ни картинок, ни видео, текст в подписи к первому
+        for i, p in enumerate(job.file_paths):
+            cap = None
+            if full_text and not caption_used and i == 0:
+                cap = full_text
+                caption_used = True
+
+            method = file_method("file", p)
+            send = bot.send_audio if method == "audio" else bot.send_document
+            try:
+                await self._send(pacer, lambda: media.send_file(
+                    method,
+                    p,
+                    lambda f: send(uid, f, caption=cap),
+                    save=set_broadcast_file_id,
+                ))
+            except Exception as e:
+                logger.warning("Broadcast #%s: file error for %s: %s", job.id, uid, e)
+                error = error or type(e).__name__
+
+        # 4) Если медиа не было вообще - отправляем просто текст
+        has_media = job.image_paths or job.video_paths or job.file_paths
+        if not caption_used and not has_media and full_text:
+            try:
+                await self._send(pacer, lambda: bot.send_message(uid, full_text))
+            except Exception as e:
+                logger.warning("Broadcast #%s: text-only error for %s: %s", job.id, uid, e)
+                error = error or type(e).__name__
+
+        return error
@@ -0,0 +1,75 @@
+"""
+In-memory каталог активных треков.
+
+Держим активные треки в компактных массивах, чтобы по track_id из колоды
+(decks.py) получать карточку без запроса в SQLite.
+Каталог перечитывается, только когда меняется db.tracks_version()
+(создание / редактирование / удаление трека, восстановление бэкапа).
+"""
+import asyncio
+from array import array
+from typing import Callable, Dict, List, Optional, Tuple
+
+import db
+
+Track = Tuple[int, str, int, Optional[str]]  # id, title, points, hint
+
+
+class TrackCatalog:
+    """Активные треки в виде параллельных массивов."""
+
+    def __init__(self) -> None:
+        self.version = -1
+        self.ids = array("q")
+        self.points = array("q")
+        self.titles: List[str] = []
+        self.hints: List[Optional[str]] = []
+        self.index: Dict[int, int] = {}  # track_id -> позиция в массивах
+        # track_id -> готовый текст карточки, сбрасывается вместе с версией
+        self.cards: Dict[int, str] = {}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def fill(self, rows: List[Tuple], version: int) -> None:
+        self.ids = array("q", (r[0] for r in rows))
+        self.titles = [r[1] for r in rows]
+        self.points = array("q", (r[2] for r in rows))
+        self.hints = [r[3] for r in rows]
+        self.index = {track_id: i for i, track_id in enumerate(self.ids)}
+        self.cards = {}
+        self.version = version
+
+    def get(self, track_id: int) -> Optional[Track]:
+        i = self.index.get(track_id)
+        if i is None:
+            return None
+        return self.ids[i], self.titles[i], self.points[i], self.hints[i]
+
+    def card(self, track: Track, render: Callable[[Track], str]) -> str:
+        """Текст карточки трека: render() вызывается один раз на трек и версию каталога."""
+        text = self.cards.get(track[0])
+        if text is None:
+            text = render(track)
+            # трек могли изменить, пока его выдавали: кэшируем только актуальный
+            if self.get(track[0]) == track:
+                self.cards[track[0]] = text
+        return text
+
+
+_catalog = TrackCatalog()
+_load_lock = asyncio.Lock()
+
+
+async def load() -> TrackCatalog:
+    """Перечитать каталог, если версия в базе изменилась."""
+    if _catalog.version == db.tracks_version():
+        return _catalog
+    async with _load_lock:
+        version = db.tracks_version()
+        if _catalog.version != version:
+            # версию запоминаем до чтения: если трек поменяют во время загрузки,
+            # версия уйдет вперед и каталог перечитается на следующем запросе
+            rows = await db.load_active_tracks()
+            _catalog.fill(rows, version)
+    return _catalog
@@ -1,79 +1,473 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
 import time
-from typing import List, Optional, Tuple
+import zlib
+from array import array
+from contextlib import asynccontextmanager
+from typing import (
+    AbstractSet,
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
 import aiosqlite
 
+import metrics
+import migrations
+import profiler
+
 DB_PATH = "uploads/db.sqlite3"
 
+logger = logging.getLogger(__name__)
+
+# сколько read-only соединений держим открытыми (бот + админка читают параллельно)
+READER_POOL_SIZE = max(1, int(os.getenv("DB_READERS", "4")))
+# сколько ждать освобождения блокировки, прежде чем получить "database is locked"
+BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+
+# где хранить показанные треки:
+#   rows   - строка (user_id, track_id) на каждый показ (used_tracks);
+#   bitmap - один сжатый битовый массив на пользователя (used_bitmaps).
+# При смене режима данные переносятся в init_db().
+USED_TRACKS_STORAGE = os.getenv("USED_TRACKS_STORAGE", "rows").strip().lower()
+if USED_TRACKS_STORAGE not in ("rows", "bitmap"):
+    raise RuntimeError("USED_TRACKS_STORAGE должен быть rows или bitmap")
+
+# схема базы и ее версии - в migrations.py
+
+
+# ---------- Connections ----------
+#
+# Одно долгоживущее соединение на запись + небольшой пул read-only соединений.
+# Открываются один раз в init_db() и закрываются в close_db(), поэтому
+# обработчики бота и админки не платят за connect и запуск потока aiosqlite.
+# В режиме WAL читатели не блокируют писателя и наоборот.
+
+_writer: Optional[aiosqlite.Connection] = None
+_write_lock = asyncio.Lock()
+_readers: Optional["asyncio.Queue[aiosqlite.Connection]"] = None
+_reader_conns: List[aiosqlite.Connection] = []
+
+# вызываются после swap_database(): сбросить состояние, прочитанное из старой базы
+_swap_hooks: List[Callable[[], Awaitable[None]]] = []
+
+# версия каталога треков: растет при любом изменении tracks и после restore,
+# по ней in-memory кэши (catalog.py) понимают, что пора перечитать данные
+_tracks_version = 0
+
+
+async def _open_connection(readonly: bool) -> aiosqlite.Connection:
+    if readonly:
+        conn = await aiosqlite.connect(f"file:{DB_PATH}?mode=ro", uri=True)
+    else:
+        conn = await aiosqlite.connect(DB_PATH)
+    await conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    if readonly:
+        await conn.execute("PRAGMA query_only = ON")
+    else:
+        # действует только для новой базы (до первой таблицы): свободные
+        # страницы возвращает housekeeping.py через incremental_vacuum
+        await conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        await conn.execute("PRAGMA journal_mode = WAL")
+        # в WAL режиме NORMAL не теряет целостность, но fsync только на checkpoint
+        await conn.execute("PRAGMA synchronous = NORMAL")
+        await conn.execute("PRAGMA foreign_keys = ON")
+    return conn
+
+
+async def _open_all() -> None:
+    global _writer, _readers, _reader_conns, _tracks_version
+
+    _writer = await _open_connection(readonly=False)
+    # схема - в migrations.py; если версия уже последняя, ничего не делается
+    await migrations.migrate(_writer)
+
+    cur = await _writer.execute(
+        "SELECT value FROM meta WHERE key = 'tracks_version'"
+    )
+    row = await cur.fetchone()
+    _tracks_version = max(_tracks_version, row[0] if row else 0)
+
+    await _migrate_used_storage(_writer)
+    await _writer.commit()
+
+    _reader_conns = [
+        await _open_connection(readonly=True) for _ in range(READER_POOL_SIZE)
+    ]
+    # при подмене базы очередь остается той же: ее уже ждут запросы
+    if _readers is None:
+        _readers = asyncio.Queue()
+    for conn in _reader_conns:
+        _readers.put_nowait(conn)
+
+
+async def _close_all() -> None:
+    global _writer, _readers, _reader_conns
 
-CREATE_SQL = """
-PRAGMA foreign_keys = ON;
-
-CREATE TABLE IF NOT EXISTS users (
-    user_id   INTEGER PRIMARY KEY,
-    username  TEXT,
-    joined_at INTEGER NOT NULL
-);
-
-CREATE TABLE IF NOT EXISTS tracks (
-    id         INTEGER PRIMARY KEY AUTOINCREMENT,
-    title      TEXT NOT NULL,
-    points     INTEGER NOT NULL DEFAULT 1,
-    hint       TEXT,
-    is_active  INTEGER NOT NULL DEFAULT 1,
-    created_at INTEGER NOT NULL
-);
-
--- какие треки уже показывались конкретному пользователю
-CREATE TABLE IF NOT EXISTS used_tracks (
-    user_id  INTEGER NOT NULL,
-    track_id INTEGER NOT NULL,
-    PRIMARY KEY (user_id, track_id)
-);
-
-CREATE TABLE IF NOT EXISTS broadcasts (
-    id         INTEGER PRIMARY KEY AUTOINCREMENT,
-    text       TEXT NOT NULL,
-    created_at INTEGER NOT NULL,
-    sent_at    INTEGER
-);
-
-CREATE TABLE IF NOT EXISTS broadcast_files (
-    id           INTEGER PRIMARY KEY AUTOINCREMENT,
-    broadcast_id INTEGER NOT NULL,
-    kind         TEXT NOT NULL, -- photo / video / file
-    path         TEXT NOT NULL,
-    created_at   INTEGER NOT NULL,
-    FOREIGN KEY (broadcast_id) REFERENCES broadcasts(id) ON DELETE CASCADE
-);
-"""
+    for conn in _reader_conns:
+        await conn.close()
+    _reader_conns = []
+    _readers = None
+
+    if _writer is not None:
+        await _writer.close()
+        _writer = None
+
+
+@asynccontextmanager
+async def _write() -> AsyncIterator[aiosqlite.Connection]:
+    """Транзакция на запись: коммит при выходе, откат при исключении."""
+    if _writer is None:
+        raise RuntimeError("База не инициализирована, вызовите init_db()")
+    waited = time.perf_counter()
+    async with _write_lock:
+        waited = time.perf_counter() - waited
+        metrics.DB_WAIT.observe(waited, "write")
+        if profiler.enabled:
+            profiler.record_wait("write", waited)
+        db = profiler.wrap(_writer)
+        try:
+            yield db
+            await db.commit()
+        except BaseException:
+            await db.rollback()
+            raise
+
+
+@asynccontextmanager
+async def _read() -> AsyncIterator[aiosqlite.Connection]:
+    """Взять read-only соединение из пула на время запроса."""
+    if _readers is None:
+        raise RuntimeError("База не инициализирована, вызовите init_db()")
+    waited = time.perf_counter()
+    conn = await _readers.get()
+    waited = time.perf_counter() - waited
+    metrics.DB_WAIT.observe(waited, "read")
+    if profiler.enabled:
+        profiler.record_wait("read", waited)
+    try:
+        yield profiler.wrap(conn)
+    finally:
+        _readers.put_nowait(conn)
 
 
 async def init_db() -> None:
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.executescript(CREATE_SQL)
-        await db.commit()
+    global _group_queue, _group_task
+    if _writer is not None:
+        return
+    await _open_all()
+    _group_queue = asyncio.Queue()
+    _group_task = asyncio.create_task(_group_commit_loop())
 
 
-# ---------- Users ----------
+async def close_db() -> None:
+    """Закрыть все соединения (при остановке процесса)."""
+    global _group_queue, _group_task
+    if _group_task is not None:
+        # дописываем то, что уже стоит в очереди group commit
+        while _group_queue is not None and not _group_queue.empty():
+            await _run_group_batch(_take_group_batch([]))
+        _group_task.cancel()
+        await asyncio.gather(_group_task, return_exceptions=True)
+        _group_task = None
+        _group_queue = None
+    async with _write_lock:
+        await _close_all()
 
-async def add_user(user_id: int, username: Optional[str]) -> None:
-    now = int(time.time())
-    async with aiosqlite.connect(DB_PATH) as db:
+
+# ---------- Group commit ----------
+#
+# Мелкие частые записи прогресса (выдача карты, отметка трека) не коммитятся
+# по одной: они встают в очередь, а одна фоновая задача выполняет все,
+# что накопилось, в одной транзакции. Каждая операция идет в своем SAVEPOINT,
+# так что ошибка одной не откатывает остальные. Чем больше нагрузка,
+# тем больше пачка - число коммитов в секунду перестает быть потолком.
+
+GroupOp = Callable[[aiosqlite.Connection], Awaitable[Any]]
+
+# операций в одной транзакции (ограничивает и задержку последней в пачке)
+GROUP_COMMIT_MAX_BATCH = max(1, int(os.getenv("GROUP_COMMIT_MAX_BATCH", "256")))
+# сколько подождать попутчиков после первой операции; 0 - не ждать
+GROUP_COMMIT_WINDOW = float(os.getenv("GROUP_COMMIT_WINDOW_MS", "0")) / 1000
+
+# (операция, future для результата, ждать ли коммита)
+_group_queue: Optional["asyncio.Queue[Tuple[GroupOp, asyncio.Future, bool]]"] = None
+_group_task: Optional["asyncio.Task[None]"] = None
+
+
+async def _group_submit(op: GroupOp, durable: bool = True) -> Any:
+    """
+    Выполнить op(db) в ближайшей групповой транзакции.
+    durable=True - результат возвращается после коммита,
+    False - сразу после выполнения (коммит догонит, но при сбое запись пропадет).
+    """
+    if _group_queue is None:
+        raise RuntimeError("База не инициализирована, вызовите init_db()")
+    queued = time.perf_counter()
+
+    async def run(db: aiosqlite.Connection) -> Any:
+        # ожидание писателя здесь - очередь, блокировка и операции перед этой в пачке
+        waited = time.perf_counter() - queued
+        metrics.DB_WAIT.observe(waited, "write")
+        if profiler.enabled:
+            profiler.record_wait("write", waited)
+        return await op(db)
+
+    if profiler.enabled:
+        run = profiler.bind(run)
+    fut = asyncio.get_running_loop().create_future()
+    _group_queue.put_nowait((run, fut, durable))
+    return await fut
+
+
+def _take_group_batch(
+    batch: List[Tuple[GroupOp, asyncio.Future, bool]],
+) -> List[Tuple[GroupOp, asyncio.Future, bool]]:
+    while len(batch) < GROUP_COMMIT_MAX_BATCH and not _group_queue.empty():
+        batch.append(_group_queue.get_nowait())
+    return batch
+
+
+async def _run_group_batch(batch: List[Tuple[GroupOp, asyncio.Future, bool]]) -> None:
+    committed: List[Tuple[asyncio.Future, Any]] = []
+    async with _write_lock:
+        db = profiler.wrap(_writer)
+        try:
+            # без внешней транзакции RELEASE самого внешнего SAVEPOINT -
+            # это COMMIT, и каждая операция коммитилась бы отдельно
+            await db.execute("BEGIN IMMEDIATE")
+            for op, fut, durable in batch:
+                if fut.done():  # вызывающий уже не ждет (отмена)
+                    continue
+                await db.execute("SAVEPOINT group_op")
+                try:
+                    result = await op(db)
+                except Exception as e:
+                    await db.execute("ROLLBACK TO group_op")
+                    await db.execute("RELEASE group_op")
+                    fut.set_exception(e)
+                    continue
+                await db.execute("RELEASE group_op")
+                if durable:
+                    committed.append((fut, result))
+                elif not fut.done():
+                    fut.set_result(result)
+            await db.commit()
+        except BaseException as e:
+            try:
+                await db.rollback()
+            finally:
+                err = e if isinstance(e, Exception) else RuntimeError("group commit прерван")
+                for fut, _result in committed:
+                    if not fut.done():
+                        fut.set_exception(err)
+                for _op, fut, _durable in batch:
+                    if not fut.done():
+                        fut.set_exception(err)
+            raise
+
+    for fut, result in committed:
+        if not fut.done():
+            fut.set_result(result)
+
+
+async def _group_commit_loop() -> None:
+    while True:
+        first = await _group_queue.get()
+        if GROUP_COMMIT_WINDOW:
+            await asyncio.sleep(GROUP_COMMIT_WINDOW)
+        batch = _take_group_batch([first])
+        try:
+            await _run_group_batch(batch)
+        except Exception:
+            logger.exception("Group commit of %s operations failed", len(batch))
+
+
+def on_database_swap(hook: Callable[[], Awaitable[None]]) -> None:
+    _swap_hooks.append(hook)
+
+
+async def suspend_database() -> None:
+    """
+    Закрыть все соединения с базой до resume_database(): текущие запросы
+    доигрывают, новые ждут. Нужно, чтобы файл базы подменил другой процесс
+    (restore в режиме split, см. ipc.py).
+    """
+    global _writer, _reader_conns
+    if _writer is None or _readers is None:
+        raise RuntimeError("База не инициализирована, вызовите init_db()")
+
+    await _write_lock.acquire()
+    try:
+        # забираем из пула все read-соединения: текущие чтения доигрывают,
+        # новые встают в очередь и получат уже соединения с новой базой
+        for _ in _reader_conns:
+            await _readers.get()
+        for conn in _reader_conns:
+            await conn.close()
+        _reader_conns = []
+        await _writer.close()
+        _writer = None
+    except BaseException:
+        _write_lock.release()
+        raise
+
+
+async def resume_database(bump: bool = True) -> None:
+    """
+    Открыть базу после suspend_database() (файл мог смениться).
+    bump=False - версию каталога уже поднял процесс, подменивший файл.
+    """
+    try:
+        await _open_all()
+        if bump:
+            # версия только растет: кэши каталога перечитаются
+            await _bump_tracks_version(_writer)
+            await _writer.commit()
+    finally:
+        _write_lock.release()
+
+    for hook in _swap_hooks:
+        await hook()
+
+
+@metrics.timed
+async def swap_database(new_path: str) -> None:
+    """
+    Атомарно подменить файл базы (восстановление бэкапа) без остановки процесса.
+    new_path должен лежать на той же файловой системе, что и DB_PATH.
+    Новые запросы на время подмены ждут, а не падают с ошибкой.
+    """
+    await suspend_database()
+    try:
+        # WAL старой базы к новому файлу не относится
+        for suffix in ("-wal", "-shm", "-journal"):
+            try:
+                os.remove(DB_PATH + suffix)
+            except FileNotFoundError:
+                pass
+        os.replace(new_path, DB_PATH)
+    finally:
+        await resume_database()
+
+
+# ---------- Catalog version ----------
+
+def tracks_version() -> int:
+    return _tracks_version
+
+
+async def _bump_tracks_version(db: aiosqlite.Connection) -> None:
+    """
+    Увеличить версию каталога внутри текущей транзакции записи.
+    Берем максимум с версией в памяти, чтобы после restore старой базы
+    версия не "откатилась" назад и кэши точно перечитались.
+    """
+    global _tracks_version
+    cur = await db.execute(
+        """
+        INSERT INTO meta (key, value) VALUES ('tracks_version', ?)
+        ON CONFLICT(key) DO UPDATE SET value = MAX(value, excluded.value - 1) + 1
+        RETURNING value
+        """,
+        (_tracks_version + 1,),
+    )
+    row = await cur.fetchone()
+    _tracks_version = row[0]
+
+
+@metrics.timed
+async def refresh_tracks_version() -> None:
+    """
+    Версию поднял другой процесс (админка в режиме split) - перечитать ее.
+    Версии в памяти всех процессов совпадают с базой: иначе колоды,
+    собранные разными воркерами, считались бы устаревшими друг для друга.
+    """
+    global _tracks_version
+    async with _read() as db:
+        cur = await db.execute("SELECT value FROM meta WHERE key = 'tracks_version'")
+        row = await cur.fetchone()
+    if row:
+        _tracks_version = max(_tracks_version, row[0])
+
+
+@metrics.timed
+async def bump_tracks_version() -> None:
+    """Сбросить кэши каталога (например, после восстановления бэкапа)."""
+    async with _write() as db:
+        await _bump_tracks_version(db)
+
+
+# ---------- Meta ----------
+
+@metrics.timed
+async def get_meta(key: str) -> Optional[object]:
+    async with _read() as db:
+        cur = await db.execute("SELECT value FROM meta WHERE key = ?", (key,))
+        row = await cur.fetchone()
+    return row[0] if row else None
+
+
+@metrics.timed
+async def set_meta(key: str, value: object) -> None:
+    async with _write() as db:
         await db.execute(
+            "INSERT INTO meta (key, value) VALUES (?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (key, value),
+        )
+
+
+# ---------- Users ----------
+
+@metrics.timed
+async def save_users(rows: List[Tuple[int, Optional[str], int]]) -> None:
+    """Пачка (user_id, username, joined_at) одной транзакцией (см. users.py)."""
+    async with _write() as db:
+        await db.executemany(
             """
             INSERT INTO users (user_id, username, joined_at)
             VALUES (?, ?, ?)
             ON CONFLICT(user_id) DO UPDATE SET
                 username=excluded.username
             """,
-            (user_id, username, now),
+            rows,
         )
-        await db.commit()
 
 
+@metrics.timed
+async def load_users() -> List[Tuple[int, Optional[str]]]:
+    async with _read() as db:
+        cur = await db.execute("SELECT user_id, username FROM users")
+        rows = await cur.fetchall()
+    return rows
+
+
+@metrics.timed
+async def count_users() -> int:
+    async with _read() as db:
+        cur = await db.execute("SELECT COUNT(*) FROM users")
+        row = await cur.fetchone()
+    return row[0]
+
+
+@metrics.timed
 async def get_all_users() -> List[int]:
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _read() as db:
         cur = await db.execute("SELECT user_id FROM users")
         rows = await cur.fetchall()
     return [r[0] for r in rows]
@@ -81,30 +475,150 @@ async def get_all_users() -> List[int]:
 
 # ---------- Tracks ----------
 
+@metrics.timed
 async def create_track(title: str, points: int, hint: Optional[str]) -> int:
     now = int(time.time())
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _write() as db:
         cur = await db.execute(
             "INSERT INTO tracks (title, points, hint, is_active, created_at) "
             "VALUES (?, ?, ?, 1, ?)",
             (title, points, hint, now),
         )
-        await db.commit()
+        await _bump_tracks_version(db)
         return cur.lastrowid
 
 
-async def list_tracks() -> List[Tuple]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "SELECT id, title, points, hint, is_active, created_at "
-            "FROM tracks ORDER BY id DESC"
+@metrics.timed
+async def import_tracks(
+    rows: List[Tuple[Optional[int], str, int, Optional[str], bool]],
+) -> int:
+    """
+    Массовая загрузка треков (id, title, points, hint, is_active) одной транзакцией.
+    Строки с id обновляют существующий трек (или создают его с этим id),
+    строки без id добавляются как новые треки.
+    """
+    now = int(time.time())
+    with_id = [
+        (track_id, title, points, hint, 1 if is_active else 0, now)
+        for track_id, title, points, hint, is_active in rows
+        if track_id is not None
+    ]
+    new = [
+        (title, points, hint, 1 if is_active else 0, now)
+        for track_id, title, points, hint, is_active in rows
+        if track_id is None
+    ]
+    async with _write() as db:
+        await db.executemany(
+            "INSERT INTO tracks (id, title, points, hint, is_active, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET title = excluded.title, "
+            "points = excluded.points, hint = excluded.hint, "
+            "is_active = excluded.is_active",
+            with_id,
+        )
+        await db.executemany(
+            "INSERT INTO tracks (title, points, hint, is_active, created_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            new,
+        )
+        if rows:
+            await _bump_tracks_version(db)
+    return len(rows)
+
+
+async def iter_tracks(batch_size: int = 500) -> AsyncIterator[List[Tuple]]:
+    """
+    Все треки пачками по id (для экспорта), без загрузки каталога целиком.
+    Соединение берется на одну пачку, а не на весь обход.
+    """
+    after_id = 0
+    while True:
+        async with _read() as db:
+            cur = await db.execute(
+                "SELECT id, title, points, hint, is_active FROM tracks "
+                "WHERE id > ? ORDER BY id LIMIT ?",
+                (after_id, batch_size),
+            )
+            rows = await cur.fetchall()
+        if not rows:
+            return
+        yield rows
+        after_id = rows[-1][0]
+
+
+def _fts_query(text: str) -> Optional[str]:
+    """
+    Пользовательский ввод -> запрос FTS5: каждое слово как префикс,
+    все слова обязательны. Кавычки экранируем, операторы FTS5 не пропускаем.
+    """
+    text = text.replace("ё", "е").replace("Ё", "Е")
+    words = [w.replace('"', '""') for w in text.split()]
+    if not words:
+        return None
+    return " ".join(f'"{w}"*' for w in words)
+
+
+@metrics.timed
+async def list_tracks_page(
+    before_id: Optional[int] = None,
+    limit: int = 50,
+    query: Optional[str] = None,
+    active: Optional[bool] = None,
+    points: Optional[int] = None,
+) -> Tuple[List[Tuple], Optional[int]]:
+    """
+    Страница треков (новые сверху) с поиском и фильтрами.
+    Пагинация по ключу: следующая страница - before_id=<последний id>,
+    поэтому стоимость не зависит от номера страницы.
+    Возвращает (строки, before_id следующей страницы или None).
+    """
+    match = _fts_query(query) if query else None
+    # при поиске идем по rowid индекса FTS5: он сам умеет диапазон и обратный порядок
+    id_col = "tracks_fts.rowid" if match else "t.id"
+
+    where: List[str] = []
+    params: List[object] = []
+    if before_id is not None:
+        where.append(f"{id_col} < ?")
+        params.append(before_id)
+    if active is not None:
+        where.append("t.is_active = ?")
+        params.append(1 if active else 0)
+    if points is not None:
+        where.append("t.points = ?")
+        params.append(points)
+
+    if match:
+        sql = (
+            "SELECT t.id, t.title, t.points, t.hint, t.is_active, t.created_at "
+            "FROM tracks_fts JOIN tracks t ON t.id = tracks_fts.rowid "
+            "WHERE tracks_fts MATCH ?"
         )
+        params.insert(0, match)
+        if where:
+            sql += " AND " + " AND ".join(where)
+    else:
+        sql = "SELECT t.id, t.title, t.points, t.hint, t.is_active, t.created_at FROM tracks t"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+    sql += f" ORDER BY {id_col} DESC LIMIT ?"
+    # одна лишняя строка - чтобы узнать, есть ли следующая страница
+    params.append(limit + 1)
+
+    async with _read() as db:
+        cur = await db.execute(sql, params)
         rows = await cur.fetchall()
-    return rows
+
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, rows[-1][0]
+    return rows, None
 
 
+@metrics.timed
 async def get_track(track_id: int) -> Optional[Tuple]:
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _read() as db:
         cur = await db.execute(
             "SELECT id, title, points, hint, is_active, created_at "
             "FROM tracks WHERE id = ?",
@@ -114,6 +628,7 @@ async def get_track(track_id: int) -> Optional[Tuple]:
     return row
 
 
+@metrics.timed
 async def update_track(
     track_id: int,
     title: str,
@@ -121,24 +636,26 @@ async def update_track(
     hint: Optional[str],
     is_active: bool,
 ) -> None:
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _write() as db:
         await db.execute(
             "UPDATE tracks SET title = ?, points = ?, hint = ?, is_active = ? "
             "WHERE id = ?",
             (title, points, hint, 1 if is_active else 0, track_id),
         )
-        await db.commit()
+        await _bump_tracks_version(db)
 
 
+@metrics.timed
 async def delete_track(track_id: int) -> None:
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _write() as db:
         await db.execute("DELETE FROM tracks WHERE id = ?", (track_id,))
-        await db.commit()
+        await _bump_tracks_version(db)
 
 
 # старый рандом можно оставить, но бот им больше пользоваться не будет
+@metrics.timed
 async def get_random_track() -> Optional[Tuple]:
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _read() as db:
         cur = await db.execute(
             "SELECT id, title, points, hint, is_active, created_at "
             "FROM tracks WHERE is_active = 1 ORDER BY RANDOM() LIMIT 1"
@@ -149,72 +666,372 @@ async def get_random_track() -> Optional[Tuple]:
 
 # ---------- Tracks per user (no repeats) ----------
 
-async def get_random_track_for_user(user_id: int) -> Optional[Tuple]:
+@metrics.timed
+async def load_active_tracks() -> List[Tuple]:
+    """Все активные треки (id, title, points, hint) для in-memory каталога."""
+    async with _read() as db:
+        cur = await db.execute(
+            "SELECT id, title, points, hint FROM tracks "
+            "WHERE is_active = 1 ORDER BY id"
+        )
+        rows = await cur.fetchall()
+    return rows
+
+
+# ---------- Used tracks storage ----------
+
+class SeenBitmap:
+    """Множество track_id в виде битового массива."""
+
+    def __init__(self, data: bytes = b"") -> None:
+        self.bits = bytearray(zlib.decompress(data)) if data else bytearray()
+
+    def __contains__(self, track_id: object) -> bool:
+        if not isinstance(track_id, int):
+            return False
+        byte = track_id >> 3
+        return byte < len(self.bits) and bool(self.bits[byte] & (1 << (track_id & 7)))
+
+    def __iter__(self) -> Iterator[int]:
+        for byte, value in enumerate(self.bits):
+            if not value:
+                continue
+            for bit in range(8):
+                if value & (1 << bit):
+                    yield (byte << 3) | bit
+
+    def add(self, track_id: int) -> None:
+        byte = track_id >> 3
+        if byte >= len(self.bits):
+            self.bits.extend(bytes(byte + 1 - len(self.bits)))
+        self.bits[byte] |= 1 << (track_id & 7)
+
+    def dump(self) -> bytes:
+        return zlib.compress(bytes(self.bits)) if any(self.bits) else b""
+
+
+async def _load_bitmap(db: aiosqlite.Connection, user_id: int) -> SeenBitmap:
+    cur = await db.execute(
+        "SELECT bits FROM used_bitmaps WHERE user_id = ?",
+        (user_id,),
+    )
+    row = await cur.fetchone()
+    return SeenBitmap(row[0] if row else b"")
+
+
+async def _save_bitmap(
+    db: aiosqlite.Connection,
+    user_id: int,
+    bitmap: SeenBitmap,
+) -> None:
+    await db.execute(
+        "INSERT INTO used_bitmaps (user_id, bits) VALUES (?, ?) "
+        "ON CONFLICT(user_id) DO UPDATE SET bits = excluded.bits",
+        (user_id, bitmap.dump()),
+    )
+
+
+async def _load_seen(
+    db: aiosqlite.Connection,
+    user_id: int,
+) -> Union[Set[int], SeenBitmap]:
+    """Показанные пользователю треки (поддерживает `in` и итерацию)."""
+    if USED_TRACKS_STORAGE == "bitmap":
+        return await _load_bitmap(db, user_id)
+    cur = await db.execute(
+        "SELECT track_id FROM used_tracks WHERE user_id = ?",
+        (user_id,),
+    )
+    return {r[0] for r in await cur.fetchall()}
+
+
+async def _mark_used(db: aiosqlite.Connection, user_id: int, track_id: int) -> None:
+    if USED_TRACKS_STORAGE == "bitmap":
+        bitmap = await _load_bitmap(db, user_id)
+        if track_id not in bitmap:
+            bitmap.add(track_id)
+            await _save_bitmap(db, user_id, bitmap)
+        return
+    await db.execute(
+        """
+        INSERT OR IGNORE INTO used_tracks (user_id, track_id)
+        VALUES (?, ?)
+        """,
+        (user_id, track_id),
+    )
+
+
+async def _clear_used(db: aiosqlite.Connection, user_id: int) -> None:
+    if USED_TRACKS_STORAGE == "bitmap":
+        # сброс прогресса - обновление одной строки вместо DELETE по всем показам
+        await db.execute(
+            "UPDATE used_bitmaps SET bits = X'' WHERE user_id = ?",
+            (user_id,),
+        )
+        return
+    await db.execute("DELETE FROM used_tracks WHERE user_id = ?", (user_id,))
+
+
+async def _migrate_used_storage(db: aiosqlite.Connection) -> None:
+    """Перенести показанные треки в текущий режим хранения (если нужно)."""
+    if USED_TRACKS_STORAGE == "bitmap":
+        cur = await db.execute("SELECT 1 FROM used_tracks LIMIT 1")
+        if await cur.fetchone() is None:
+            return
+
+        async def flush(user_id: int, track_ids: List[int]) -> None:
+            bitmap = await _load_bitmap(db, user_id)
+            for track_id in track_ids:
+                bitmap.add(track_id)
+            await _save_bitmap(db, user_id, bitmap)
+
+        cur = await db.execute(
+            "SELECT user_id, track_id FROM used_tracks ORDER BY user_id"
+        )
+        current: Optional[int] = None
+        track_ids: List[int] = []
+        while rows := await cur.fetchmany(5000):
+            for user_id, track_id in rows:
+                if user_id != current:
+                    if current is not None:
+                        await flush(current, track_ids)
+                    current, track_ids = user_id, []
+                track_ids.append(track_id)
+        if current is not None:
+            await flush(current, track_ids)
+        await db.execute("DELETE FROM used_tracks")
+    else:
+        cur = await db.execute("SELECT 1 FROM used_bitmaps LIMIT 1")
+        if await cur.fetchone() is None:
+            return
+
+        cur = await db.execute("SELECT user_id, bits FROM used_bitmaps")
+        while rows := await cur.fetchmany(500):
+            await db.executemany(
+                "INSERT OR IGNORE INTO used_tracks (user_id, track_id) VALUES (?, ?)",
+                [
+                    (user_id, track_id)
+                    for user_id, bits in rows
+                    for track_id in SeenBitmap(bits)
+                ],
+            )
+        await db.execute("DELETE FROM used_bitmaps")
+
+
+@metrics.timed
+async def mark_track_used(user_id: int, track_id: int, durable: bool = True) -> None:
+    await _group_submit(lambda db: _mark_used(db, user_id, track_id), durable)
+
+
+@metrics.timed
+async def clear_used_tracks(user_id: int, durable: bool = True) -> None:
+    await _group_submit(lambda db: _clear_used(db, user_id), durable)
+
+
+# ---------- Decks ----------
+#
+# Колода = перемешанная перестановка track_id. Первые pos карт уже выданы
+# (туда же при сборке кладутся треки, показанные раньше), остальные ждут
+# своей очереди. Выдача трека - один UPDATE курсора + чтение 4 байт,
+# стоимость не зависит от того, сколько треков пользователь уже видел.
+
+DECK_OK = "ok"
+DECK_EMPTY = "empty"      # все карты выданы
+DECK_MISSING = "missing"  # колоды еще нет
+DECK_STALE = "stale"      # каталог изменился, колоду нужно подправить
+
+
+def _pack_ids(ids: Iterable[int]) -> bytes:
+    arr = array("I", ids)
+    if sys.byteorder != "little":
+        arr.byteswap()
+    return arr.tobytes()
+
+
+def _unpack_ids(data: bytes) -> List[int]:
+    arr = array("I")
+    arr.frombytes(data)
+    if sys.byteorder != "little":
+        arr.byteswap()
+    return arr.tolist()
+
+
+async def _save_deck(
+    db: aiosqlite.Connection,
+    user_id: int,
+    cards: List[int],
+    pos: int,
+    version: int,
+) -> None:
+    now = int(time.time())
+    await db.execute(
+        """
+        INSERT INTO user_decks (user_id, pos, size, version, updated_at)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            pos = excluded.pos,
+            size = excluded.size,
+            version = excluded.version,
+            updated_at = excluded.updated_at
+        """,
+        (user_id, pos, len(cards), version, now),
+    )
+    await db.execute(
+        "INSERT OR REPLACE INTO user_deck_cards (user_id, cards) VALUES (?, ?)",
+        (user_id, _pack_ids(cards)),
+    )
+
+
+@metrics.timed
+async def build_deck(
+    user_id: int,
+    active_ids: Iterable[int],
+    version: int,
+    reset: bool,
+) -> None:
     """
-    Выбираем случайный активный трек,
-    который еще не показывали этому пользователю.
+    Собрать новую колоду из активных треков.
+    reset=True - начать сначала (прогресс пользователя стирается),
+    иначе уже показанные треки кладутся в "выданную" часть колоды.
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _write() as db:
+        if reset:
+            await _clear_used(db, user_id)
+            seen: Union[Set[int], SeenBitmap] = set()
+        else:
+            seen = await _load_seen(db, user_id)
+
+        rest = [track_id for track_id in active_ids if track_id not in seen]
+        random.shuffle(rest)
+        drawn = list(seen)
+        await _save_deck(db, user_id, drawn + rest, len(drawn), version)
+
+
+async def _draw(db: aiosqlite.Connection, user_id: int, version: int) -> Tuple[str, Optional[int]]:
+    now = int(time.time())
+    cur = await db.execute(
+        """
+        UPDATE user_decks SET pos = pos + 1, updated_at = ?
+        WHERE user_id = ? AND version = ? AND pos < size
+        RETURNING pos
+        """,
+        (now, user_id, version),
+    )
+    row = await cur.fetchone()
+    if row is not None:
+        pos = row[0]
         cur = await db.execute(
-            """
-            SELECT id, title, points, hint, is_active, created_at
-            FROM tracks
-            WHERE is_active = 1
-              AND id NOT IN (
-                  SELECT track_id FROM used_tracks WHERE user_id = ?
-              )
-            ORDER BY RANDOM()
-            LIMIT 1
-            """,
-            (user_id,),
+            "SELECT substr(cards, ?, 4) FROM user_deck_cards WHERE user_id = ?",
+            ((pos - 1) * 4 + 1, user_id),
         )
-        row = await cur.fetchone()
-    return row
+        card = await cur.fetchone()
+        track_id = int.from_bytes(card[0], "little")
+        await _mark_used(db, user_id, track_id)
+        return DECK_OK, track_id
 
+    cur = await db.execute(
+        "SELECT version FROM user_decks WHERE user_id = ?",
+        (user_id,),
+    )
+    row = await cur.fetchone()
+    if row is None:
+        return DECK_MISSING, None
+    if row[0] != version:
+        return DECK_STALE, None
+    return DECK_EMPTY, None
 
-async def mark_track_used(user_id: int, track_id: int) -> None:
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            """
-            INSERT OR IGNORE INTO used_tracks (user_id, track_id)
-            VALUES (?, ?)
-            """,
-            (user_id, track_id),
+
+@metrics.timed
+async def draw_from_deck(
+    user_id: int,
+    version: int,
+    durable: bool = True,
+) -> Tuple[str, Optional[int]]:
+    """
+    Атомарно выдать следующую карту и сдвинуть курсор.
+    Возвращает (DECK_OK, track_id) или (DECK_EMPTY | DECK_MISSING | DECK_STALE, None).
+    Запись идет через group commit (см. _group_submit).
+    """
+    return await _group_submit(lambda db: _draw(db, user_id, version), durable)
+
+
+@metrics.timed
+async def patch_deck(
+    user_id: int,
+    active_ids: AbstractSet[int],
+    version: int,
+) -> None:
+    """
+    Подогнать колоду под изменившийся каталог без полной перетасовки:
+    выключенные/удаленные треки убираются из невыданной части,
+    новые треки вставляются в нее на случайные места.
+    """
+    async with _write() as db:
+        cur = await db.execute(
+            "SELECT d.pos, d.version, c.cards FROM user_decks d "
+            "JOIN user_deck_cards c ON c.user_id = d.user_id "
+            "WHERE d.user_id = ?",
+            (user_id,),
         )
-        await db.commit()
+        row = await cur.fetchone()
+        if row is None or row[1] == version:
+            return
+
+        pos, _old_version, blob = row
+        cards = _unpack_ids(blob)
+        known = set(cards)
+        drawn = cards[:pos]
+        rest = [track_id for track_id in cards[pos:] if track_id in active_ids]
 
+        # вставка на равновероятное место (шаг "inside-out" Фишера-Йетса)
+        for track_id in active_ids - known:
+            j = random.randint(0, len(rest))
+            if j == len(rest):
+                rest.append(track_id)
+            else:
+                rest.append(rest[j])
+                rest[j] = track_id
 
-async def clear_used_tracks(user_id: int) -> None:
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("DELETE FROM used_tracks WHERE user_id = ?", (user_id,))
-        await db.commit()
+        await _save_deck(db, user_id, drawn + rest, pos, version)
 
 
 # ---------- Broadcasts ----------
 
+@metrics.timed
 async def create_broadcast(text: str) -> int:
     now = int(time.time())
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _write() as db:
         cur = await db.execute(
             "INSERT INTO broadcasts (text, created_at) VALUES (?, ?)",
             (text, now),
         )
-        await db.commit()
         return cur.lastrowid
 
 
+@metrics.timed
 async def mark_broadcast_sent(broadcast_id: int) -> None:
     now = int(time.time())
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _write() as db:
         await db.execute(
             "UPDATE broadcasts SET sent_at = ? WHERE id = ?",
             (now, broadcast_id),
         )
-        await db.commit()
 
 
+@metrics.timed
+async def get_broadcast(broadcast_id: int) -> Optional[Tuple]:
+    async with _read() as db:
+        cur = await db.execute(
+            "SELECT id, text, created_at, sent_at FROM broadcasts WHERE id = ?",
+            (broadcast_id,),
+        )
+        row = await cur.fetchone()
+    return row
+
+
+@metrics.timed
 async def list_broadcasts() -> List[Tuple]:
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _read() as db:
         cur = await db.execute(
             "SELECT id, text, created_at, sent_at "
             "FROM broadcasts ORDER BY COALESCE(sent_at, created_at) DESC"
@@ -223,37 +1040,357 @@ async def list_broadcasts() -> List[Tuple]:
     return rows
 
 
+@metrics.timed
 async def delete_broadcast(broadcast_id: int) -> None:
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _write() as db:
         await db.execute("DELETE FROM broadcasts WHERE id = ?", (broadcast_id,))
-        await db.commit()
+
+
+# ---------- Broadcast deliveries ----------
+
+@metrics.timed
+async def seed_broadcast_deliveries(broadcast_id: int) -> int:
+    """Поставить всех пользователей в очередь рассылки. Возвращает их число."""
+    async with _write() as db:
+        cur = await db.execute(
+            "INSERT OR IGNORE INTO broadcast_deliveries (broadcast_id, user_id) "
+            "SELECT ?, user_id FROM users",
+            (broadcast_id,),
+        )
+        return cur.rowcount
+
+
+@metrics.timed
+async def get_pending_deliveries(
+    broadcast_id: int,
+    after_user_id: int,
+    limit: int,
+) -> List[int]:
+    """Следующая страница получателей, которым рассылка еще не ушла."""
+    async with _read() as db:
+        cur = await db.execute(
+            # статистика по выборке (analysis_limit, см. housekeeping.py) не
+            # отличает частичный индекс от первичного ключа - указываем явно
+            "SELECT user_id FROM broadcast_deliveries INDEXED BY idx_deliveries_pending "
+            "WHERE broadcast_id = ? AND status = 'pending' AND user_id > ? "
+            "ORDER BY user_id LIMIT ?",
+            (broadcast_id, after_user_id, limit),
+        )
+        rows = await cur.fetchall()
+    return [r[0] for r in rows]
+
+
+@metrics.timed
+async def record_deliveries(
+    broadcast_id: int,
+    results: List[Tuple[int, str, Optional[str]]],
+) -> None:
+    """Записать пачку результатов (user_id, status, error) одной транзакцией."""
+    now = int(time.time())
+    async with _write() as db:
+        await db.executemany(
+            "UPDATE broadcast_deliveries SET status = ?, error = ?, updated_at = ? "
+            "WHERE broadcast_id = ? AND user_id = ?",
+            [
+                (status, error, now, broadcast_id, user_id)
+                for user_id, status, error in results
+            ],
+        )
+
+
+@metrics.timed
+async def get_delivery_counts(broadcast_id: int) -> Dict[str, int]:
+    async with _read() as db:
+        cur = await db.execute(
+            "SELECT status, COUNT(*) FROM broadcast_deliveries "
+            "WHERE broadcast_id = ? GROUP BY status",
+            (broadcast_id,),
+        )
+        rows = await cur.fetchall()
+    return {status: count for status, count in rows}
+
+
+@metrics.timed
+async def get_delivery_errors(broadcast_id: int) -> Dict[str, int]:
+    async with _read() as db:
+        cur = await db.execute(
+            "SELECT error, COUNT(*) FROM broadcast_deliveries "
+            "WHERE broadcast_id = ? AND status = 'failed' GROUP BY error",
+            (broadcast_id,),
+        )
+        rows = await cur.fetchall()
+    return {error or "unknown": count for error, count in rows}
+
+
+@metrics.timed
+async def list_unfinished_broadcasts() -> List[int]:
+    """Рассылки, прерванные на середине (есть получатели в статусе pending)."""
+    async with _read() as db:
+        cur = await db.execute(
+            "SELECT b.id FROM broadcasts b "
+            "WHERE b.sent_at IS NULL AND EXISTS ("
+            "  SELECT 1 FROM broadcast_deliveries d INDEXED BY idx_deliveries_pending "
+            "  WHERE d.broadcast_id = b.id AND d.status = 'pending'"
+            ") ORDER BY b.id"
+        )
+        rows = await cur.fetchall()
+    return [r[0] for r in rows]
+
+
+@metrics.timed
+async def finish_stranded_broadcasts() -> List[int]:
+    """
+    Отметить отправленными рассылки, у которых журнал доставки пройден целиком,
+    но sent_at не записан (процесс упал между последним чекпоинтом и
+    mark_broadcast_sent). Рассылки без журнала не трогаем: их как раз создают.
+    """
+    now = int(time.time())
+    async with _write() as db:
+        cur = await db.execute(
+            "UPDATE broadcasts SET sent_at = ? "
+            "WHERE sent_at IS NULL "
+            "AND EXISTS (SELECT 1 FROM broadcast_deliveries d WHERE d.broadcast_id = broadcasts.id) "
+            "AND NOT EXISTS ("
+            "  SELECT 1 FROM broadcast_deliveries d INDEXED BY idx_deliveries_pending "
+            "  WHERE d.broadcast_id = broadcasts.id AND d.status = 'pending'"
+            ") RETURNING id",
+            (now,),
+        )
+        rows = await cur.fetchall()
+    return sorted(r[0] for r in rows)
 
 
 # ---------- Broadcast media ----------
 
+@metrics.timed
 async def create_broadcast_file(
     broadcast_id: int,
     kind: str,
     path: str,
+    sha256: Optional[str] = None,
 ) -> int:
     now = int(time.time())
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _write() as db:
+        # если этот файл уже отправлялся, сразу подхватываем его file_id
         cur = await db.execute(
-            "INSERT INTO broadcast_files (broadcast_id, kind, path, created_at) "
-            "VALUES (?, ?, ?, ?)",
-            (broadcast_id, kind, path, now),
+            "INSERT INTO broadcast_files "
+            "(broadcast_id, kind, path, created_at, sha256, file_id) "
+            "VALUES (?, ?, ?, ?, ?, ("
+            "  SELECT file_id FROM broadcast_files "
+            "  WHERE path = ? AND file_id IS NOT NULL LIMIT 1"
+            "))",
+            (broadcast_id, kind, path, now, sha256, path),
         )
-        await db.commit()
         return cur.lastrowid
 
 
+@metrics.timed
+async def find_broadcast_file(kind: str, sha256: str) -> Optional[str]:
+    """Путь к уже загруженному файлу с таким же содержимым (для дедупликации)."""
+    async with _read() as db:
+        cur = await db.execute(
+            "SELECT path FROM broadcast_files WHERE sha256 = ? AND kind = ? "
+            "ORDER BY id LIMIT 1",
+            (sha256, kind),
+        )
+        row = await cur.fetchone()
+    return row[0] if row else None
+
+
+@metrics.timed
 async def get_broadcast_files(broadcast_id: int) -> List[Tuple]:
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _read() as db:
         cur = await db.execute(
-            "SELECT id, kind, path, created_at "
+            "SELECT id, kind, path, created_at, file_id "
             "FROM broadcast_files WHERE broadcast_id = ? "
             "ORDER BY id ASC",
             (broadcast_id,),
         )
         rows = await cur.fetchall()
     return rows
+
+
+@metrics.timed
+async def set_broadcast_file_id(path: str, file_id: Optional[str]) -> None:
+    """Запомнить (или забыть при file_id=None) Telegram file_id для файла."""
+    async with _write() as db:
+        await db.execute(
+            "UPDATE broadcast_files SET file_id = ? WHERE path = ?",
+            (file_id, path),
+        )
+
+
+# ---------- Backups ----------
+
+@metrics.timed
+async def save_backup_manifest(manifest: Dict) -> None:
+    async with _write() as db:
+        await db.execute(
+            "INSERT OR REPLACE INTO backups (id, parent_id, kind, created_at, manifest) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (
+                manifest["id"],
+                manifest["parent"],
+                manifest["kind"],
+                manifest["created_at"],
+                json.dumps(manifest["files"]),
+            ),
+        )
+
+
+@metrics.timed
+async def get_backup_manifest(backup_id: str) -> Optional[Dict]:
+    async with _read() as db:
+        cur = await db.execute(
+            "SELECT id, parent_id, kind, created_at, manifest FROM backups WHERE id = ?",
+            (backup_id,),
+        )
+        row = await cur.fetchone()
+    if row is None:
+        return None
+    return {
+        "id": row[0],
+        "parent": row[1],
+        "kind": row[2],
+        "created_at": row[3],
+        "files": json.loads(row[4]),
+    }
+
+
+@metrics.timed
+async def get_last_backup_id() -> Optional[str]:
+    async with _read() as db:
+        cur = await db.execute(
+            "SELECT id FROM backups ORDER BY created_at DESC, rowid DESC LIMIT 1"
+        )
+        row = await cur.fetchone()
+    return row[0] if row else None
+
+
+# ---------- Housekeeping ----------
+#
+# Запросы фоновой уборки (housekeeping.py). Каждая функция - один короткий
+# шаг: уборка идет рядом с живым ботом и не должна надолго занимать писателя.
+
+@metrics.timed
+async def find_inactive_players(
+    cutoff: int,
+    after_user_id: int,
+    window: int,
+) -> Tuple[List[int], Optional[int]]:
+    """
+    Просмотреть window пользователей после after_user_id и выбрать тех,
+    у кого есть прогресс, но последний ход (или регистрация) раньше cutoff.
+    Возвращает (выбранные, последний просмотренный user_id или None в конце).
+    """
+    async with _read() as db:
+        cur = await db.execute(
+            "SELECT u.user_id, COALESCE(d.updated_at, u.joined_at) < ? AND ("
+            "  d.user_id IS NOT NULL"
+            "  OR EXISTS (SELECT 1 FROM used_tracks t WHERE t.user_id = u.user_id)"
+            "  OR EXISTS (SELECT 1 FROM used_bitmaps b WHERE b.user_id = u.user_id)"
+            ") FROM users u LEFT JOIN user_decks d ON d.user_id = u.user_id "
+            "WHERE u.user_id > ? ORDER BY u.user_id LIMIT ?",
+            (cutoff, after_user_id, window),
+        )
+        rows = await cur.fetchall()
+    if not rows:
+        return [], None
+    return [user_id for user_id, stale in rows if stale], rows[-1][0]
+
+
+@metrics.timed
+async def prune_progress(user_ids: List[int], cutoff: int) -> int:
+    """
+    Стереть показанные треки и колоду у пользователей, не игравших с cutoff.
+    Кто успел сыграть после find_inactive_players(), не трогается.
+    Возвращает, скольких пользователей очистили.
+    """
+    if not user_ids:
+        return 0
+    marks = ",".join("?" * len(user_ids))
+    async with _write() as db:
+        # в режиме split пишут и другие процессы: перепроверка и удаление -
+        # в одной транзакции, игрок не вернется между ними
+        await db.execute("BEGIN IMMEDIATE")
+        cur = await db.execute(
+            "SELECT u.user_id FROM users u "
+            "LEFT JOIN user_decks d ON d.user_id = u.user_id "
+            f"WHERE u.user_id IN ({marks}) "
+            "AND COALESCE(d.updated_at, u.joined_at) < ?",
+            (*user_ids, cutoff),
+        )
+        stale = await cur.fetchall()
+        for table in ("used_tracks", "used_bitmaps", "user_deck_cards", "user_decks"):
+            await db.executemany(f"DELETE FROM {table} WHERE user_id = ?", stale)
+    return len(stale)
+
+
+@metrics.timed
+async def list_broadcast_file_paths() -> Set[str]:
+    """Все пути из broadcast_files (один файл может быть у нескольких рассылок)."""
+    async with _read() as db:
+        cur = await db.execute("SELECT DISTINCT path FROM broadcast_files")
+        rows = await cur.fetchall()
+    return {os.path.normpath(r[0]) for r in rows}
+
+
+@metrics.timed
+async def get_free_pages() -> Tuple[int, int]:
+    """(auto_vacuum: 0 - none, 1 - full, 2 - incremental; свободных страниц в файле)."""
+    async with _read() as db:
+        cur = await db.execute("PRAGMA auto_vacuum")
+        mode = (await cur.fetchone())[0]
+        cur = await db.execute("PRAGMA freelist_count")
+        free = (await cur.fetchone())[0]
+    return mode, free
+
+
+@metrics.timed
+async def incremental_vacuum(pages: int) -> int:
+    """
+    Отдать файловой системе до pages свободных страниц (нужен
+    auto_vacuum = INCREMENTAL). Возвращает, сколько свободных осталось.
+    """
+    async with _write() as db:
+        # через execute() прагма освобождает одну страницу,
+        # executescript() выполняет ее до конца
+        await db.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+        cur = await db.execute("PRAGMA freelist_count")
+        row = await cur.fetchone()
+    return row[0]
+
+
+@metrics.timed
+async def list_tables() -> List[str]:
+    """Обычные таблицы базы (без служебных sqlite_* и виртуальных)."""
+    async with _read() as db:
+        cur = await db.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' "
+            "AND name NOT LIKE 'sqlite_%' AND sql NOT LIKE 'CREATE VIRTUAL TABLE%' "
+            "ORDER BY name"
+        )
+        rows = await cur.fetchall()
+    return [r[0] for r in rows]
+
+
+@metrics.timed
+async def analyze_table(table: str, analysis_limit: int) -> None:
+    """Пересчитать статистику планировщика по таблице, читая не больше analysis_limit строк индекса."""
+    async with _write() as db:
+        await db.execute(f"PRAGMA analysis_limit = {int(analysis_limit)}")
+        try:
+            await db.execute(f'ANALYZE "{table}"')
+        finally:
+            await db.execute("PRAGMA analysis_limit = 0")
+
+
+@metrics.timed
+async def optimize_database(analysis_limit: int) -> None:
+    """PRAGMA optimize: SQLite сам решает, каким таблицам нужен ANALYZE."""
+    async with _write() as db:
+        await db.execute(f"PRAGMA analysis_limit = {int(analysis_limit)}")
+        try:
+            await db.execute("PRAGMA optimize")
+        finally:
+            await db.execute("PRAGMA analysis_limit = 0")
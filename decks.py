@@ -0,0 +1,51 @@
+"""
+Персональные колоды треков.
+
+На "Поехали" / "Начать сначала" пользователю собирается перемешанная колода
+из активных треков, каждое "Следующая песня" просто берет следующую карту
+(db.draw_from_deck - одна атомарная операция, два быстрых нажатия
+не получат один и тот же трек). Если в админке добавили или выключили
+треки, колода подправляется на месте при следующей выдаче.
+"""
+from typing import Optional, Tuple
+
+import catalog
+import db
+
+# защита от бесконечного цикла, если каталог меняется прямо во время выдачи
+_MAX_ATTEMPTS = 5
+
+
+async def new_deck(user_id: int, reset: bool) -> None:
+    """
+    Собрать колоду заново.
+    reset=True - прогресс стирается ("Начать сначала"),
+    иначе уже показанные треки не попадут в невыданную часть.
+    """
+    cat = await catalog.load()
+    await db.build_deck(user_id, cat.ids, cat.version, reset=reset)
+
+
+async def draw_track(user_id: int) -> Optional[Tuple[int, str, int, Optional[str]]]:
+    """
+    Следующий трек из колоды (id, title, points, hint)
+    или None, если пользователь прошел все активные треки.
+    """
+    for _ in range(_MAX_ATTEMPTS):
+        cat = await catalog.load()
+        status, track_id = await db.draw_from_deck(user_id, cat.version)
+
+        if status == db.DECK_OK:
+            track = cat.get(track_id)
+            if track is not None:
+                return track
+            # трек выключили между загрузкой каталога и выдачей - берем следующий
+            continue
+        if status == db.DECK_EMPTY:
+            return None
+        if status == db.DECK_MISSING:
+            await db.build_deck(user_id, cat.ids, cat.version, reset=False)
+        elif status == db.DECK_STALE:
+            await db.patch_deck(user_id, cat.index.keys(), cat.version)
+
+    raise RuntimeError(f"Не удалось выдать трек из колоды user_id={user_id}")
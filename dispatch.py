@@ -0,0 +1,176 @@
+"""
+Планировщик апдейтов бота.
+
+aiogram запускает каждый апдейт отдельной задачей и ничем их не ограничивает:
+пачка нажатий превращается в столько же одновременных походов в базу, а два
+быстрых нажатия одного игрока ("Следующая песня" дважды) обрабатываются
+наперегонки и могут выдать треки не в том порядке.
+
+UpdateScheduler - outer middleware на dp.update:
+- апдейты одного пользователя (или чата, если пользователя нет) идут
+  строго по очереди, в порядке поступления - у каждого своя очередь (lane);
+- апдейты разных пользователей идут параллельно, но не больше
+  UPDATE_CONCURRENCY одновременно;
+- если принятых, но не обработанных апдейтов UPDATE_QUEUE_LIMIT и больше,
+  прием притормаживается: в polling не вызывается getUpdates (апдейты ждут
+  на стороне Telegram), webhook не отвечает, пока очередь не разгрузится.
+
+Глубина очереди и ожидание в ней - в /metrics (kazoo_updates_*).
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.dispatcher.middlewares.user_context import EVENT_CONTEXT_KEY
+from aiogram.methods import GetUpdates
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# сколько апдейтов обрабатывается одновременно; хендлеры в основном ждут
+# Bot API, так что предел высокий - он держит в рамках очередь к писателю SQLite
+UPDATE_CONCURRENCY = max(1, int(os.getenv("UPDATE_CONCURRENCY", "64")))
+# сколько апдейтов может ждать и выполняться, прежде чем прием притормозит
+UPDATE_QUEUE_LIMIT = max(1, int(os.getenv("UPDATE_QUEUE_LIMIT", "500")))
+
+_SCHEDULER_KEY = "update_scheduler"
+
+
+class _Lane:
+    """Очередь одного пользователя: asyncio.Lock отпускает ждущих по порядку."""
+
+    __slots__ = ("lock", "pending")
+
+    def __init__(self) -> None:
+        self.lock = asyncio.Lock()
+        self.pending = 0
+
+
+class UpdateScheduler(BaseMiddleware):
+    def __init__(
+        self,
+        concurrency: int = UPDATE_CONCURRENCY,
+        queue_limit: int = UPDATE_QUEUE_LIMIT,
+    ) -> None:
+        self.concurrency = concurrency
+        self.queue_limit = queue_limit
+        # принятые апдейты: ждут очереди или слота + выполняются
+        self.pending = 0
+        self.active = 0
+        self._slots = asyncio.Semaphore(concurrency)
+        self._lanes: Dict[int, _Lane] = {}
+        self._capacity = asyncio.Event()
+        self._capacity.set()
+
+    @property
+    def overloaded(self) -> bool:
+        return self.pending >= self.queue_limit
+
+    async def wait_capacity(self, timeout: Optional[float] = None) -> bool:
+        """
+        Дождаться, пока очередь разгрузится. Предел мягкий: проснувшиеся
+        разом могут немного превысить его, это не страшно.
+        """
+        if not self.overloaded:
+            return True
+        try:
+            await asyncio.wait_for(self._capacity.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def __call__(
+        self,
+        handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+        event: Any,
+        data: Dict[str, Any],
+    ) -> Any:
+        context = data.get(EVENT_CONTEXT_KEY)
+        key = None
+        if context is not None:
+            key = context.user_id if context.user_id is not None else context.chat_id
+
+        self._add(1)
+        queued = time.perf_counter()
+        try:
+            if key is None:
+                return await self._run(handler, event, data, queued)
+
+            lane = self._lanes.get(key)
+            if lane is None:
+                lane = self._lanes[key] = _Lane()
+            lane.pending += 1
+            try:
+                async with lane.lock:
+                    return await self._run(handler, event, data, queued)
+            finally:
+                lane.pending -= 1
+                if not lane.pending:
+                    del self._lanes[key]
+        finally:
+            self._add(-1)
+
+    async def _run(
+        self,
+        handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+        event: Any,
+        data: Dict[str, Any],
+        queued: float,
+    ) -> Any:
+        # слот берем уже в своей очереди: ждущие за другим апдейтом
+        # того же пользователя не занимают слоты у остальных
+        async with self._slots:
+            metrics.UPDATE_QUEUE_WAIT.observe(time.perf_counter() - queued)
+            self.active += 1
+            self._report()
+            try:
+                return await handler(event, data)
+            finally:
+                self.active -= 1
+                self._report()
+
+    def _add(self, delta: int) -> None:
+        self.pending += delta
+        if self.overloaded:
+            self._capacity.clear()
+        else:
+            self._capacity.set()
+        self._report()
+
+    def _report(self) -> None:
+        metrics.UPDATES_QUEUED.set(value=self.pending - self.active)
+        metrics.UPDATES_ACTIVE.set(value=self.active)
+
+
+class PollingBackpressure(BaseRequestMiddleware):
+    """Middleware сессии бота: пока очередь переполнена, getUpdates не вызывается."""
+
+    def __init__(self, scheduler: UpdateScheduler) -> None:
+        self.scheduler = scheduler
+
+    async def __call__(self, make_request, bot, method) -> Any:
+        if isinstance(method, GetUpdates) and self.scheduler.overloaded:
+            metrics.UPDATES_THROTTLED.inc("polling")
+            logger.warning(
+                "Update queue is full (%s pending), pausing polling", self.scheduler.pending
+            )
+            await self.scheduler.wait_capacity()
+        return await make_request(bot, method)
+
+
+def install(dp: Dispatcher, bot: Bot) -> UpdateScheduler:
+    """Подключить планировщик к диспетчеру (и к polling этого бота)."""
+    scheduler = UpdateScheduler()
+    dp.update.outer_middleware(scheduler)
+    bot.session.middleware(PollingBackpressure(scheduler))
+    dp[_SCHEDULER_KEY] = scheduler
+    return scheduler
+
+
+def get_scheduler(dp: Dispatcher) -> Optional[UpdateScheduler]:
+    return dp.get(_SCHEDULER_KEY)
@@ -0,0 +1,254 @@
+"""
+Локальная заглушка Telegram Bot API для тестов и нагрузочных прогонов.
+
+Поднимает aiohttp-сервер, который отвечает на /bot<token>/<method>
+правдоподобными ответами (sendMessage, sendPhoto, answerCallbackQuery...)
+и запоминает все вызовы. Бот направляется на нее через
+TELEGRAM_API_BASE=http://127.0.0.1:<port>, а апдейты отправляются
+в webhook приложения с правильным секретом.
+
+Запуск вручную (бот уже работает в режиме webhook):
+
+    python fake_telegram.py --port 8081 \\
+        --webhook http://127.0.0.1:8080/telegram/webhook --secret <WEBHOOK_SECRET> \\
+        --users 20
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+import aiohttp
+from aiohttp import web
+
+BOT_USER = {"id": 1000000, "is_bot": True, "first_name": "Kazoo", "username": "fake_kazoo_bot"}
+
+
+class FakeTelegram:
+    """
+    Заглушка Bot API. calls - список (метод, параметры) в порядке вызова
+    (если record=False, вызовы только считаются - для долгих прогонов).
+    rate_limit - доля send*-запросов, на которые отвечаем 429 с retry_after.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        rate_limit: float = 0.0,
+        retry_after: int = 1,
+        record: bool = True,
+    ) -> None:
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.record = record
+        self.calls: List[Tuple[str, Dict[str, Any]]] = []
+        self.counts: Counter = Counter()
+        self.throttled = 0
+        self._ids = itertools.count(1)
+        self._runner: Optional[web.AppRunner] = None
+        self.app = web.Application()
+        self.app.router.add_post("/bot{token}/{method}", self._handle)
+        self.app.router.add_get("/bot{token}/{method}", self._handle)
+
+    # ---------- server ----------
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8081) -> str:
+        """Запустить сервер, вернуть base URL для TELEGRAM_API_BASE."""
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        return f"http://{host}:{port}"
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def count(self, method: Optional[str] = None) -> int:
+        if method is None:
+            return sum(self.counts.values())
+        return self.counts[method]
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params: Dict[str, Any] = {}
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            for key, value in (await request.post()).items():
+                # файлы приходят как FileField, остальное - строки (JSON для сложных полей)
+                params[key] = value.filename if isinstance(value, web.FileField) else value
+        self.counts[method] += 1
+        if self.record:
+            self.calls.append((method, params))
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.rate_limit and method.startswith("send") and random.random() < self.rate_limit:
+            self.throttled += 1
+            return web.json_response(
+                {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                },
+                status=429,
+            )
+        return web.json_response({"ok": True, "result": self._result(method, params)})
+
+    # ---------- responses ----------
+
+    def _message(self, params: Dict[str, Any], **extra: Any) -> Dict[str, Any]:
+        chat_id = int(params.get("chat_id", 0))
+        message = {
+            "message_id": next(self._ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+        }
+        if "text" in params:
+            message["text"] = params["text"]
+        if "caption" in params:
+            message["caption"] = params["caption"]
+        message.update(extra)
+        return message
+
+    def _file(self, kind: str) -> Dict[str, Any]:
+        n = next(self._ids)
+        return {"file_id": f"{kind}-{n}", "file_unique_id": f"u{kind}{n}"}
+
+    def _result(self, method: str, params: Dict[str, Any]) -> Any:
+        if method == "getMe":
+            return BOT_USER
+        if method == "sendMessage":
+            return self._message(params)
+        if method == "sendPhoto":
+            return self._message(params, photo=[{**self._file("photo"), "width": 1, "height": 1}])
+        if method == "sendVideo":
+            return self._message(
+                params, video={**self._file("video"), "width": 1, "height": 1, "duration": 1}
+            )
+        if method == "sendAudio":
+            return self._message(params, audio={**self._file("audio"), "duration": 1})
+        if method == "sendDocument":
+            return self._message(params, document=self._file("document"))
+        if method == "sendMediaGroup":
+            media = json.loads(params.get("media", "[]"))
+            return [
+                self._message(params, photo=[{**self._file("photo"), "width": 1, "height": 1}])
+                for _ in media
+            ]
+        if method.startswith("editMessage"):
+            return self._message(params)
+        # answerCallbackQuery, setWebhook, deleteWebhook, ...
+        return True
+
+
+# ---------- updates ----------
+
+_update_ids = itertools.count(1)
+
+
+def _user(user_id: int) -> Dict[str, Any]:
+    return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"u{user_id}"}
+
+
+def message_update(user_id: int, text: str) -> Dict[str, Any]:
+    update = {
+        "update_id": next(_update_ids),
+        "message": {
+            "message_id": next(_update_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": _user(user_id),
+            "text": text,
+        },
+    }
+    if text.startswith("/"):
+        command = text.split()[0]
+        update["message"]["entities"] = [
+            {"type": "bot_command", "offset": 0, "length": len(command)}
+        ]
+    return update
+
+
+def callback_update(user_id: int, data: str) -> Dict[str, Any]:
+    return {
+        "update_id": next(_update_ids),
+        "callback_query": {
+            "id": str(next(_update_ids)),
+            "from": _user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": next(_update_ids),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": BOT_USER,
+                "text": "...",
+            },
+        },
+    }
+
+
+async def post_update(
+    session: aiohttp.ClientSession,
+    webhook_url: str,
+    secret: str,
+    update: Dict[str, Any],
+) -> int:
+    """Отправить апдейт в webhook так, как это делает Telegram. Возвращает HTTP статус."""
+    async with session.post(
+        webhook_url,
+        json=update,
+        headers={"X-Telegram-Bot-Api-Secret-Token": secret},
+    ) as resp:
+        return resp.status
+
+
+# ---------- CLI ----------
+
+async def _main(args: argparse.Namespace) -> None:
+    fake = FakeTelegram(
+        latency=args.latency,
+        rate_limit=args.rate_limit,
+        retry_after=args.retry_after,
+        record=False,
+    )
+    base = await fake.start(port=args.port)
+    print(f"Fake Bot API: {base} (TELEGRAM_API_BASE)", flush=True)
+    if not args.webhook:
+        await asyncio.Event().wait()
+        return
+
+    async with aiohttp.ClientSession() as session:
+        statuses: Counter = Counter()
+        for user_id in range(1, args.users + 1):
+            for update in (message_update(user_id, "/start"), callback_update(user_id, "go")):
+                statuses[await post_update(session, args.webhook, args.secret, update)] += 1
+        print("webhook statuses:", dict(statuses))
+
+    await asyncio.sleep(args.wait)
+    print("Bot API calls:", dict(fake.counts), "429:", fake.throttled)
+    await fake.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Telegram Bot API")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--webhook", help="URL webhook бота; без него сервер просто работает")
+    parser.add_argument("--secret", default="")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа, сек")
+    parser.add_argument("--rate-limit", type=float, default=0.0,
+                        help="доля send*-запросов с ответом 429, 0..1")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after в ответах 429")
+    parser.add_argument("--wait", type=float, default=2.0, help="сколько ждать ответов бота")
+    asyncio.run(_main(parser.parse_args()))
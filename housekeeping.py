@@ -0,0 +1,295 @@
+"""
+Фоновая уборка в часы затишья.
+
+Со временем база и uploads/ только растут: показанные треки и колоды
+остаются у игроков, которые давно ушли, файлы удаленной рассылки лежат
+в uploads/broadcasts/<id>/, а освободившиеся страницы SQLite файловой
+системе не отдает. Раз в сутки, в часы HOUSEKEEPING_HOURS (местное время),
+по очереди выполняются задачи из HOUSEKEEPING_JOBS:
+- prune   - стереть прогресс (показанные треки и колоду) у игроков, которые
+            не играли PRUNE_INACTIVE_DAYS дней; сам пользователь остается
+            (ему по-прежнему уходят рассылки), вернувшись, он просто
+            начнет колоду заново;
+- media   - удалить файлы uploads/broadcasts/, на которые не ссылается ни
+            одна рассылка, и опустевшие папки. Файлы моложе MEDIA_GRACE не
+            трогаются: загрузка и restore пишут файл раньше строки в базе;
+- vacuum  - PRAGMA incremental_vacuum небольшими порциями страниц;
+- analyze - ANALYZE по таблицам с analysis_limit и PRAGMA optimize.
+
+Работа нарезана на шаги: шаг - одна короткая транзакция, размер порции
+подстраивается так, чтобы шаг укладывался в STEP_BUDGET, между шагами -
+пауза STEP_PAUSE, за которую проходят запросы бота. Кончились часы уборки -
+задача останавливается и доделывается на следующую ночь.
+
+Запускается в одном процессе: в single - рядом с ботом, в split - в админке.
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import db
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# часы уборки "с-по" по местному времени (по не включается): "3-6", "23-2";
+# пусто - в любое время
+HOUSEKEEPING_HOURS = os.getenv("HOUSEKEEPING_HOURS", "3-6")
+# какие задачи выполнять и в каком порядке; пусто - уборка выключена
+HOUSEKEEPING_JOBS = [
+    job.strip()
+    for job in os.getenv("HOUSEKEEPING_JOBS", "prune,media,vacuum,analyze").split(",")
+    if job.strip()
+]
+# через сколько дней без игры прогресс стирается; 0 - никогда
+PRUNE_INACTIVE_DAYS = int(os.getenv("PRUNE_INACTIVE_DAYS", "180"))
+
+# не чаще раза в сутки (с запасом, чтобы окно не "уезжало" каждую ночь)
+MIN_INTERVAL = 20 * 3600
+CHECK_INTERVAL = 60.0
+# сколько может длиться один шаг и пауза между шагами
+STEP_BUDGET = 0.005
+STEP_PAUSE = 0.05
+MEDIA_DIR = os.path.join("uploads", "broadcasts")
+MEDIA_GRACE = 3600
+# сколько пользователей просматривает один запрос при поиске неактивных
+PRUNE_SCAN_WINDOW = 1000
+# сколько строк каждого индекса читает ANALYZE
+ANALYSIS_LIMIT = 400
+
+_META_KEY = "housekeeping_at"
+
+
+def _parse_hours(value: str) -> Optional[Tuple[int, int]]:
+    value = value.strip()
+    if not value:
+        return None
+    try:
+        start, end = (int(part) % 24 for part in value.split("-"))
+    except ValueError:
+        raise RuntimeError("HOUSEKEEPING_HOURS должен быть вида 3-6") from None
+    return start, end
+
+
+_hours = _parse_hours(HOUSEKEEPING_HOURS)
+
+_task: Optional["asyncio.Task[None]"] = None
+
+
+def in_window(now: Optional[float] = None) -> bool:
+    """Сейчас часы уборки? "0-24" (и вообще с == по) - круглые сутки."""
+    if _hours is None:
+        return True
+    start, end = _hours
+    hour = time.localtime(now).tm_hour
+    if start == end:
+        return True
+    if start < end:
+        return start <= hour < end
+    return hour >= start or hour < end
+
+
+class _Batch:
+    """Размер порции, при котором шаг укладывается в STEP_BUDGET."""
+
+    def __init__(self, size: int, low: int, high: int) -> None:
+        self.size = size
+        self.low = low
+        self.high = high
+
+    async def step(self, job: str, op: Awaitable[int]) -> int:
+        started = time.perf_counter()
+        result = await op
+        elapsed = time.perf_counter() - started
+        metrics.HOUSEKEEPING_STEP.observe(elapsed, job)
+        if elapsed > STEP_BUDGET:
+            self.size = max(self.low, self.size // 2)
+        elif elapsed < STEP_BUDGET / 2:
+            self.size = min(self.high, self.size * 2)
+        await asyncio.sleep(STEP_PAUSE)
+        return result
+
+
+# ---------- Jobs ----------
+#
+# Каждая задача работает, пока keep_going() возвращает True,
+# и возвращает, сколько всего убрала.
+
+async def prune_inactive(keep_going: Callable[[], bool]) -> int:
+    if PRUNE_INACTIVE_DAYS <= 0:
+        return 0
+    cutoff = int(time.time()) - PRUNE_INACTIVE_DAYS * 86400
+    batch = _Batch(20, 5, 1000)
+    pruned = 0
+    after: Optional[int] = 0
+    while after is not None and keep_going():
+        candidates, after = await db.find_inactive_players(cutoff, after, PRUNE_SCAN_WINDOW)
+        while candidates and keep_going():
+            chunk, candidates = candidates[:batch.size], candidates[batch.size:]
+            pruned += await batch.step("prune", db.prune_progress(chunk, cutoff))
+    return pruned
+
+
+def _scan_media(cutoff: float) -> List[str]:
+    """Файлы в MEDIA_DIR, не менявшиеся с cutoff."""
+    found = []
+    for root, _dirs, files in os.walk(MEDIA_DIR):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                if os.stat(path).st_mtime < cutoff:
+                    found.append(os.path.normpath(path))
+            except FileNotFoundError:
+                pass
+    return found
+
+
+def _remove_files(paths: List[str]) -> int:
+    removed = 0
+    for path in paths:
+        try:
+            os.remove(path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+def _remove_empty_dirs(cutoff: float) -> None:
+    # снизу вверх: папки sha256 пустеют раньше photo/video/file, а те - раньше папки рассылки
+    for root, _dirs, _files in os.walk(MEDIA_DIR, topdown=False):
+        if os.path.normpath(root) == os.path.normpath(MEDIA_DIR):
+            continue
+        try:
+            # свежую папку могла только что создать загрузка
+            if not os.listdir(root) and os.stat(root).st_mtime < cutoff:
+                os.rmdir(root)
+        except OSError:
+            pass
+
+
+async def collect_media(keep_going: Callable[[], bool]) -> int:
+    cutoff = time.time() - MEDIA_GRACE
+    old = await asyncio.to_thread(_scan_media, cutoff)
+    batch = _Batch(50, 10, 500)
+    removed = 0
+
+    async def remove(chunk: List[str]) -> int:
+        # ссылки перечитываем перед каждой порцией: файл мог подхватить
+        # новая рассылка (одинаковые файлы хранятся один раз, по sha256)
+        used = await db.list_broadcast_file_paths()
+        return await asyncio.to_thread(_remove_files, [p for p in chunk if p not in used])
+
+    while old and keep_going():
+        chunk, old = old[:batch.size], old[batch.size:]
+        removed += await batch.step("media", remove(chunk))
+    if not old:
+        await asyncio.to_thread(_remove_empty_dirs, cutoff)
+    return removed
+
+
+_warned_auto_vacuum = False
+
+
+async def vacuum(keep_going: Callable[[], bool]) -> int:
+    global _warned_auto_vacuum
+    mode, free = await db.get_free_pages()
+    if mode != 2:
+        if free and not _warned_auto_vacuum:
+            _warned_auto_vacuum = True
+            logger.warning(
+                "Database has %s free pages but auto_vacuum is not INCREMENTAL; "
+                "run a one-time VACUUM to enable it (see README)", free,
+            )
+        return 0
+    batch = _Batch(64, 8, 4096)
+    freed = 0
+    while free and keep_going():
+        left = await batch.step("vacuum", db.incremental_vacuum(min(batch.size, free)))
+        freed += max(0, free - left)
+        free = left
+    return freed
+
+
+async def analyze(keep_going: Callable[[], bool]) -> int:
+    batch = _Batch(1, 1, 1)
+    done = 0
+    for table in await db.list_tables():
+        if not keep_going():
+            return done
+        await batch.step("analyze", db.analyze_table(table, ANALYSIS_LIMIT))
+        done += 1
+    await batch.step("analyze", db.optimize_database(ANALYSIS_LIMIT))
+    return done
+
+
+JOBS: Dict[str, Callable[[Callable[[], bool]], Awaitable[int]]] = {
+    "prune": prune_inactive,
+    "media": collect_media,
+    "vacuum": vacuum,
+    "analyze": analyze,
+}
+
+_unknown = [job for job in HOUSEKEEPING_JOBS if job not in JOBS]
+if _unknown:
+    raise RuntimeError(
+        f"Неизвестные задачи в HOUSEKEEPING_JOBS: {', '.join(_unknown)} "
+        f"(есть {', '.join(JOBS)})"
+    )
+
+
+# ---------- Scheduler ----------
+
+async def run_once(
+    jobs: List[str] = HOUSEKEEPING_JOBS,
+    keep_going: Callable[[], bool] = in_window,
+) -> Dict[str, int]:
+    """Выполнить задачи по очереди. Упавшая задача не мешает следующим."""
+    results: Dict[str, int] = {}
+    for job in jobs:
+        if not keep_going():
+            break
+        started = time.monotonic()
+        try:
+            count = await JOBS[job](keep_going)
+        except Exception:
+            logger.exception("Housekeeping job %s failed", job)
+            continue
+        results[job] = count
+        metrics.HOUSEKEEPING_ITEMS.inc(job, amount=count)
+        logger.info(
+            "Housekeeping %s: %s item(s) in %.1fs", job, count, time.monotonic() - started
+        )
+    return results
+
+
+async def _loop() -> None:
+    while True:
+        await asyncio.sleep(CHECK_INTERVAL)
+        if not in_window():
+            continue
+        try:
+            last = await db.get_meta(_META_KEY) or 0
+            if time.time() - last < MIN_INTERVAL:
+                continue
+            # отмечаем заранее: упавшая уборка не перезапускается каждую минуту
+            await db.set_meta(_META_KEY, int(time.time()))
+            await run_once()
+        except Exception:
+            logger.exception("Housekeeping run failed")
+
+
+def start() -> None:
+    global _task
+    if _task is None and HOUSEKEEPING_JOBS:
+        _task = asyncio.create_task(_loop())
+
+
+async def stop() -> None:
+    global _task
+    if _task is not None:
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions=True)
+        _task = None
@@ -0,0 +1,347 @@
+"""
+Связь админки с процессами бота в режиме PROCESS_MODE=split (см. supervisor.py).
+
+Unix-сокет, по строке JSON на сообщение. Сервер (Hub) - в процессе админки,
+воркеры бота подключаются к нему и переподключаются, если связь пропала.
+
+- запрос админки: {"id": 1, "op": "tracks_changed", ...}
+- ответ воркера:  {"reply": 1, "ok": true, "result": ...}
+- событие воркера (без ответа): {"event": "broadcasts", ...}
+
+Команды воркерам: tracks_changed, db_suspend / db_resume (подмена базы
+при restore), broadcast_start / broadcast_cancel / broadcast_stop_all /
+broadcast_resume (рассылки крутятся в воркере 0, а не в админке).
+"""
+import asyncio
+import itertools
+import json
+import logging
+import os
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+IPC_SOCKET = os.getenv("IPC_SOCKET", "kazoo-ipc.sock")
+CALL_TIMEOUT = 30.0
+RECONNECT_DELAY = 1.0
+# воркер, в котором идут рассылки
+PRIMARY_WORKER = 0
+
+Handler = Callable[[Dict[str, Any]], Awaitable[Any]]
+
+
+class IPCError(Exception):
+    """Воркер недоступен или вернул ошибку."""
+
+
+async def _send(writer: asyncio.StreamWriter, message: Dict[str, Any]) -> None:
+    writer.write(json.dumps(message, ensure_ascii=False).encode() + b"\n")
+    await writer.drain()
+
+
+# ---------- Hub (процесс админки) ----------
+
+class _Peer:
+    def __init__(self, worker: int, writer: asyncio.StreamWriter) -> None:
+        self.worker = worker
+        self.writer = writer
+        self.pending: Dict[int, asyncio.Future] = {}
+
+
+class Hub:
+    def __init__(self, workers: int, path: str = IPC_SOCKET) -> None:
+        # сколько воркеров бота запустил supervisor (0 .. workers-1)
+        self.workers = workers
+        self.path = path
+        self.peers: Dict[int, _Peer] = {}
+        self._ids = itertools.count(1)
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._event_handlers: Dict[str, Callable[[int, Dict[str, Any]], None]] = {}
+        # пока база подменяется, новые воркеры ждут с подключением
+        self._swap_lock = asyncio.Lock()
+
+    async def start(self) -> None:
+        try:
+            os.remove(self.path)  # сокет от прошлого запуска
+        except FileNotFoundError:
+            pass
+        self._server = await asyncio.start_unix_server(self._client, path=self.path)
+        logger.info("IPC hub listening on %s", self.path)
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        for peer in list(self.peers.values()):
+            peer.writer.close()
+
+    def on_event(self, event: str, handler: Callable[[int, Dict[str, Any]], None]) -> None:
+        self._event_handlers[event] = handler
+
+    async def _client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        peer: Optional[_Peer] = None
+        try:
+            hello = json.loads(await reader.readline() or b"{}")
+            if hello.get("op") != "hello":
+                return
+            async with self._swap_lock:
+                peer = _Peer(int(hello["worker"]), writer)
+                old = self.peers.get(peer.worker)
+                if old is not None:
+                    old.writer.close()
+                self.peers[peer.worker] = peer
+                await _send(writer, {"op": "welcome"})
+            logger.info("Bot worker %s connected (pid %s)", peer.worker, hello.get("pid"))
+
+            while line := await reader.readline():
+                message = json.loads(line)
+                if "reply" in message:
+                    fut = peer.pending.pop(message["reply"], None)
+                    if fut is not None and not fut.done():
+                        if message.get("ok"):
+                            fut.set_result(message.get("result"))
+                        else:
+                            fut.set_exception(IPCError(message.get("error", "ошибка воркера")))
+                elif "event" in message:
+                    handler = self._event_handlers.get(message["event"])
+                    if handler is not None:
+                        handler(peer.worker, message)
+        except (ConnectionError, ValueError, KeyError) as e:
+            logger.warning("IPC connection error: %s", e)
+        finally:
+            writer.close()
+            if peer is not None:
+                if self.peers.get(peer.worker) is peer:
+                    del self.peers[peer.worker]
+                for fut in peer.pending.values():
+                    if not fut.done():
+                        fut.set_exception(IPCError(f"воркер {peer.worker} отключился"))
+                logger.info("Bot worker %s disconnected", peer.worker)
+
+    async def call(self, worker: int, op: str, timeout: float = CALL_TIMEOUT, **data: Any) -> Any:
+        peer = self.peers.get(worker)
+        if peer is None:
+            raise IPCError(f"воркер {worker} не подключен")
+        request_id = next(self._ids)
+        fut = asyncio.get_running_loop().create_future()
+        peer.pending[request_id] = fut
+        try:
+            await _send(peer.writer, {"id": request_id, "op": op, **data})
+            return await asyncio.wait_for(fut, timeout)
+        finally:
+            peer.pending.pop(request_id, None)
+
+    async def broadcast(self, op: str, **data: Any) -> Dict[int, Any]:
+        """Отправить команду всем подключенным воркерам, ошибки - в лог."""
+        workers = list(self.peers)
+        results = await asyncio.gather(
+            *(self.call(worker, op, **data) for worker in workers),
+            return_exceptions=True,
+        )
+        for worker, result in zip(workers, results):
+            if isinstance(result, Exception):
+                logger.warning("IPC %s failed on worker %s: %s", op, worker, result)
+        return dict(zip(workers, results))
+
+    def missing_workers(self) -> List[int]:
+        """Воркеры, которых сейчас нет на связи (например, стартовали без IPC)."""
+        return [worker for worker in range(self.workers) if worker not in self.peers]
+
+    async def suspend_workers(self) -> None:
+        """
+        Перед подменой базы: воркеры закрывают соединения и ждут db_resume.
+        Если хоть один воркер не на связи или не подтвердил - IPCError,
+        уже закрывшие базу воркеры возобновляются, подменять файл нельзя.
+        """
+        await self._swap_lock.acquire()
+        try:
+            missing = self.missing_workers()
+            if missing:
+                raise IPCError(f"воркеры {missing} не на связи")
+            results = await self.broadcast("db_suspend")
+            failed = [worker for worker, result in results.items() if isinstance(result, Exception)]
+            if failed:
+                # db_resume без db_suspend ничего не делает, поэтому шлем всем:
+                # воркер с истекшим таймаутом мог все же закрыть базу, а команды
+                # он выполняет по очереди - db_resume придет после db_suspend
+                await self.broadcast("db_resume")
+                raise IPCError(f"воркеры {failed} не закрыли базу")
+        except BaseException:
+            self._swap_lock.release()
+            raise
+
+    async def resume_workers(self) -> None:
+        try:
+            await self.broadcast("db_resume")
+        finally:
+            self._swap_lock.release()
+
+
+class _RemoteJob:
+    def __init__(self, data: Dict[str, Any]) -> None:
+        self.data = data
+
+    @property
+    def status(self) -> str:
+        return self.data.get("status", "running")
+
+    def as_dict(self) -> Dict[str, Any]:
+        return dict(self.data)
+
+
+class RemoteBroadcastEngine:
+    """
+    То же, что BroadcastEngine, для админки в режиме split: рассылки идут
+    в воркере PRIMARY_WORKER, состояние приходит оттуда событием broadcasts.
+    """
+
+    def __init__(self, hub: Hub) -> None:
+        self.hub = hub
+        self.jobs: Dict[int, _RemoteJob] = {}
+        self._running: Set[int] = set()
+        self._tasks: Set["asyncio.Task[Any]"] = set()
+        hub.on_event("broadcasts", self._on_progress)
+
+    def _on_progress(self, _worker: int, message: Dict[str, Any]) -> None:
+        for data in message.get("jobs", []):
+            self.jobs[data["id"]] = _RemoteJob(data)
+        self._running = set(message.get("running", []))
+
+    async def _call(self, op: str, **data: Any) -> Any:
+        return await self.hub.call(PRIMARY_WORKER, op, **data)
+
+    def start(self, job: Any) -> int:
+        self._running.add(job.id)
+        # журнал доставки уже в базе: если воркер сейчас недоступен,
+        # он подхватит рассылку сам через resume() при старте
+        task = asyncio.create_task(self._call("broadcast_start", broadcast_id=job.id))
+        self._tasks.add(task)
+        task.add_done_callback(self._done)
+        return job.id
+
+    def _done(self, task: "asyncio.Task[Any]") -> None:
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("Failed to hand broadcast to worker: %s", task.exception())
+
+    def get(self, job_id: int) -> Optional[_RemoteJob]:
+        return self.jobs.get(job_id)
+
+    def is_running(self, job_id: int) -> bool:
+        return job_id in self._running
+
+    async def cancel(self, job_id: int) -> None:
+        self._running.discard(job_id)
+        try:
+            await self._call("broadcast_cancel", broadcast_id=job_id)
+        except (IPCError, asyncio.TimeoutError) as e:
+            logger.warning("Failed to cancel broadcast #%s: %s", job_id, e)
+
+    async def stop(self) -> None:
+        self._running.clear()
+        try:
+            await self._call("broadcast_stop_all")
+        except (IPCError, asyncio.TimeoutError) as e:
+            logger.warning("Failed to stop broadcasts: %s", e)
+
+    async def resume(self) -> None:
+        try:
+            await self._call("broadcast_resume")
+        except (IPCError, asyncio.TimeoutError) as e:
+            logger.warning("Failed to resume broadcasts: %s", e)
+
+
+# ---------- Worker (процесс бота) ----------
+
+class WorkerLink:
+    """Подключение воркера к админке. handlers: op -> корутина(message) -> результат."""
+
+    def __init__(self, worker: int, path: str = IPC_SOCKET) -> None:
+        self.worker = worker
+        self.path = path
+        self.handlers: Dict[str, Handler] = {}
+        # при (пере)подключении - догнать то, что пропустили без связи
+        self.on_connect: Optional[Callable[[], Awaitable[None]]] = None
+        # при потере связи - например, снять db_suspend
+        self.on_disconnect: Optional[Callable[[], Awaitable[None]]] = None
+        self.connected = asyncio.Event()
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._task: Optional["asyncio.Task[None]"] = None
+
+    def handle(self, op: str, handler: Handler) -> None:
+        self.handlers[op] = handler
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def event(self, event: str, **data: Any) -> None:
+        """Отправить событие админке; без связи - просто пропускаем."""
+        if self._writer is None:
+            return
+        try:
+            await _send(self._writer, {"event": event, **data})
+        except ConnectionError:
+            pass
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path)
+            except OSError:
+                await asyncio.sleep(RECONNECT_DELAY)
+                continue
+            try:
+                await _send(writer, {"op": "hello", "worker": self.worker, "pid": os.getpid()})
+                welcome = json.loads(await reader.readline() or b"{}")
+                if welcome.get("op") != "welcome":
+                    raise ConnectionError("нет ответа от админки")
+                self._writer = writer
+                self.connected.set()
+                await self._callback(self.on_connect)
+                while line := await reader.readline():
+                    # команды выполняются по очереди: db_suspend/db_resume
+                    # не должны обгонять друг друга
+                    await self._dispatch(writer, json.loads(line))
+            except (ConnectionError, ValueError) as e:
+                logger.warning("IPC link lost: %s", e)
+            finally:
+                self._writer = None
+                self.connected.clear()
+                writer.close()
+            await self._callback(self.on_disconnect)
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    async def _callback(self, callback: Optional[Callable[[], Awaitable[None]]]) -> None:
+        if callback is None:
+            return
+        try:
+            await callback()
+        except Exception:
+            logger.exception("IPC link callback failed")
+
+    async def _dispatch(self, writer: asyncio.StreamWriter, message: Dict[str, Any]) -> None:
+        handler = self.handlers.get(message.get("op", ""))
+        try:
+            if handler is None:
+                raise IPCError(f"неизвестная команда {message.get('op')!r}")
+            reply = {"reply": message["id"], "ok": True, "result": await handler(message)}
+        except Exception as e:
+            logger.exception("IPC command %s failed", message.get("op"))
+            reply = {"reply": message["id"], "ok": False, "error": str(e)}
+        await _send(writer, reply)
+
+
+async def wait_connected(link: WorkerLink, timeout: Optional[float] = None) -> bool:
+    try:
+        await asyncio.wait_for(link.connected.wait(), timeout)
+    except asyncio.TimeoutError:
+        return False
+    return True
+
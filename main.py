@@ -1,12 +1,16 @@
 import asyncio
 import logging
 import os
+import socket
 import traceback
 import html
+from typing import Optional, Tuple
 
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher, Router, F
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.enums import ParseMode
 from aiogram.filters import CommandStart, Command
 from aiogram.types import (
@@ -14,18 +18,31 @@ from aiogram.types import (
     CallbackQuery,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
-    FSInputFile,  # <-- добавили
 )
 import uvicorn
 
 from db import (
     init_db,
-    add_user,
-    get_random_track_for_user,
-    mark_track_used,
-    clear_used_tracks,
+    close_db,
+    get_meta,
+    set_meta,
+    on_database_swap,
+    refresh_tracks_version,
+    resume_database,
+    suspend_database,
 )
-from admin_web import create_app
+from decks import new_deck, draw_track
+import antiflood
+import catalog
+import dispatch
+import housekeeping
+import ipc
+import users
+import media
+import metrics
+import supervisor
+from admin_web import WEBHOOK_PATH, create_app, create_webhook_app
+from broadcaster import BroadcastEngine
 import messages as msg
 
 POINT_EMOJIS = {
@@ -34,6 +51,9 @@ POINT_EMOJIS = {
     3: "3️⃣",
 }
 
+WELCOME_PHOTO = "kazoo.jpg"  # файл лежит рядом с main.py
+WELCOME_FILE_ID_KEY = "welcome_photo_file_id"
+
 # ---------- ENV ----------
 load_dotenv()
 
@@ -41,6 +61,24 @@ TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
 if not TOKEN:
     raise RuntimeError("TELEGRAM_BOT_TOKEN не задан")
 
+# WEBHOOK_URL - публичный адрес приложения (https://...): если задан,
+# бот получает апдейты через webhook, иначе через long polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip()
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip()
+if WEBHOOK_URL and not WEBHOOK_SECRET:
+    raise RuntimeError("Для WEBHOOK_URL нужно задать WEBHOOK_SECRET")
+# другой адрес Bot API (локальный сервер или fake_telegram.py)
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "").strip()
+
+# single - бот и админка в одном процессе; split - supervisor.py запускает
+# админку и процессы бота отдельно (тяжелые действия в админке не тормозят игроков)
+PROCESS_MODE = os.getenv("PROCESS_MODE", "single").strip().lower()
+# роль процесса в режиме split, ее выставляет supervisor.py: web / bot
+PROCESS_ROLE = os.getenv("PROCESS_ROLE", "")
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", "0"))
+# в режиме split + webhook воркеры бота принимают апдейты на этом порту
+BOT_PORT = int(os.getenv("BOT_PORT", "8081"))
+
 # Можно указать ID админов, если потом решим что-то делать с ними
 ADMIN_IDS = {
     int(x)
@@ -63,68 +101,53 @@ logger = logging.getLogger(__name__)
 
 
 # ---------- Keyboards ----------
-def start_keyboard() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(
-        inline_keyboard=[
-            [
-                InlineKeyboardButton(text="▶️ Поехали", callback_data="go"),
-                InlineKeyboardButton(text="❓ Помощь", callback_data="help"),
-            ]
+# Клавиатуры не меняются - собираем их один раз и переиспользуем
+# (pydantic-модели не строятся и не валидируются на каждое нажатие).
+# Это общие экземпляры: не изменять.
+START_KEYBOARD = InlineKeyboardMarkup(
+    inline_keyboard=[
+        [
+            InlineKeyboardButton(text="▶️ Поехали", callback_data="go"),
+            InlineKeyboardButton(text="❓ Помощь", callback_data="help"),
         ]
-    )
-
+    ]
+)
 
-def game_keyboard() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(
-        inline_keyboard=[
-            [
-                InlineKeyboardButton(
-                    text="⏭️ Следующая песня", callback_data="next"
-                ),
-                InlineKeyboardButton(
-                    text="🔁 Начать сначала", callback_data="restart"
-                ),
-            ]
+GAME_KEYBOARD = InlineKeyboardMarkup(
+    inline_keyboard=[
+        [
+            InlineKeyboardButton(
+                text="⏭️ Следующая песня", callback_data="next"
+            ),
+            InlineKeyboardButton(
+                text="🔁 Начать сначала", callback_data="restart"
+            ),
         ]
-    )
-
+    ]
+)
 
-def restart_cycle_keyboard() -> InlineKeyboardMarkup:
-    """Клавиатура, когда пользователь прошел все треки."""
-    return InlineKeyboardMarkup(
-        inline_keyboard=[
-            [
-                InlineKeyboardButton(
-                    text="🔁 Начнем заново?", callback_data="restart_all"
-                ),
-            ]
+# когда пользователь прошел все треки
+RESTART_CYCLE_KEYBOARD = InlineKeyboardMarkup(
+    inline_keyboard=[
+        [
+            InlineKeyboardButton(
+                text="🔁 Начнем заново?", callback_data="restart_all"
+            ),
         ]
-    )
+    ]
+)
 
 
 # ---------- Bot handlers ----------
 router = Router()
+# время и ошибки по каждому хендлеру (cmd_start, cb_game, ...) для /metrics
+router.message.middleware(metrics.HandlerMetricsMiddleware())
+router.callback_query.middleware(metrics.HandlerMetricsMiddleware())
 
 
-async def _send_random_track(message: Message, user_id: int):
-    """
-    Отправить случайный трек пользователю:
-    - без повторов, пока не закончатся все активные треки;
-    - если треки закончились - показать поздравление и кнопку 'Начнем заново?'.
-    """
-    track = await get_random_track_for_user(user_id)
-    if not track:
-        # нет ни одного нового трека для этого пользователя
-        await message.answer(
-            "Поздравляем, вы сыграли все треки! 🏁",
-            reply_markup=restart_cycle_keyboard(),
-        )
-        return
-
-    _id, title, points, hint, is_active, created_at = track
-
-    # отмечаем трек как уже показанный этому пользователю
-    await mark_track_used(user_id, _id)
+def _render_card(track: Tuple[int, str, int, Optional[str]]) -> str:
+    """HTML-карточка трека (кэшируется в catalog до изменения трека)."""
+    _id, title, points, hint = track
 
     # экранируем спецсимволы, чтобы не ломали HTML
     title_safe = html.escape(title)
@@ -134,40 +157,73 @@ async def _send_random_track(message: Message, user_id: int):
     points_emoji = POINT_EMOJIS.get(points, str(points))
 
     if hint_safe:
-        text = (
+        return (
             f"🎵 <b>{title_safe}</b>\n\n"
             f"Количество баллов: <b>{points_emoji}</b>\n\n"
             f"💬 Подсказка: <span class=\"tg-spoiler\">{hint_safe}</span>"
         )
-    else:
-        text = (
-            f"🎵 <b>{title_safe}</b>\n\n"
-            f"Количество баллов: <b>{points_emoji}</b>"
+    return (
+        f"🎵 <b>{title_safe}</b>\n\n"
+        f"Количество баллов: <b>{points_emoji}</b>"
+    )
+
+
+async def _send_random_track(message: Message, user_id: int):
+    """
+    Отправить следующий трек из колоды пользователя:
+    - без повторов, пока не закончатся все активные треки;
+    - если треки закончились - показать поздравление и кнопку 'Начнем заново?'.
+    """
+    track = await draw_track(user_id)
+    if not track:
+        # нет ни одного нового трека для этого пользователя
+        await message.answer(
+            "Поздравляем, вы сыграли все треки! 🏁",
+            reply_markup=RESTART_CYCLE_KEYBOARD,
         )
+        return
+
+    # трек уже отмечен как показанный: выдача из колоды атомарна;
+    # готовый текст карточки берем из кэша каталога
+    text = (await catalog.load()).card(track, _render_card)
 
     await message.answer(
         text,
-        reply_markup=game_keyboard(),
+        reply_markup=GAME_KEYBOARD,
         parse_mode="HTML",  # принудительно включаем HTML
     )
 
 
+async def _load_welcome_file_id() -> None:
+    if welcome_file_id := await get_meta(WELCOME_FILE_ID_KEY):
+        media.remember("photo", WELCOME_PHOTO, welcome_file_id)
+
+
+async def _save_welcome_file_id(_path: str, file_id: Optional[str]) -> None:
+    await set_meta(WELCOME_FILE_ID_KEY, file_id)
+
+
 @router.message(CommandStart())
 async def cmd_start(message: Message):
-    await add_user(message.from_user.id, message.from_user.username)
+    users.remember(message.from_user.id, message.from_user.username)
 
     # пробуем отправить приветствие с картинкой
+    # (загружаем ее один раз, дальше отправляем по file_id)
     try:
-        photo = FSInputFile("kazoo.jpg")  # файл лежит рядом с main.py
-        await message.answer_photo(
-            photo=photo,
-            caption=msg.START_TEXT,
-            reply_markup=start_keyboard(),
+        await media.send_file(
+            "photo",
+            WELCOME_PHOTO,
+            lambda photo: message.answer_photo(
+                photo=photo,
+                caption=msg.START_TEXT,
+                reply_markup=START_KEYBOARD,
+            ),
+            save=_save_welcome_file_id,
         )
     except Exception as e:
         # если что-то пошло не так (нет файла, ошибка пути и т.п.) - просто отправим текст
         logger.warning("Failed to send welcome photo: %s", e)
-        await message.answer(msg.START_TEXT, reply_markup=start_keyboard())
+        await message.answer(msg.START_TEXT, reply_markup=START_KEYBOARD)
 
 
 @router.message(Command("help"))
@@ -183,11 +239,14 @@ async def cb_help(cb: CallbackQuery):
 
 @router.callback_query(F.data.in_(["go", "next", "restart"]))
 async def cb_game(cb: CallbackQuery):
-    await add_user(cb.from_user.id, cb.from_user.username)
+    users.remember(cb.from_user.id, cb.from_user.username)
 
-    # Если пользователь нажал "Начать сначала" - очищаем его прогресс
-    if cb.data == "restart":
-        await clear_used_tracks(cb.from_user.id)
+    # "Поехали" - новая колода без уже сыгранных треков,
+    # "Начать сначала" - новая колода с очисткой прогресса
+    if cb.data == "go":
+        await new_deck(cb.from_user.id, reset=False)
+    elif cb.data == "restart":
+        await new_deck(cb.from_user.id, reset=True)
 
     try:
         await _send_random_track(cb.message, cb.from_user.id)
@@ -203,8 +262,8 @@ async def cb_restart_all(cb: CallbackQuery):
     Обработчик кнопки 'Начнем заново?' после того,
     как пользователь прошел все треки.
     """
-    await add_user(cb.from_user.id, cb.from_user.username)
-    await clear_used_tracks(cb.from_user.id)
+    users.remember(cb.from_user.id, cb.from_user.username)
+    await new_deck(cb.from_user.id, reset=True)
     try:
         await _send_random_track(cb.message, cb.from_user.id)
     except Exception:
@@ -219,30 +278,242 @@ async def run_bot(bot: Bot, dp: Dispatcher):
     await dp.start_polling(bot)
 
 
-async def run_web(bot: Bot):
-    app = create_app(bot)
+async def run_web(bot: Bot, dp: Optional[Dispatcher] = None, hub: Optional[ipc.Hub] = None):
+    app = create_app(bot, dp, WEBHOOK_SECRET, hub)
     port = int(os.getenv("PORT", "8080"))
     config = uvicorn.Config(app, host="0.0.0.0", port=port, log_level="info")
     server = uvicorn.Server(config)
     await server.serve()
 
 
-async def main():
-    os.makedirs("uploads", exist_ok=True)
-    await init_db()
+async def run_webhook_worker(bot: Bot, dp: Dispatcher):
+    """Прием webhook в воркере: все воркеры слушают BOT_PORT, ядро делит соединения."""
+    app = create_webhook_app(bot, dp, WEBHOOK_SECRET)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(("0.0.0.0", BOT_PORT))
+    config = uvicorn.Config(app, log_level="warning")
+    server = uvicorn.Server(config)
+    await server.serve(sockets=[sock])
 
+
+def _make_bot() -> Bot:
+    session = None
+    if TELEGRAM_API_BASE:
+        # локальный Bot API сервер или fake_telegram.py для тестов
+        session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_BASE))
     bot = Bot(
         token=TOKEN,
+        session=session,
         default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN),
     )
+    bot.session.middleware(metrics.TelegramMetricsMiddleware())
+    return bot
+
+
+def _make_dispatcher(bot: Bot) -> Dispatcher:
     dp = Dispatcher()
     dp.include_router(router)
+    # повторные "Следующая песня" подряд схлопываются при получении, до очереди
+    dp.update.outer_middleware(antiflood.AntiFloodMiddleware())
+    # апдейты одного игрока - по очереди, разных - параллельно, с пределом
+    dispatch.install(dp, bot)
+    return dp
+
+
+async def _init_bot_state():
+    os.makedirs("uploads", exist_ok=True)
+    await init_db()
+    await catalog.load()
+    await users.load()
+    users.start()
+    await _load_welcome_file_id()
+    # после восстановления бэкапа file_id и пользователей берем уже из новой базы
+    on_database_swap(_load_welcome_file_id)
+    on_database_swap(users.load)
+
+
+async def _set_webhook(bot: Bot, dp: Dispatcher):
+    await bot.set_webhook(
+        WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+    logger.info("Webhook mode: %s%s", WEBHOOK_URL.rstrip("/"), WEBHOOK_PATH)
+
+
+async def main():
+    """Бот и админка в одном процессе (PROCESS_MODE=single)."""
+    await _init_bot_state()
+    bot = _make_bot()
+    dp = _make_dispatcher(bot)
+    lag_task = asyncio.create_task(metrics.monitor_loop_lag())
+    housekeeping.start()
+
+    try:
+        if WEBHOOK_URL:
+            # апдейты приходят POST-запросами в то же FastAPI-приложение
+            await _set_webhook(bot, dp)
+            await run_web(bot, dp)
+        else:
+            await bot.delete_webhook()
+            bot_task = asyncio.create_task(run_bot(bot, dp))
+            web_task = asyncio.create_task(run_web(bot))
+            await asyncio.gather(bot_task, web_task)
+    finally:
+        lag_task.cancel()
+        await housekeeping.stop()
+        await users.stop()
+        await close_db()
+
+
+# ---------- Split mode ----------
+
+async def main_web():
+    """Процесс админки в режиме split: апдейты бота сюда не приходят."""
+    os.makedirs("uploads", exist_ok=True)
+    await init_db()
+    bot = _make_bot()
+    hub = ipc.Hub(supervisor.BOT_WORKERS)
+    await hub.start()
+    lag_task = asyncio.create_task(metrics.monitor_loop_lag())
+    # уборка - только здесь, воркеры бота ее не запускают
+    housekeeping.start()
+    try:
+        await run_web(bot, hub=hub)
+    finally:
+        lag_task.cancel()
+        await housekeeping.stop()
+        await hub.stop()
+        await bot.session.close()
+        await close_db()
+
+
+def _worker_db_commands(link: ipc.WorkerLink):
+    """
+    db_suspend / db_resume: регистрируются до подключения к админке, чтобы
+    restore не застал воркер без них. Если база еще не открыта, db_suspend
+    отвечает ошибкой, и админка отменяет restore.
+    """
+    suspended = False
+
+    async def db_suspend(_message):
+        nonlocal suspended
+        if not suspended:
+            await suspend_database()
+            suspended = True
+
+    async def db_resume(_message=None):
+        nonlocal suspended
+        if suspended:
+            suspended = False
+            # до resume: его хуки загружают file_id приветствия уже из новой базы
+            media.clear()
+            # версию каталога уже подняла админка, берем ее из новой базы
+            await resume_database(bump=False)
+            await refresh_tracks_version()
+
+    link.handle("db_suspend", db_suspend)
+    link.handle("db_resume", db_resume)
+    # админка пропала посреди restore - не оставляем базу закрытой навсегда
+    link.on_disconnect = db_resume
+
+
+def _worker_commands(link: ipc.WorkerLink, engine: Optional[BroadcastEngine]):
+    """Остальные команды, которые админка присылает воркеру бота по IPC."""
+
+    async def tracks_changed(_message=None):
+        await refresh_tracks_version()
+
+    async def users_flush(_message):
+        await users.flush()
+
+    link.handle("tracks_changed", tracks_changed)
+    link.handle("users_flush", users_flush)
+    # без связи могли пропустить изменения каталога
+    link.on_connect = tracks_changed
+
+    if engine is None:
+        return
 
-    bot_task = asyncio.create_task(run_bot(bot, dp))
-    web_task = asyncio.create_task(run_web(bot))
+    async def broadcast_start(message):
+        return await engine.start_saved(message["broadcast_id"])
 
-    await asyncio.gather(bot_task, web_task)
+    async def broadcast_cancel(message):
+        await engine.cancel(message["broadcast_id"])
+
+    async def broadcast_stop_all(_message):
+        await engine.stop()
+        engine.jobs.clear()
+
+    async def broadcast_resume(_message):
+        await engine.resume()
+
+    link.handle("broadcast_start", broadcast_start)
+    link.handle("broadcast_cancel", broadcast_cancel)
+    link.handle("broadcast_stop_all", broadcast_stop_all)
+    link.handle("broadcast_resume", broadcast_resume)
+
+
+async def _report_broadcasts(link: ipc.WorkerLink, engine: BroadcastEngine):
+    """Состояние рассылок для страниц админки - раз в секунду."""
+    while True:
+        await asyncio.sleep(1.0)
+        await link.event(
+            "broadcasts",
+            jobs=[job.as_dict() for job in engine.jobs.values()],
+            running=[job_id for job_id in engine.jobs if engine.is_running(job_id)],
+        )
+
+
+async def main_bot_worker():
+    """Процесс бота в режиме split: апдейты и (в воркере 0) рассылки."""
+    primary = WORKER_INDEX == ipc.PRIMARY_WORKER
+    link = ipc.WorkerLink(WORKER_INDEX)
+    _worker_db_commands(link)
+    link.start()
+    # если админка сейчас подменяет базу, она отпустит воркер после подмены
+    if not await ipc.wait_connected(link, timeout=5.0):
+        logger.warning("Admin process is not reachable, starting without IPC")
+
+    await _init_bot_state()
+    bot = _make_bot()
+    dp = _make_dispatcher(bot)
+    engine = BroadcastEngine(bot) if primary else None
+    _worker_commands(link, engine)
+    tasks = [asyncio.create_task(metrics.monitor_loop_lag())]
+    if engine is not None:
+        await engine.resume()
+        tasks.append(asyncio.create_task(_report_broadcasts(link, engine)))
+
+    try:
+        if WEBHOOK_URL:
+            if primary:
+                await _set_webhook(bot, dp)
+            await run_webhook_worker(bot, dp)
+        else:
+            # getUpdates может вызывать только один процесс
+            await bot.delete_webhook()
+            await run_bot(bot, dp)
+    finally:
+        for task in tasks:
+            task.cancel()
+        if engine is not None:
+            await engine.stop()
+        await link.stop()
+        await users.stop()
+        await close_db()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if PROCESS_ROLE == "web":
+        asyncio.run(main_web())
+    elif PROCESS_ROLE == "bot":
+        asyncio.run(main_bot_worker())
+    elif PROCESS_MODE == "split":
+        # при long polling апдейты получает только один процесс
+        workers = supervisor.BOT_WORKERS if WEBHOOK_URL else 1
+        asyncio.run(supervisor.run(os.path.abspath(__file__), workers))
+    else:
+        asyncio.run(main())
@@ -0,0 +1,146 @@
+"""
+Кэш Telegram file_id для локальных файлов.
+
+Первый раз файл загружается с диска (FSInputFile), Telegram возвращает
+file_id, и дальше тот же файл отправляется по этому id без повторной
+загрузки. Если Telegram отклонил сохраненный id, файл загружается заново.
+Ключ кэша - (метод, путь): file_id видео не всегда годится для sendDocument.
+"""
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile, InputMediaPhoto, Message
+
+logger = logging.getLogger(__name__)
+
+InputRef = Union[str, FSInputFile]
+SaveFileId = Callable[[str, Optional[str]], Awaitable[None]]
+
+# (метод, путь) -> file_id
+_file_ids: Dict[Tuple[str, str], str] = {}
+# загрузки в процессе: остальные отправители ждут file_id, а не грузят файл еще раз
+_uploading: Dict[Tuple[str, str], asyncio.Event] = {}
+
+
+def remember(method: str, path: str, file_id: str) -> None:
+    _file_ids[(method, path)] = file_id
+
+
+def forget(method: str, path: str) -> None:
+    _file_ids.pop((method, path), None)
+
+
+def clear() -> None:
+    """Забыть все file_id (например, после восстановления базы из бэкапа)."""
+    _file_ids.clear()
+
+
+def _file_id_of(message: Message) -> Optional[str]:
+    if message.photo:
+        return message.photo[-1].file_id
+    for attachment in (message.video, message.audio, message.document, message.animation):
+        if attachment is not None:
+            return attachment.file_id
+    return None
+
+
+# ответы Bot API на устаревший или чужой file_id; "file is too big",
+# "wrong file type" и прочие ошибки повторной загрузкой не лечатся
+_REJECTED_ID_ERRORS = (
+    "wrong file identifier",
+    "wrong remote file identifier",
+    "file_reference_expired",
+)
+
+
+def _is_rejected_id(e: TelegramBadRequest) -> bool:
+    text = str(e).lower()
+    return any(error in text for error in _REJECTED_ID_ERRORS)
+
+
+async def send_file(
+    method: str,
+    path: str,
+    send: Callable[[InputRef], Awaitable[Message]],
+    save: Optional[SaveFileId] = None,
+) -> Message:
+    """
+    Отправить файл по file_id из кэша, иначе загрузить с диска.
+    save(path, file_id) вызывается, когда file_id появился или стал недействителен.
+    """
+    key = (method, path)
+    while True:
+        file_id = _file_ids.get(key)
+        if file_id:
+            try:
+                return await send(file_id)
+            except TelegramBadRequest as e:
+                if not _is_rejected_id(e):
+                    raise
+                # пока шла отправка, id мог уже обновить другой отправитель
+                if _file_ids.get(key) == file_id:
+                    logger.warning("Cached file_id for %s rejected, re-uploading: %s", path, e)
+                    forget(method, path)
+                    if save:
+                        await save(path, None)
+                continue
+        done = _uploading.get(key)
+        if done is None:
+            break
+        # файл уже грузит другой отправитель; если его загрузка не удалась,
+        # грузить начнет только один из ждущих, остальные снова подождут
+        await done.wait()
+
+    done = _uploading[key] = asyncio.Event()
+    try:
+        message = await send(FSInputFile(path))
+        new_id = _file_id_of(message)
+        if new_id:
+            remember(method, path, new_id)
+            if save:
+                await save(path, new_id)
+        return message
+    finally:
+        _uploading.pop(key, None)
+        done.set()
+
+
+async def send_photo_group(
+    paths: Sequence[str],
+    captions: Sequence[Optional[str]],
+    send: Callable[[List[InputMediaPhoto]], Awaitable[List[Message]]],
+    save: Optional[SaveFileId] = None,
+) -> List[Message]:
+    """Альбом картинок: закэшированные по file_id, остальные загружаем."""
+
+    def build(use_cache: bool) -> List[InputMediaPhoto]:
+        return [
+            InputMediaPhoto(
+                media=(_file_ids.get(("photo", p)) if use_cache else None) or FSInputFile(p),
+                caption=cap,
+            )
+            for p, cap in zip(paths, captions)
+        ]
+
+    use_cache = any(("photo", p) in _file_ids for p in paths)
+    try:
+        messages = await send(build(use_cache))
+    except TelegramBadRequest as e:
+        if not use_cache or not _is_rejected_id(e):
+            raise
+        logger.warning("Cached album file_ids rejected, re-uploading: %s", e)
+        for p in paths:
+            forget("photo", p)
+            if save:
+                await save(p, None)
+        messages = await send(build(False))
+
+    for p, message in zip(paths, messages):
+        new_id = _file_id_of(message)
+        if new_id and _file_ids.get(("photo", p)) != new_id:
+            remember("photo", p, new_id)
+            if save:
+                await save(p, new_id)
+    return messages
@@ -0,0 +1,299 @@
+"""
+Метрики процесса в формате Prometheus (text exposition 0.0.4), отдаются на /metrics.
+
+Без внешних зависимостей: счетчики и гистограммы - это словари и списки
+в памяти процесса, запись метрики стоит порядка микросекунды, поэтому
+все включено постоянно. Все обновления идут из одного event loop.
+
+Что меряем:
+- время и ошибки обработчиков aiogram (HandlerMetricsMiddleware);
+- время функций db.py (декоратор timed);
+- время и ошибки запросов к Bot API по методам (TelegramMetricsMiddleware);
+- результаты рассылок и классы ошибок (broadcaster.py);
+- очередь апдейтов и притормаживание приема (dispatch.py);
+- отброшенные частые нажатия кнопок (antiflood.py);
+- шаги фоновой уборки и что она убрала (housekeeping.py);
+- задержку event loop (monitor_loop_lag).
+"""
+import asyncio
+import functools
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple, TypeVar
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.dispatcher.event.handler import HandlerObject
+
+# секунды: от долей миллисекунды (SQLite) до десятков секунд (загрузка видео)
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+)
+
+LabelValues = Tuple[str, ...]
+
+_registry: List["_Metric"] = []
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        _registry.append(self)
+
+    def render(self) -> List[str]:
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        self.values[labels] = self.values.get(labels, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        for labels, value in sorted(self.values.items()):
+            lines.append(
+                f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+            )
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, *labels: str, value: float) -> None:
+        self.values[labels] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [счетчики по корзинам (+Inf последней), сумма, количество]
+        self.series: Dict[LabelValues, List[Any]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        names = self.labelnames + ("le",)
+        for labels, (counts, total, count) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                lines.append(
+                    f"{self.name}_bucket"
+                    f"{_format_labels(names, labels + (_format_value(bound),))} {cumulative}"
+                )
+            label_str = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_str} {_format_value(total)}")
+            lines.append(f"{self.name}_count{label_str} {count}")
+        return lines
+
+
+def render() -> str:
+    lines: List[str] = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# ---------- Metrics ----------
+
+HANDLER_LATENCY = Histogram(
+    "kazoo_handler_seconds", "Время обработки апдейта хендлером aiogram", ["handler"]
+)
+HANDLER_ERRORS = Counter(
+    "kazoo_handler_errors_total", "Исключения в хендлерах aiogram", ["handler", "error"]
+)
+DB_LATENCY = Histogram(
+    "kazoo_db_seconds", "Время вызова функций db.py", ["function"]
+)
+DB_ERRORS = Counter(
+    "kazoo_db_errors_total", "Исключения в функциях db.py", ["function", "error"]
+)
+DB_WAIT = Histogram(
+    "kazoo_db_wait_seconds",
+    "Ожидание соединения: read - пул читателей, write - блокировка писателя",
+    ["kind"],
+)
+TELEGRAM_LATENCY = Histogram(
+    "kazoo_telegram_request_seconds", "Время запросов к Bot API", ["method"]
+)
+TELEGRAM_ERRORS = Counter(
+    "kazoo_telegram_errors_total", "Ошибки запросов к Bot API", ["method", "error"]
+)
+BROADCAST_MESSAGES = Counter(
+    "kazoo_broadcast_recipients_total", "Получатели рассылок по результату", ["status"]
+)
+BROADCAST_FAILURES = Counter(
+    "kazoo_broadcast_failures_total", "Неудачные доставки рассылок по классу ошибки", ["error"]
+)
+BROADCAST_THROTTLED = Counter(
+    "kazoo_broadcast_throttled_total", "Ответы 429 (RetryAfter) во время рассылок"
+)
+BROADCAST_RATE = Gauge(
+    "kazoo_broadcast_rate", "Скорость последней активной рассылки, получателей в секунду"
+)
+UPDATES_QUEUED = Gauge(
+    "kazoo_updates_queued", "Апдейты, ждущие своей очереди пользователя или свободного слота"
+)
+UPDATES_ACTIVE = Gauge(
+    "kazoo_updates_active", "Апдейты, которые сейчас обрабатываются"
+)
+UPDATE_QUEUE_WAIT = Histogram(
+    "kazoo_update_queue_seconds", "Ожидание апдейта в очереди до начала обработки"
+)
+UPDATES_THROTTLED = Counter(
+    "kazoo_updates_throttled_total",
+    "Прием апдейтов остановлен до разгрузки очереди: polling - пауза getUpdates, "
+    "webhook - ответ Telegram придержан",
+    ["source"],
+)
+UPDATES_REJECTED = Counter(
+    "kazoo_updates_rejected_total", "Webhook-апдейты, отклоненные с 503 из-за переполненной очереди"
+)
+ANTIFLOOD_DROPPED = Counter(
+    "kazoo_antiflood_dropped_total",
+    "Отброшенные нажатия: duplicate - повтор той же кнопки, rate - слишком часто",
+    ["reason"],
+)
+HOUSEKEEPING_STEP = Histogram(
+    "kazoo_housekeeping_step_seconds",
+    "Длительность одного шага фоновой уборки (столько она держит базу)",
+    ["job"],
+)
+HOUSEKEEPING_ITEMS = Counter(
+    "kazoo_housekeeping_items_total",
+    "Убрано фоновой уборкой: prune - пользователей, media - файлов, "
+    "vacuum - страниц, analyze - таблиц",
+    ["job"],
+)
+LOOP_LAG = Histogram(
+    "kazoo_event_loop_lag_seconds",
+    "Опоздание пробуждения event loop относительно расписания",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+LOOP_LAG_LAST = Gauge(
+    "kazoo_event_loop_lag_last_seconds", "Последнее измеренное опоздание event loop"
+)
+
+
+# ---------- Instrumentation ----------
+
+F = TypeVar("F", bound=Callable[..., Awaitable[Any]])
+
+# какая функция db.py сейчас выполняется (для профайлера запросов)
+DB_FUNCTION: ContextVar[str] = ContextVar("db_function", default="-")
+
+
+def timed(func: F) -> F:
+    """Декоратор для корутин db.py: время и исключения по имени функции."""
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(*args: Any, **kwargs: Any) -> Any:
+        token = DB_FUNCTION.set(name)
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception as e:
+            DB_ERRORS.inc(name, type(e).__name__)
+            raise
+        finally:
+            DB_LATENCY.observe(time.perf_counter() - started, name)
+            DB_FUNCTION.reset(token)
+
+    return wrapper  # type: ignore[return-value]
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """
+    Внутренний middleware роутера: к этому моменту хендлер уже выбран
+    (data["handler"]), так что время пишется по его имени.
+    """
+
+    async def __call__(self, handler, event, data: Dict[str, Any]) -> Any:
+        handler_obj: Optional[HandlerObject] = data.get("handler")
+        name = getattr(handler_obj.callback, "__name__", "unknown") if handler_obj else "unknown"
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            HANDLER_ERRORS.inc(name, type(e).__name__)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - started, name)
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: все запросы к Bot API, включая рассылки."""
+
+    async def __call__(self, make_request, bot, method) -> Any:
+        name = getattr(method, "__api_method__", type(method).__name__)
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            TELEGRAM_ERRORS.inc(name, type(e).__name__)
+            raise
+        finally:
+            TELEGRAM_LATENCY.observe(time.perf_counter() - started, name)
+
+
+async def monitor_loop_lag(interval: float = 0.5) -> None:
+    """Фоновая задача: насколько позже запланированного просыпается event loop."""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - expected)
+        LOOP_LAG.observe(lag)
+        LOOP_LAG_LAST.set(value=lag)
@@ -0,0 +1,321 @@
+"""
+Версии схемы базы (PRAGMA user_version).
+
+MIGRATIONS - упорядоченный список шагов, шаг N переводит базу с версии
+N-1 на N. Каждый шаг выполняется в своей транзакции вместе с записью новой
+версии: если шаг упал, база остается на прежней версии и при следующем
+старте он повторится. Если версия уже последняя, при старте схема
+не трогается вовсе - одно чтение user_version.
+
+Выпущенные шаги не меняются, новые добавляются только в конец.
+Базы, созданные до миграций (user_version = 0), проходят все шаги:
+первый написан так, чтобы не ломаться на уже существующих таблицах.
+"""
+import logging
+import sqlite3
+import time
+from typing import Awaitable, Callable, Iterator, List, Tuple
+
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+# другие процессы (режим split) ждут, пока один из них прогоняет миграции
+MIGRATION_BUSY_TIMEOUT_MS = 10 * 60 * 1000
+
+Migration = Callable[[aiosqlite.Connection], Awaitable[None]]
+
+
+def _statements(script: str) -> Iterator[str]:
+    """
+    Разбить скрипт на команды: executescript() сам делает COMMIT,
+    а шаг миграции должен быть одной транзакцией.
+    """
+    statement = ""
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            yield statement.strip()
+            statement = ""
+
+
+async def _execute_script(db: aiosqlite.Connection, script: str) -> None:
+    for statement in _statements(script):
+        await db.execute(statement)
+
+
+async def _ensure_column(
+    db: aiosqlite.Connection,
+    table: str,
+    column: str,
+    decl: str,
+) -> None:
+    """Добавить колонку в уже существующую таблицу (старые базы)."""
+    cur = await db.execute(f"PRAGMA table_info({table})")
+    if column not in {r[1] for r in await cur.fetchall()}:
+        await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+# ---------- 1: baseline ----------
+
+# схема на момент появления миграций (все IF NOT EXISTS - старые базы
+# ее уже частично или полностью имеют)
+BASELINE_SQL = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id   INTEGER PRIMARY KEY,
+    username  TEXT,
+    joined_at INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS tracks (
+    id         INTEGER PRIMARY KEY AUTOINCREMENT,
+    title      TEXT NOT NULL,
+    points     INTEGER NOT NULL DEFAULT 1,
+    hint       TEXT,
+    is_active  INTEGER NOT NULL DEFAULT 1,
+    created_at INTEGER NOT NULL
+);
+
+-- фильтры и постраничный вывод в админке (ORDER BY id DESC)
+CREATE INDEX IF NOT EXISTS idx_tracks_active_id ON tracks(is_active, id);
+CREATE INDEX IF NOT EXISTS idx_tracks_points_id ON tracks(points, id);
+CREATE INDEX IF NOT EXISTS idx_tracks_active_points_id ON tracks(is_active, points, id);
+
+-- полнотекстовый поиск по названию и подсказке.
+-- Индекс без копии текста (content=''), rowid = tracks.id;
+-- ё приводим к е, чтобы "елка" находила "Ёлка"
+CREATE VIRTUAL TABLE IF NOT EXISTS tracks_fts USING fts5(
+    title,
+    hint,
+    content = '',
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+
+CREATE TRIGGER IF NOT EXISTS tracks_fts_ai AFTER INSERT ON tracks BEGIN
+    INSERT INTO tracks_fts (rowid, title, hint) VALUES (
+        new.id,
+        replace(replace(new.title, 'ё', 'е'), 'Ё', 'Е'),
+        replace(replace(new.hint, 'ё', 'е'), 'Ё', 'Е')
+    );
+END;
+
+CREATE TRIGGER IF NOT EXISTS tracks_fts_ad AFTER DELETE ON tracks BEGIN
+    INSERT INTO tracks_fts (tracks_fts, rowid, title, hint) VALUES (
+        'delete',
+        old.id,
+        replace(replace(old.title, 'ё', 'е'), 'Ё', 'Е'),
+        replace(replace(old.hint, 'ё', 'е'), 'Ё', 'Е')
+    );
+END;
+
+CREATE TRIGGER IF NOT EXISTS tracks_fts_au AFTER UPDATE OF title, hint ON tracks BEGIN
+    INSERT INTO tracks_fts (tracks_fts, rowid, title, hint) VALUES (
+        'delete',
+        old.id,
+        replace(replace(old.title, 'ё', 'е'), 'Ё', 'Е'),
+        replace(replace(old.hint, 'ё', 'е'), 'Ё', 'Е')
+    );
+    INSERT INTO tracks_fts (rowid, title, hint) VALUES (
+        new.id,
+        replace(replace(new.title, 'ё', 'е'), 'Ё', 'Е'),
+        replace(replace(new.hint, 'ё', 'е'), 'Ё', 'Е')
+    );
+END;
+
+-- какие треки уже показывались конкретному пользователю
+CREATE TABLE IF NOT EXISTS used_tracks (
+    user_id  INTEGER NOT NULL,
+    track_id INTEGER NOT NULL,
+    PRIMARY KEY (user_id, track_id)
+);
+
+-- то же самое в режиме USED_TRACKS_STORAGE=bitmap:
+-- zlib(битовый массив), бит N выставлен = трек N уже показан
+CREATE TABLE IF NOT EXISTS used_bitmaps (
+    user_id INTEGER PRIMARY KEY,
+    bits    BLOB NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS broadcasts (
+    id         INTEGER PRIMARY KEY AUTOINCREMENT,
+    text       TEXT NOT NULL,
+    created_at INTEGER NOT NULL,
+    sent_at    INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS broadcast_files (
+    id           INTEGER PRIMARY KEY AUTOINCREMENT,
+    broadcast_id INTEGER NOT NULL,
+    kind         TEXT NOT NULL, -- photo / video / file
+    path         TEXT NOT NULL,
+    created_at   INTEGER NOT NULL,
+    file_id      TEXT, -- Telegram file_id после первой успешной отправки
+    sha256       TEXT, -- хэш содержимого: одинаковые файлы храним один раз
+    FOREIGN KEY (broadcast_id) REFERENCES broadcasts(id) ON DELETE CASCADE
+);
+
+-- журнал доставки рассылки: по строке на получателя,
+-- по нему рассылка продолжается с места остановки после рестарта
+CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+    broadcast_id INTEGER NOT NULL,
+    user_id      INTEGER NOT NULL,
+    status       TEXT NOT NULL DEFAULT 'pending', -- pending / sent / failed
+    error        TEXT,                            -- класс ошибки для failed
+    updated_at   INTEGER,
+    PRIMARY KEY (broadcast_id, user_id),
+    FOREIGN KEY (broadcast_id) REFERENCES broadcasts(id) ON DELETE CASCADE
+) WITHOUT ROWID;
+
+-- колода пользователя: курсор отдельно от карт, чтобы выдача трека
+-- переписывала маленькую строку, а не весь BLOB
+CREATE TABLE IF NOT EXISTS user_decks (
+    user_id    INTEGER PRIMARY KEY,
+    pos        INTEGER NOT NULL DEFAULT 0, -- сколько карт уже выдано
+    size       INTEGER NOT NULL,
+    version    INTEGER NOT NULL,           -- tracks_version, под которую собрана колода
+    updated_at INTEGER NOT NULL
+);
+
+-- перемешанные track_id (uint32 little-endian) в порядке выдачи
+CREATE TABLE IF NOT EXISTS user_deck_cards (
+    user_id INTEGER PRIMARY KEY,
+    cards   BLOB NOT NULL
+);
+
+-- манифесты отданных бэкапов: от них считаются инкрементальные бэкапы
+CREATE TABLE IF NOT EXISTS backups (
+    id         TEXT PRIMARY KEY,
+    parent_id  TEXT,
+    kind       TEXT NOT NULL, -- full / incremental
+    created_at INTEGER NOT NULL,
+    manifest   TEXT NOT NULL  -- JSON: путь -> sha256/size/mtime
+);
+
+-- служебные счетчики (например, версия каталога треков)
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value
+) WITHOUT ROWID;
+"""
+
+
+async def _baseline(db: aiosqlite.Connection) -> None:
+    await _execute_script(db, BASELINE_SQL)
+    await _ensure_column(db, "broadcast_files", "file_id", "TEXT")
+    await _ensure_column(db, "broadcast_files", "sha256", "TEXT")
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_broadcast_files_sha256 "
+        "ON broadcast_files(sha256)"
+    )
+    # в базе, созданной до поиска, треки есть, а индекса по ним еще нет
+    cur = await db.execute("SELECT 1 FROM meta WHERE key = 'tracks_fts'")
+    if await cur.fetchone() is None:
+        await db.execute("INSERT INTO tracks_fts (tracks_fts) VALUES ('delete-all')")
+        await db.execute(
+            "INSERT INTO tracks_fts (rowid, title, hint) "
+            "SELECT id, replace(replace(title, 'ё', 'е'), 'Ё', 'Е'), "
+            "replace(replace(hint, 'ё', 'е'), 'Ё', 'Е') FROM tracks"
+        )
+        await db.execute("INSERT INTO meta (key, value) VALUES ('tracks_fts', 1)")
+
+
+# ---------- 2: indexes for hot queries ----------
+
+async def _hot_query_indexes(db: aiosqlite.Connection) -> None:
+    await _execute_script(db, """
+-- список рассылок в админке (list_broadcasts): ORDER BY по выражению
+-- идет по индексу, без сортировки всей таблицы во временном B-дереве
+CREATE INDEX idx_broadcasts_recent ON broadcasts(COALESCE(sent_at, created_at));
+
+-- очередь рассылки (get_pending_deliveries) и поиск прерванных рассылок
+-- (list_unfinished_broadcasts): частичный покрывающий индекс только по
+-- pending, отправленные получатели из него уходят и не просматриваются
+CREATE INDEX idx_deliveries_pending
+    ON broadcast_deliveries(broadcast_id, user_id) WHERE status = 'pending';
+
+-- файлы рассылки по порядку и каскадное удаление рассылки
+CREATE INDEX idx_broadcast_files_broadcast ON broadcast_files(broadcast_id, id);
+
+-- без статистики планировщик не отличает частичный индекс от первичного
+-- ключа (приблизительной, с analysis_limit, тоже не хватает)
+ANALYZE broadcasts;
+ANALYZE broadcast_deliveries;
+ANALYZE broadcast_files;
+""")
+
+
+# ---------- 3: used_tracks WITHOUT ROWID ----------
+
+async def _used_tracks_without_rowid(db: aiosqlite.Connection) -> None:
+    """
+    Таблица из одного составного ключа: без rowid данные лежат прямо
+    в B-дереве первичного ключа, а не в таблице плюс отдельном индексе.
+    """
+    await db.execute(
+        "CREATE TABLE used_tracks_new ("
+        "user_id INTEGER NOT NULL, "
+        "track_id INTEGER NOT NULL, "
+        "PRIMARY KEY (user_id, track_id)"
+        ") WITHOUT ROWID"
+    )
+    await db.execute(
+        "INSERT INTO used_tracks_new (user_id, track_id) "
+        "SELECT user_id, track_id FROM used_tracks"
+    )
+    await db.execute("DROP TABLE used_tracks")
+    await db.execute("ALTER TABLE used_tracks_new RENAME TO used_tracks")
+
+
+MIGRATIONS: List[Tuple[str, Migration]] = [
+    ("baseline", _baseline),
+    ("hot query indexes", _hot_query_indexes),
+    ("used_tracks without rowid", _used_tracks_without_rowid),
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+async def _user_version(db: aiosqlite.Connection) -> int:
+    cur = await db.execute("PRAGMA user_version")
+    row = await cur.fetchone()
+    return row[0]
+
+
+async def migrate(db: aiosqlite.Connection) -> int:
+    """Довести схему до SCHEMA_VERSION. Возвращает версию базы после миграций."""
+    version = await _user_version(db)
+    if version == SCHEMA_VERSION:
+        return version
+    if version > SCHEMA_VERSION:
+        logger.warning(
+            "Database schema version %s is newer than this code knows (%s)",
+            version, SCHEMA_VERSION,
+        )
+        return version
+
+    cur = await db.execute("PRAGMA busy_timeout")
+    busy_timeout = (await cur.fetchone())[0]
+    await db.execute(f"PRAGMA busy_timeout = {MIGRATION_BUSY_TIMEOUT_MS}")
+    try:
+        while True:
+            # IMMEDIATE: сразу берем блокировку записи, и версию читаем уже под
+            # ней - параллельно стартующий процесс мог успеть сделать этот шаг
+            await db.execute("BEGIN IMMEDIATE")
+            try:
+                version = await _user_version(db)
+                if version >= SCHEMA_VERSION:
+                    await db.rollback()
+                    return version
+                name, step = MIGRATIONS[version]
+                started = time.perf_counter()
+                await step(db)
+                await db.execute(f"PRAGMA user_version = {version + 1}")
+                await db.commit()
+            except BaseException:
+                await db.rollback()
+                raise
+            logger.info(
+                "Database migrated to version %s (%s) in %.2fs",
+                version + 1, name, time.perf_counter() - started,
+            )
+    finally:
+        await db.execute(f"PRAGMA busy_timeout = {busy_timeout}")
@@ -0,0 +1,298 @@
+"""
+Профайлер запросов db.py (включается по желанию).
+
+Когда он включен, соединения из _read()/_write() оборачиваются в прокси,
+который для каждого запроса запоминает:
+- текст SQL (списки ?, ?, ? свернуты, чтобы IN (...) разной длины не плодили строки);
+- форму параметров (типы, без значений) и размер пачки у executemany;
+- сколько строк вернулось (или изменилось);
+- время выполнения вместе с fetch*, отдельно - ожидание соединения.
+
+Статистика копится по паре (функция db.py, SQL), страница
+/admin_web/profiler показывает самые дорогие запросы по суммарному времени.
+Запросы дольше SLOW_QUERY_MS попадают в журнал медленных запросов
+вместе с EXPLAIN QUERY PLAN (план снимается один раз на текст запроса).
+
+DB_PROFILE=1 включает профайлер при старте, в админке его можно
+включить и выключить на ходу.
+"""
+import logging
+import os
+import re
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+import aiosqlite
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "100"))
+SLOW_LOG_SIZE = 100
+# больше разных запросов не бывает, предел - на случай динамического SQL
+MAX_STATEMENTS = 1000
+
+enabled = os.getenv("DB_PROFILE", "") not in ("", "0")
+started_at = time.time()
+
+_IN_LIST = re.compile(r"\?(\s*,\s*\?)+")
+_SPACES = re.compile(r"\s+")
+
+
+@dataclass
+class QueryStat:
+    function: str
+    sql: str
+    params: str = ""
+    calls: int = 0
+    total: float = 0.0
+    max: float = 0.0
+    rows: int = 0
+
+    @property
+    def avg(self) -> float:
+        return self.total / self.calls if self.calls else 0.0
+
+
+@dataclass
+class WaitStat:
+    calls: int = 0
+    total: float = 0.0
+    max: float = 0.0
+
+
+@dataclass
+class SlowQuery:
+    at: float
+    function: str
+    sql: str
+    params: str
+    seconds: float
+    rows: int
+    plan: str
+
+
+_stats: Dict[Tuple[str, str], QueryStat] = {}
+_waits: Dict[Tuple[str, str], WaitStat] = {}
+_slow: Deque[SlowQuery] = deque(maxlen=SLOW_LOG_SIZE)
+_plans: Dict[str, str] = {}
+
+
+def set_enabled(value: bool) -> None:
+    global enabled
+    enabled = value
+
+
+def reset() -> None:
+    global started_at
+    _stats.clear()
+    _waits.clear()
+    _slow.clear()
+    _plans.clear()
+    started_at = time.time()
+
+
+def normalize(sql: str) -> str:
+    return _IN_LIST.sub("?, …", _SPACES.sub(" ", sql).strip())
+
+
+def _shape(parameters: Any) -> str:
+    if not parameters:
+        return ""
+    if isinstance(parameters, dict):
+        return "{" + ", ".join(f"{k}: {type(v).__name__}" for k, v in parameters.items()) + "}"
+    return "(" + ", ".join(type(v).__name__ for v in parameters) + ")"
+
+
+def _stat(sql: str, params: str) -> QueryStat:
+    function = metrics.DB_FUNCTION.get()
+    key = (function, normalize(sql))
+    stat = _stats.get(key)
+    if stat is None:
+        if len(_stats) >= MAX_STATEMENTS:
+            key = (function, "(прочие запросы)")
+            stat = _stats.setdefault(key, QueryStat(function, key[1]))
+        else:
+            stat = _stats[key] = QueryStat(function, key[1])
+    stat.params = params
+    return stat
+
+
+def record_wait(kind: str, seconds: float) -> None:
+    """Ожидание соединения: kind - read (пул читателей) или write (блокировка писателя)."""
+    key = (metrics.DB_FUNCTION.get(), kind)
+    stat = _waits.get(key)
+    if stat is None:
+        stat = _waits[key] = WaitStat()
+    stat.calls += 1
+    stat.total += seconds
+    stat.max = max(stat.max, seconds)
+
+
+def bind(op: Callable[[Any], Awaitable[Any]]) -> Callable[[Any], Awaitable[Any]]:
+    """
+    Операция group commit выполняется в фоновой задаче: сохраняем имя
+    вызвавшей функции db.py, чтобы ее запросы не терялись в общей куче.
+    """
+    function = metrics.DB_FUNCTION.get()
+
+    async def run(db: Any) -> Any:
+        token = metrics.DB_FUNCTION.set(function)
+        try:
+            return await op(db)
+        finally:
+            metrics.DB_FUNCTION.reset(token)
+
+    return run
+
+
+# ---------- Reports ----------
+
+def top_queries(limit: int = 50) -> List[QueryStat]:
+    return sorted(_stats.values(), key=lambda s: s.total, reverse=True)[:limit]
+
+
+def waits() -> List[Tuple[str, str, WaitStat]]:
+    items = [(function, kind, stat) for (function, kind), stat in _waits.items()]
+    return sorted(items, key=lambda item: item[2].total, reverse=True)
+
+
+def slow_queries() -> List[SlowQuery]:
+    return list(reversed(_slow))
+
+
+# ---------- Proxies ----------
+
+class _Execution:
+    """Одно выполнение запроса: время и строки копятся, пока читают курсор."""
+
+    __slots__ = ("conn", "sql", "parameters", "stat", "seconds", "rows", "reported")
+
+    def __init__(self, conn: aiosqlite.Connection, sql: str, parameters: Any, stat: QueryStat) -> None:
+        self.conn = conn
+        self.sql = sql
+        self.parameters = parameters
+        self.stat = stat
+        self.seconds = 0.0
+        self.rows = 0
+        self.reported = False
+        stat.calls += 1
+
+    async def add(self, seconds: float, rows: int) -> None:
+        stat = self.stat
+        self.seconds += seconds
+        self.rows += rows
+        stat.total += seconds
+        stat.rows += rows
+        stat.max = max(stat.max, self.seconds)
+        if not self.reported and self.seconds * 1000 >= SLOW_QUERY_MS:
+            self.reported = True
+            await self._report()
+
+    async def _report(self) -> None:
+        key = normalize(self.sql)
+        plan = _plans.get(key)
+        if plan is None:
+            plan = await self._explain()
+            _plans[key] = plan
+        _slow.append(SlowQuery(
+            at=time.time(),
+            function=self.stat.function,
+            sql=self.stat.sql,
+            params=self.stat.params,
+            seconds=self.seconds,
+            rows=self.rows,
+            plan=plan,
+        ))
+        logger.warning(
+            "Slow query %.1f ms in %s: %s\n%s",
+            self.seconds * 1000, self.stat.function, self.stat.sql, plan,
+        )
+
+    async def _explain(self) -> str:
+        if not self.sql.lstrip().upper().startswith(("SELECT", "WITH", "INSERT", "UPDATE", "DELETE")):
+            return ""
+        if not self.parameters and "?" in self.sql:
+            return ""  # пустой executemany: подставить нечего
+        try:
+            cur = await self.conn.execute("EXPLAIN QUERY PLAN " + self.sql, self.parameters or ())
+            rows = await cur.fetchall()
+        except Exception as e:
+            return f"(план не получен: {e})"
+        # (id, parent, notused, detail) -> дерево с отступами по parent
+        depth: Dict[int, int] = {0: 0}
+        lines = []
+        for node_id, parent, _notused, detail in rows:
+            depth[node_id] = depth.get(parent, 0) + 1
+            lines.append("  " * (depth[node_id] - 1) + detail)
+        return "\n".join(lines)
+
+
+class ProfiledCursor:
+    def __init__(self, cursor: aiosqlite.Cursor, execution: _Execution) -> None:
+        self._cursor = cursor
+        self._execution = execution
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._cursor, name)
+
+    async def fetchone(self) -> Optional[Any]:
+        started = time.perf_counter()
+        row = await self._cursor.fetchone()
+        await self._execution.add(time.perf_counter() - started, 0 if row is None else 1)
+        return row
+
+    async def fetchmany(self, size: Optional[int] = None) -> List[Any]:
+        started = time.perf_counter()
+        rows = await (self._cursor.fetchmany() if size is None else self._cursor.fetchmany(size))
+        await self._execution.add(time.perf_counter() - started, len(rows))
+        return rows
+
+    async def fetchall(self) -> List[Any]:
+        started = time.perf_counter()
+        rows = await self._cursor.fetchall()
+        await self._execution.add(time.perf_counter() - started, len(rows))
+        return rows
+
+
+class ProfiledConnection:
+    """Прокси над aiosqlite.Connection: все, кроме запросов, уходит как есть."""
+
+    def __init__(self, conn: aiosqlite.Connection) -> None:
+        self._conn = conn
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._conn, name)
+
+    async def execute(self, sql: str, parameters: Any = None) -> ProfiledCursor:
+        execution = _Execution(self._conn, sql, parameters, _stat(sql, _shape(parameters)))
+        started = time.perf_counter()
+        cursor = await self._conn.execute(sql, parameters)
+        await execution.add(time.perf_counter() - started, max(cursor.rowcount, 0))
+        return ProfiledCursor(cursor, execution)
+
+    async def executemany(self, sql: str, parameters: Any) -> aiosqlite.Cursor:
+        parameters = list(parameters)
+        shape = f"{len(parameters)} × {_shape(parameters[0])}" if parameters else "0 ×"
+        # план снимается с параметрами первой строки пачки
+        execution = _Execution(
+            self._conn, sql, parameters[0] if parameters else None, _stat(sql, shape)
+        )
+        started = time.perf_counter()
+        cursor = await self._conn.executemany(sql, parameters)
+        await execution.add(time.perf_counter() - started, max(cursor.rowcount, 0))
+        return cursor
+
+    async def commit(self) -> None:
+        execution = _Execution(self._conn, "COMMIT", None, _stat("COMMIT", ""))
+        started = time.perf_counter()
+        await self._conn.commit()
+        await execution.add(time.perf_counter() - started, 0)
+
+
+def wrap(conn: aiosqlite.Connection) -> Any:
+    """Соединение для запросов: с профайлером, если он включен."""
+    return ProfiledConnection(conn) if enabled else conn
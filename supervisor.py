@@ -0,0 +1,87 @@
+"""
+Режим PROCESS_MODE=split: админка и бот в разных процессах.
+
+Supervisor запускает main.py с PROCESS_ROLE=web (админка, порт PORT)
+и BOT_WORKERS процессов с PROCESS_ROLE=bot (апдейты Telegram, рассылки -
+в воркере 0), перезапускает упавшие с растущей паузой и при SIGTERM
+останавливает всех. Процессы работают с одной SQLite-базой (WAL,
+busy_timeout), админка передает воркерам команды через ipc.py.
+"""
+import asyncio
+import logging
+import os
+import signal
+import sys
+from typing import Dict, List
+
+logger = logging.getLogger(__name__)
+
+# при long polling воркер всегда один: getUpdates нельзя вызывать параллельно
+BOT_WORKERS = max(1, int(os.getenv("BOT_WORKERS", "2")))
+RESTART_DELAY_MAX = 30.0
+# проработал дольше - значит, падение не циклическое, пауза сбрасывается
+HEALTHY_AFTER = 60.0
+STOP_TIMEOUT = 15.0
+
+
+async def _keep_running(
+    script: str,
+    role: str,
+    index: int,
+    workers: int,
+    stopping: asyncio.Event,
+    procs: Dict[str, asyncio.subprocess.Process],
+) -> None:
+    name = f"{role}-{index}" if role == "bot" else role
+    loop = asyncio.get_running_loop()
+    delay = 1.0
+    while not stopping.is_set():
+        # BOT_WORKERS - сколько воркеров на самом деле: админка ждет от всех
+        # подтверждения db_suspend перед restore
+        env = dict(
+            os.environ, PROCESS_ROLE=role, WORKER_INDEX=str(index), BOT_WORKERS=str(workers)
+        )
+        proc = await asyncio.create_subprocess_exec(sys.executable, script, env=env)
+        procs[name] = proc
+        logger.info("Started %s (pid %s)", name, proc.pid)
+        started = loop.time()
+        code = await proc.wait()
+        if stopping.is_set():
+            return
+        if loop.time() - started > HEALTHY_AFTER:
+            delay = 1.0
+        logger.warning("%s exited with code %s, restarting in %.0fs", name, code, delay)
+        try:
+            await asyncio.wait_for(stopping.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+        delay = min(delay * 2, RESTART_DELAY_MAX)
+
+
+async def run(script: str, workers: int) -> None:
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stopping.set)
+
+    procs: Dict[str, asyncio.subprocess.Process] = {}
+    tasks: List["asyncio.Task[None]"] = [
+        asyncio.create_task(_keep_running(script, "web", 0, workers, stopping, procs))
+    ]
+    tasks += [
+        asyncio.create_task(_keep_running(script, "bot", i, workers, stopping, procs))
+        for i in range(workers)
+    ]
+    logger.info("Split mode: admin + %s bot worker(s)", workers)
+
+    await stopping.wait()
+    logger.info("Stopping child processes...")
+    for proc in procs.values():
+        if proc.returncode is None:
+            proc.terminate()
+    _done, pending = await asyncio.wait(tasks, timeout=STOP_TIMEOUT)
+    for name, proc in procs.items():
+        if proc.returncode is None:
+            logger.warning("%s did not stop in %.0fs, killing", name, STOP_TIMEOUT)
+            proc.kill()
+    await asyncio.gather(*pending, return_exceptions=True)
@@ -0,0 +1,32 @@
+import asyncio
+
+import db
+
+
+def test_group_batch_is_one_transaction(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "db.sqlite3"))
+
+    async def scenario():
+        await db.init_db()
+        try:
+            statements = []
+            await db._writer.set_trace_callback(statements.append)
+            await asyncio.gather(*(db.mark_track_used(1, track_id) for track_id in range(50)))
+            await db._writer.set_trace_callback(None)
+
+            async with db._read() as conn:
+                cur = await conn.execute("SELECT COUNT(*) FROM used_tracks WHERE user_id = 1")
+                assert (await cur.fetchone())[0] == 50
+            return statements, db._writer.in_transaction
+        finally:
+            await db.close_db()
+
+    statements, in_transaction = asyncio.run(scenario())
+    begins = [s for s in statements if s.upper().startswith("BEGIN")]
+    commits = [s for s in statements if s.upper().startswith("COMMIT")]
+    inserts = [s for s in statements if "INSERT" in s.upper()]
+    assert len(inserts) == 50
+    # 50 одновременных записей - одна транзакция, а не 50
+    assert len(begins) == 1
+    assert len(commits) == 1
+    assert not in_transaction
@@ -0,0 +1,72 @@
+import asyncio
+
+import pytest
+from aiogram import Bot, Dispatcher, Router
+from aiogram.types import Message
+
+import admin_web
+import dispatch
+import fake_telegram
+
+httpx = pytest.importorskip("httpx")
+
+SECRET = "s3cret"
+
+
+def _make_app(release: asyncio.Event, started: asyncio.Event, seen: list):
+    router = Router()
+
+    @router.message()
+    async def on_message(message: Message):
+        seen.append(message.text)
+        started.set()
+        await release.wait()
+
+    bot = Bot("42:TEST")
+    dp = Dispatcher()
+    dp.include_router(router)
+    scheduler = dispatch.install(dp, bot)
+    # один апдейт в работе - и очередь уже полна
+    scheduler.queue_limit = 1
+    return admin_web.create_webhook_app(bot, dp, SECRET), bot
+
+
+async def _post(client, update, secret=SECRET):
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret is not None else {}
+    return await client.post(admin_web.WEBHOOK_PATH, json=update, headers=headers)
+
+
+def test_webhook_secret_and_backpressure(monkeypatch):
+    monkeypatch.setattr(admin_web, "WEBHOOK_BACKPRESSURE_TIMEOUT", 0.05)
+
+    async def scenario():
+        release, started, seen = asyncio.Event(), asyncio.Event(), []
+        app, bot = _make_app(release, started, seen)
+        transport = httpx.ASGITransport(app=app)
+        try:
+            async with app.router.lifespan_context(app):
+                async with httpx.AsyncClient(transport=transport, base_url="http://bot") as client:
+                    # чужой или пустой секрет - отказ, до диспетчера апдейт не доходит
+                    bad = await _post(client, fake_telegram.message_update(1, "bad"), "wrong")
+                    missing = await _post(client, fake_telegram.message_update(1, "none"), None)
+                    assert bad.status_code == 403
+                    assert missing.status_code == 403
+
+                    ok = await _post(client, fake_telegram.message_update(1, "first"))
+                    assert ok.status_code == 200
+                    await asyncio.wait_for(started.wait(), 5)
+
+                    # очередь полна: запрос ждет WEBHOOK_BACKPRESSURE_TIMEOUT и получает 503,
+                    # чтобы Telegram прислал апдейт повторно
+                    busy = await _post(client, fake_telegram.message_update(2, "second"))
+                    assert busy.status_code == 503
+
+                    release.set()
+                    retry = await _post(client, fake_telegram.message_update(2, "second"))
+                    assert retry.status_code == 200
+        finally:
+            await bot.session.close()
+        return seen
+
+    # выход из lifespan дожидается принятых апдейтов
+    assert asyncio.run(scenario()) == ["first", "second"]
@@ -0,0 +1,234 @@
+"""
+Импорт и экспорт каталога треков в CSV / JSON.
+
+Файл читается потоком (построчно для CSV, по объектам для JSON),
+каждая строка проверяется отдельно: ошибки собираются с номером строки,
+а корректные строки загружаются в базу одной транзакцией (db.import_tracks).
+Экспорт отдается кусками по мере чтения из базы.
+
+Формат строки: id, title, points, hint, is_active.
+id необязателен: с ним трек обновляется, без него - добавляется новый.
+"""
+import codecs
+import csv
+import io
+import json
+from typing import IO, Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+import db
+
+FIELDS = ("id", "title", "points", "hint", "is_active")
+# разумный предел баллов; тот же действует для формы в админке
+MAX_POINTS = 32767
+# колоды хранят track_id в array("I"), а в режиме bitmap id - номер бита
+# в битовом массиве каждого игрока (миллион - 125 КБ в памяти на игрока)
+MAX_TRACK_ID = 1_000_000
+MAX_TITLE_LEN = 300
+READ_CHUNK_SIZE = 64 * 1024
+
+TrackRow = Tuple[Optional[int], str, int, Optional[str], bool]
+RowError = Tuple[int, str]
+
+
+class TrackFormatError(Exception):
+    """Файл целиком не разбирается (не тот формат, битый JSON и т.п.)."""
+
+
+def format_of(filename: str) -> Optional[str]:
+    name = filename.lower()
+    if name.endswith(".csv"):
+        return "csv"
+    if name.endswith((".json", ".jsonl", ".ndjson")):
+        return "json"
+    return None
+
+
+# ---------- Validation ----------
+
+def _parse_bool(value: Any) -> bool:
+    if value is None or value == "":
+        return True  # по умолчанию трек активен
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in ("1", "true", "yes", "да", "y"):
+        return True
+    if text in ("0", "false", "no", "нет", "n"):
+        return False
+    raise ValueError(f"is_active: непонятное значение {value!r}")
+
+
+def validate_track(record: Dict[str, Any]) -> TrackRow:
+    """Проверить одну запись и привести ее к строке для db.import_tracks()."""
+    if not isinstance(record, dict):
+        raise ValueError("ожидается объект с полями " + ", ".join(FIELDS))
+
+    raw_id = record.get("id")
+    track_id: Optional[int] = None
+    if raw_id not in (None, ""):
+        try:
+            track_id = int(raw_id)
+        except (TypeError, ValueError):
+            raise ValueError(f"id: не число {raw_id!r}")
+        if not 1 <= track_id <= MAX_TRACK_ID:
+            raise ValueError(f"id: должен быть от 1 до {MAX_TRACK_ID}")
+
+    title = str(record.get("title") or "").strip()
+    if not title:
+        raise ValueError("title: пустое название")
+    if len(title) > MAX_TITLE_LEN:
+        raise ValueError(f"title: длиннее {MAX_TITLE_LEN} символов")
+
+    raw_points = record.get("points")
+    try:
+        points = int(raw_points) if raw_points not in (None, "") else 1
+    except (TypeError, ValueError):
+        raise ValueError(f"points: не число {raw_points!r}")
+    if not 1 <= points <= MAX_POINTS:
+        raise ValueError(f"points: должно быть от 1 до {MAX_POINTS}")
+
+    hint = record.get("hint")
+    hint = str(hint).strip() if hint not in (None, "") else None
+
+    return track_id, title, points, hint or None, _parse_bool(record.get("is_active"))
+
+
+# ---------- Parsing ----------
+
+def _iter_csv(f: IO[bytes]) -> Iterator[Tuple[int, Any]]:
+    text = io.TextIOWrapper(f, encoding="utf-8-sig", newline="")
+    try:
+        reader = csv.DictReader(text)
+        if not reader.fieldnames or "title" not in reader.fieldnames:
+            raise TrackFormatError("В CSV нет заголовка с колонкой title")
+        for record in reader:
+            yield reader.line_num, record
+    except (UnicodeDecodeError, csv.Error) as e:
+        raise TrackFormatError(f"CSV не читается: {e}") from e
+    finally:
+        # не закрываем исходный файл вместе с оберткой
+        text.detach()
+
+
+def _iter_json(f: IO[bytes]) -> Iterator[Tuple[int, Any]]:
+    """
+    JSON-массив объектов или JSON Lines, без чтения файла целиком:
+    объекты по одному достаются из буфера через raw_decode.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8-sig")()
+    buf = ""
+    pos = 0
+    eof = False
+    in_array: Optional[bool] = None
+    index = 0
+
+    def fill() -> bool:
+        nonlocal buf, pos, eof
+        if eof:
+            return False
+        chunk = f.read(READ_CHUNK_SIZE)
+        try:
+            data = utf8.decode(chunk, final=not chunk)
+        except UnicodeDecodeError as e:
+            raise TrackFormatError(f"JSON не в UTF-8: {e}") from e
+        if not chunk:
+            eof = True
+        buf = buf[pos:] + data
+        pos = 0
+        return bool(chunk)
+
+    def skip(separators: str) -> Optional[str]:
+        """Пропустить пробелы (и разделители), вернуть следующий символ."""
+        nonlocal pos
+        while True:
+            while pos < len(buf) and (buf[pos].isspace() or buf[pos] in separators):
+                pos += 1
+            if pos < len(buf):
+                return buf[pos]
+            if not fill():
+                return None
+
+    while True:
+        ch = skip("," if in_array else "")
+        if ch is None:
+            if in_array:
+                raise TrackFormatError("JSON-массив не закрыт")
+            return
+        if in_array is None:
+            in_array = ch == "["
+            if in_array:
+                pos += 1
+                continue
+        if in_array and ch == "]":
+            return
+
+        while True:
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+                # число на границе куска могло быть обрезано - дочитываем
+                if end == len(buf) and not eof and fill():
+                    continue
+                break
+            except json.JSONDecodeError as e:
+                if not fill():
+                    raise TrackFormatError(f"Битый JSON в записи {index + 1}: {e.msg}") from e
+        pos = end
+        index += 1
+        yield index, obj
+
+
+def read_tracks(f: IO[bytes], fmt: str) -> Tuple[List[TrackRow], List[RowError]]:
+    """
+    Разобрать и проверить файл. Возвращает (корректные строки, ошибки)
+    где ошибка - (номер строки CSV / записи JSON, текст).
+    Блокирующая - вызывать через asyncio.to_thread().
+    """
+    records = _iter_csv(f) if fmt == "csv" else _iter_json(f)
+    rows: List[TrackRow] = []
+    errors: List[RowError] = []
+    for line, record in records:
+        try:
+            rows.append(validate_track(record))
+        except ValueError as e:
+            errors.append((line, str(e)))
+    return rows, errors
+
+
+# ---------- Export ----------
+
+def _csv_line(values: Tuple) -> str:
+    out = io.StringIO()
+    csv.writer(out).writerow(values)
+    return out.getvalue()
+
+
+async def export_tracks(fmt: str) -> AsyncIterator[bytes]:
+    """Каталог в CSV или JSON-массиве, кусками по пачке треков."""
+    if fmt == "csv":
+        # BOM - чтобы Excel открыл кириллицу без танцев с кодировкой
+        yield ("\ufeff" + _csv_line(FIELDS)).encode("utf-8")
+        async for batch in db.iter_tracks():
+            out = io.StringIO()
+            writer = csv.writer(out)
+            for track_id, title, points, hint, is_active in batch:
+                writer.writerow((track_id, title, points, hint or "", int(is_active)))
+            yield out.getvalue().encode("utf-8")
+        return
+
+    yield b"["
+    first = True
+    async for batch in db.iter_tracks():
+        parts = []
+        for track_id, title, points, hint, is_active in batch:
+            item = {
+                "id": track_id,
+                "title": title,
+                "points": points,
+                "hint": hint,
+                "is_active": bool(is_active),
+            }
+            parts.append(("\n" if first else ",\n") + json.dumps(item, ensure_ascii=False))
+            first = False
+        yield "".join(parts).encode("utf-8")
+    yield b"\n]\n"
@@ -0,0 +1,97 @@
+"""
+Реестр пользователей в памяти с отложенной записью в базу.
+
+Каждое нажатие кнопки раньше делало UPSERT в users ради username,
+который почти никогда не меняется. Теперь известные пользователи
+и их последний username держатся в памяти (загружаются при старте),
+а в базу пишутся только новые пользователи и смененные username:
+пачкой раз в FLUSH_INTERVAL секунд, сразу при накоплении FLUSH_BATCH
+записей и при остановке процесса.
+"""
+import asyncio
+import logging
+import time
+from typing import Dict, Optional, Tuple
+
+import db
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = 1.0
+FLUSH_BATCH = 500
+
+# user_id -> последний известный username
+_known: Dict[int, Optional[str]] = {}
+# user_id -> (username, joined_at), еще не записанные в базу
+_pending: Dict[int, Tuple[Optional[str], int]] = {}
+_wakeup = asyncio.Event()
+_flush_lock = asyncio.Lock()
+_task: Optional["asyncio.Task[None]"] = None
+
+
+async def load() -> None:
+    """Прочитать всех пользователей из базы (при старте и после restore)."""
+    rows = await db.load_users()
+    _known.clear()
+    _known.update(rows)
+    # незаписанные изменения важнее прочитанного из базы
+    for user_id, (username, _joined_at) in _pending.items():
+        _known[user_id] = username
+
+
+def remember(user_id: int, username: Optional[str]) -> None:
+    """Отметить пользователя. Для уже известного с тем же username - ничего не делает."""
+    if user_id in _known and _known[user_id] == username:
+        return
+    _known[user_id] = username
+    prev = _pending.get(user_id)
+    _pending[user_id] = (username, prev[1] if prev else int(time.time()))
+    if len(_pending) >= FLUSH_BATCH:
+        _wakeup.set()
+
+
+async def flush() -> None:
+    """Записать накопленное одной транзакцией (например, перед рассылкой)."""
+    async with _flush_lock:
+        if not _pending:
+            return
+        batch = dict(_pending)
+        _pending.clear()
+        try:
+            await db.save_users(
+                [(user_id, username, joined_at) for user_id, (username, joined_at) in batch.items()]
+            )
+        except BaseException:
+            # вернем в очередь, если за это время не пришли более свежие данные
+            for user_id, item in batch.items():
+                _pending.setdefault(user_id, item)
+            raise
+
+
+async def _flush_loop() -> None:
+    while True:
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout=FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _wakeup.clear()
+        try:
+            await flush()
+        except Exception:
+            logger.exception("Failed to flush %s pending users", len(_pending))
+
+
+def start() -> None:
+    global _task
+    if _task is None:
+        _task = asyncio.create_task(_flush_loop())
+
+
+async def stop() -> None:
+    """Остановить фоновую запись и дописать все, что осталось."""
+    global _task
+    if _task is not None:
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions=True)
+        _task = None
+    await flush()